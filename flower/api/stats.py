@@ -0,0 +1,66 @@
+from tornado import web
+
+from ..utils.timeseries import RESOLUTIONS
+from . import BaseApiHandler
+
+
+class TimeSeries(BaseApiHandler):
+    @web.authenticated
+    def get(self):
+        """
+Task event counts and runtimes over time, by task name and by worker
+
+Counts of received, started, succeeded and failed task events and sums of
+task runtimes are kept per second for the last 5 minutes and per minute
+for the last 3 hours. Every series has a value for each timestamp, the
+start of its second or minute.
+
+**Example request**:
+
+.. sourcecode:: http
+
+  GET /api/stats/timeseries?resolution=minute&taskname=tasks.add HTTP/1.1
+  Host: localhost:5555
+
+**Example response**:
+
+.. sourcecode:: http
+
+  HTTP/1.1 200 OK
+  Content-Type: application/json; charset=UTF-8
+
+  {
+      "resolution": 60,
+      "timestamps": [1700000000, 1700000060, ...],
+      "tasks": {
+          "tasks.add": {
+              "received": [12, 9, ...],
+              "started": [12, 9, ...],
+              "succeeded": [11, 9, ...],
+              "failed": [1, 0, ...],
+              "runtime": [0.31, 0.22, ...]
+          }
+      },
+      "workers": {
+          "celery@worker1": {
+              "received": [40, 35, ...],
+              ...
+          }
+      }
+  }
+
+:query resolution: `second` or `minute` (default)
+:query taskname: only return the series of this task name
+:query workername: only return the series of this worker
+:reqheader Authorization: optional OAuth token to authenticate
+:statuscode 200: no error
+:statuscode 400: invalid resolution
+:statuscode 401: unauthorized request
+        """
+        resolution = self.get_argument('resolution', 'minute')
+        if resolution not in RESOLUTIONS:
+            raise web.HTTPError(400, f"Invalid resolution '{resolution}'")
+        self.write(self.application.events.state.timeseries.query(
+            resolution,
+            task_name=self.get_argument('taskname', None),
+            worker_name=self.get_argument('workername', None)))
@@ -13,7 +13,7 @@ from tornado.web import HTTPError
 
 from ..utils import tasks
 from ..utils.broker import Broker
-from ..utils.search import QuerySyntaxError
+from ..utils.query import QuerySyntaxError
 from . import BaseApiHandler
 
 logger = logging.getLogger(__name__)
@@ -458,7 +458,7 @@ Return length of all active queues
 class ListTasks(BaseTaskHandler):
     @web.authenticated
     # pylint: disable=too-many-locals
-    def get(self):
+    async def get(self):
         """
 List tasks
 
@@ -537,7 +537,7 @@ List tasks
       }
   }
 
-:query limit: maximum number of tasks
+:query limit: maximum number of tasks, at most ``max_tasks`` by default when a task store is set
 :query offset: skip first n tasks
 :query sort_by: sort tasks by attribute (name, state, received, started)
 :query workername: filter task by workername
@@ -546,9 +546,11 @@ List tasks
 :query received_start: filter tasks by received date (must be greater than) format %Y-%m-%d %H:%M
 :query received_end: filter tasks by received date (must be less than) format %Y-%m-%d %H:%M
 :query search: search task details using the task-filter query syntax
+:query cursor: resume after the last task of the previous page (its X-Next-Cursor header)
 :reqheader Authorization: optional OAuth token to authenticate
+:resheader X-Next-Cursor: cursor of the next page when a limit is given and there are more tasks
 :statuscode 200: no error
-:statuscode 400: invalid search query
+:statuscode 400: invalid search query or cursor
 :statuscode 401: unauthorized request
         """
         app = self.application
@@ -561,6 +563,7 @@ List tasks
         received_end = self.get_argument('received_end', None)
         sort_by = self.get_argument('sort_by', None)
         search = self.get_argument('search', None)
+        cursor = self.get_argument('cursor', None)
 
         limit = limit and int(limit)
         offset = max(offset, 0)
@@ -570,14 +573,16 @@ List tasks
 
         result = []
         try:
-            task_iterator = tasks.iter_tasks(
-                    app.events, limit=limit, offset=offset, sort_by=sort_by, type=type,
+            sort_by, descending = tasks.parse_sort_by(sort_by)
+            page = await tasks.search_tasks(
+                    app.events, limit=limit, offset=offset, sort_by=sort_by,
+                    descending=descending, type=type,
                     worker=worker, state=state,
                     received_start=received_start,
                     received_end=received_end,
-                    search=search
+                    search=search, cursor=cursor
             )
-            for task_id, task in task_iterator:
+            for task_id, task in await tasks.page_tasks(app.events, page):
                 task = tasks.as_dict(task)
                 worker = task.pop('worker', None)
                 if worker is not None:
@@ -587,9 +592,206 @@ List tasks
             self.set_status(400)
             self.write({'error': str(exc)})
             return
+        if page.next_cursor:
+            self.set_header('X-Next-Cursor', page.next_cursor)
         self.write(OrderedDict(result))
 
 
+class StandingQueries(BaseTaskHandler):
+    max_standing_queries = 100
+
+    @web.authenticated
+    def get(self):
+        """
+List standing queries
+
+**Example request**:
+
+.. sourcecode:: http
+
+  GET /api/tasks/standing HTTP/1.1
+  Host: localhost:5555
+
+**Example response**:
+
+.. sourcecode:: http
+
+  HTTP/1.1 200 OK
+  Content-Length: 185
+  Content-Type: application/json; charset=UTF-8
+
+  {
+      "0cd8a2a2-0c5b-4a0d-9e6e-7d7c3e0b8a0e": {
+          "count": 2,
+          "id": "0cd8a2a2-0c5b-4a0d-9e6e-7d7c3e0b8a0e",
+          "query": "state:FAILURE name:billing",
+          "states": {
+              "FAILURE": 2
+          }
+      }
+  }
+
+:reqheader Authorization: optional OAuth token to authenticate
+:statuscode 200: no error
+:statuscode 401: unauthorized request
+        """
+        engine = self.application.events.state.search_engine
+        self.write({
+            query_id: standing_query.as_dict()
+            for query_id, standing_query in engine.standing_queries.items()
+        })
+
+    @web.authenticated
+    def post(self):
+        """
+Register a standing query
+
+The matches of a standing query are kept up to date as task events arrive,
+so its result is available without running the search again.
+
+**Example request**:
+
+.. sourcecode:: http
+
+  POST /api/tasks/standing?query=state:FAILURE+name:billing HTTP/1.1
+  Host: localhost:5555
+  Content-Length: 0
+
+**Example response**:
+
+.. sourcecode:: http
+
+  HTTP/1.1 200 OK
+  Content-Length: 135
+  Content-Type: application/json; charset=UTF-8
+
+  {
+      "count": 2,
+      "id": "0cd8a2a2-0c5b-4a0d-9e6e-7d7c3e0b8a0e",
+      "query": "state:FAILURE name:billing",
+      "states": {
+          "FAILURE": 2
+      }
+  }
+
+:query query: search query using the task-filter query syntax
+:reqheader Authorization: optional OAuth token to authenticate
+:statuscode 200: no error
+:statuscode 400: invalid search query or too many standing queries
+:statuscode 401: unauthorized request
+        """
+        query = self.get_argument('query')
+        engine = self.application.events.state.search_engine
+        if len(engine.standing_queries) >= self.max_standing_queries:
+            raise HTTPError(
+                400, f'Too many standing queries (maximum {self.max_standing_queries})')
+        try:
+            standing_query = engine.add_standing_query(query)
+        except QuerySyntaxError as exc:
+            self.set_status(400)
+            self.write({'error': str(exc)})
+            return
+        self.write(standing_query.as_dict())
+
+
+class StandingQueryResult(BaseTaskHandler):
+    @web.authenticated
+    def get(self, query_id):
+        """
+Get the current result of a standing query
+
+**Example request**:
+
+.. sourcecode:: http
+
+  GET /api/tasks/standing/0cd8a2a2-0c5b-4a0d-9e6e-7d7c3e0b8a0e?limit=1 HTTP/1.1
+  Host: localhost:5555
+
+**Example response**:
+
+.. sourcecode:: http
+
+  HTTP/1.1 200 OK
+  Content-Length: 462
+  Content-Type: application/json; charset=UTF-8
+
+  {
+      "count": 2,
+      "id": "0cd8a2a2-0c5b-4a0d-9e6e-7d7c3e0b8a0e",
+      "query": "state:FAILURE name:billing",
+      "states": {
+          "FAILURE": 2
+      },
+      "tasks": {
+          "e42ceb2d-8730-47b5-8b4d-8e0d2a1ef7c9": {
+              "args": "[3, 4]",
+              "name": "billing.charge",
+              "state": "FAILURE",
+              "timestamp": 1398505411.124802,
+              "uuid": "e42ceb2d-8730-47b5-8b4d-8e0d2a1ef7c9",
+              "worker": "celery@worker1",
+              ...
+          }
+      }
+  }
+
+:query limit: maximum number of tasks, the most recent first
+:reqheader Authorization: optional OAuth token to authenticate
+:statuscode 200: no error
+:statuscode 401: unauthorized request
+:statuscode 404: unknown standing query
+        """
+        limit = self.get_argument('limit', None, type=int)
+        state = self.application.events.state
+        standing_query = state.search_engine.standing_queries.get(query_id)
+        if standing_query is None:
+            raise HTTPError(404, f"Unknown standing query '{query_id}'")
+
+        task_map = getattr(state.tasks, 'data', state.tasks)
+        result = []
+        for task_id in state.search_engine.most_recent(
+                standing_query.task_ids, limit):
+            task = task_map.get(task_id)
+            if task is None:
+                continue
+            task = tasks.as_dict(task)
+            worker = task.pop('worker', None)
+            if worker is not None:
+                task['worker'] = worker.hostname
+            result.append((task_id, task))
+        response = standing_query.as_dict()
+        response['tasks'] = OrderedDict(result)
+        self.write(response)
+
+    @web.authenticated
+    def delete(self, query_id):
+        """
+Remove a standing query
+
+**Example request**:
+
+.. sourcecode:: http
+
+  DELETE /api/tasks/standing/0cd8a2a2-0c5b-4a0d-9e6e-7d7c3e0b8a0e HTTP/1.1
+  Host: localhost:5555
+
+**Example response**:
+
+.. sourcecode:: http
+
+  HTTP/1.1 200 OK
+  Content-Length: 0
+
+:reqheader Authorization: optional OAuth token to authenticate
+:statuscode 200: no error
+:statuscode 401: unauthorized request
+:statuscode 404: unknown standing query
+        """
+        engine = self.application.events.state.search_engine
+        if not engine.remove_standing_query(query_id):
+            raise HTTPError(404, f"Unknown standing query '{query_id}'")
+
+
 class ListTaskTypes(BaseTaskHandler):
     @web.authenticated
     def get(self):
@@ -629,9 +831,60 @@ List (seen) task types
         self.write(response)
 
 
+class TaskStats(BaseTaskHandler):
+    @web.authenticated
+    def get(self):
+        """
+Runtime statistics of tasks by task name
+
+Quantiles are estimated by a streaming sketch within 1% of the exact
+runtimes, from the runtimes of succeeded tasks since Flower started.
+
+**Example request**:
+
+.. sourcecode:: http
+
+  GET /api/task/stats?taskname=tasks.add HTTP/1.1
+  Host: localhost:5555
+
+**Example response**:
+
+.. sourcecode:: http
+
+  HTTP/1.1 200 OK
+  Content-Length: 164
+  Content-Type: application/json; charset=UTF-8
+
+  {
+      "tasks.add": {
+          "count": 1200,
+          "sum": 31.2,
+          "min": 0.0011,
+          "max": 1.73,
+          "p50": 0.0203,
+          "p90": 0.0514,
+          "p95": 0.0872,
+          "p99": 0.4125
+      }
+  }
+
+:query taskname: filter stats by task name
+:reqheader Authorization: optional OAuth token to authenticate
+:statuscode 200: no error
+:statuscode 401: unauthorized request
+        """
+        taskname = self.get_argument('taskname', None)
+        sketches = self.application.events.state.runtime_sketches
+        if taskname is not None:
+            sketches = {name: sketch for name, sketch in sketches.items()
+                        if name == taskname}
+        self.write({name: sketch.stats()
+                    for name, sketch in sorted(sketches.items())})
+
+
 class TaskInfo(BaseTaskHandler):
     @web.authenticated
-    def get(self, taskid):
+    async def get(self, taskid):
         """
 Get a task info
 
@@ -687,7 +940,7 @@ Get a task info
 :statuscode 404: unknown task
         """
 
-        task = tasks.get_task_by_id(self.application.events, taskid)
+        task = await tasks.get_task_by_id(self.application.events, taskid)
         if not task:
             raise HTTPError(404, f"Unknown task '{taskid}'")
 
@@ -16,8 +16,10 @@ from tornado.web import url
 from .urls import handlers as default_handlers
 from .events import Events
 from .inspector import Inspector
+from .metrics import MetricsCache, get_prometheus_metrics
 from .options import default_options
 from .utils.blocking import BlockingOperationRunner
+from .utils.task_store import open_task_store
 
 
 logger = logging.getLogger(__name__)
@@ -57,6 +59,14 @@ class Flower(tornado.web.Application):
         self.executor = self.pool_executor_cls(max_workers=self.max_workers)
         self.io_loop.set_default_executor(self.executor)
         self.blocking_runner = BlockingOperationRunner(self.executor)
+        self.metrics_cache = MetricsCache()
+        get_prometheus_metrics().configure(
+            self.options.metrics_worker_pattern,
+            self.options.metrics_drop_labels,
+            self.options.metrics_max_series)
+        get_prometheus_metrics().expose_runtime_quantiles(
+            self.runtime_sketches if self.options.task_runtime_summary
+            else None)
 
         self.inspector = Inspector(self.io_loop, self.capp, self.options.inspect_timeout / 1000.0)
 
@@ -66,9 +76,23 @@ class Flower(tornado.web.Application):
             persistent=self.options.persistent,
             state_save_interval=self.options.state_save_interval,
             enable_events=self.options.enable_events,
+            batch_size=self.options.events_batch_size,
+            flush_interval=self.options.events_flush_interval,
+            max_queue_size=self.options.max_events_queue,
+            overflow_policy=self.options.events_overflow_policy,
+            sample_rate=self.options.events_sample_rate,
+            use_process=self.options.events_process,
             io_loop=self.io_loop,
             max_workers_in_memory=self.options.max_workers,
-            max_tasks_in_memory=self.options.max_tasks)
+            max_tasks_in_memory=self.options.max_tasks,
+            max_tasks_memory=self.options.max_tasks_memory,
+            task_retention=self.options.task_retention,
+            task_store=(open_task_store(self.options.task_store,
+                                        self.options.task_store_max_age)
+                        if self.options.task_store else None),
+            compact_tasks=self.options.compact_tasks,
+            search_max_field_length=self.options.search_max_field_length,
+            search_exclude_fields=self.options.search_exclude_fields)
         self.started = False
 
     def start_http_server(self):
@@ -129,6 +153,9 @@ class Flower(tornado.web.Application):
     def update_workers(self, workername=None):
         return self.inspector.inspect(workername)
 
+    def runtime_sketches(self):
+        return self.events.state.runtime_sketches
+
     def purge_offline_worker_metrics(self):
         threshold = self.options.purge_offline_workers
         if threshold is None:
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import atexit
 import signal
@@ -15,6 +16,11 @@ from tornado.log import enable_pretty_logging
 from celery.bin.base import CeleryCommand
 
 from .app import Flower
+from .metrics import TASK_LABELS
+from .utils.event_buffer import OVERFLOW_POLICIES
+from .utils.eviction import parse_retention
+from .utils.search import TRUNCATABLE_FIELDS
+from .utils.task_store import check_sqlite, task_store_path
 from .urls import settings
 from .utils import abs_path, prepend_url, strtobool
 from .options import DEFAULT_CONFIG_FILE, default_options
@@ -147,6 +153,61 @@ def extract_settings():
         logger.error("Invalid '--auth' option: %s", options.auth)
         sys.exit(1)
 
+    validate_events_options()
+
+    if not set(options.search_exclude_fields) <= set(TRUNCATABLE_FIELDS):
+        logger.error("Invalid '--search_exclude_fields' option: %s",
+                     ','.join(options.search_exclude_fields))
+        sys.exit(1)
+
+    try:
+        parse_retention(options.task_retention)
+    except ValueError:
+        logger.error("Invalid '--task_retention' option: %s",
+                     ','.join(options.task_retention))
+        sys.exit(1)
+
+    if options.task_store:
+        try:
+            task_store_path(options.task_store)
+        except ValueError:
+            logger.error("Invalid '--task_store' option: %s", options.task_store)
+            sys.exit(1)
+        try:
+            check_sqlite()
+        except ValueError as e:
+            logger.error("Can't use '--task_store': %s", e)
+            sys.exit(1)
+
+    validate_metrics_options()
+
+
+def validate_events_options():
+    if options.events_overflow_policy not in OVERFLOW_POLICIES:
+        logger.error("Invalid '--events_overflow_policy' option: %s",
+                     options.events_overflow_policy)
+        sys.exit(1)
+
+    if options.events_process and options.max_events_queue:
+        logger.error("'--max_events_queue' can't be used with "
+                     "'--events_process'")
+        sys.exit(1)
+
+
+def validate_metrics_options():
+    if options.metrics_worker_pattern:
+        try:
+            re.compile(options.metrics_worker_pattern)
+        except re.error:
+            logger.error("Invalid '--metrics_worker_pattern' option: %s",
+                         options.metrics_worker_pattern)
+            sys.exit(1)
+
+    if not set(options.metrics_drop_labels) <= set(TASK_LABELS):
+        logger.error("Invalid '--metrics_drop_labels' option: %s",
+                     ','.join(options.metrics_drop_labels))
+        sys.exit(1)
+
 
 def is_flower_option(arg):
     name, _, _ = arg.lstrip('-').partition("=")
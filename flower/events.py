@@ -1,167 +1,621 @@
 import collections
+import dbm
+import itertools
 import logging
+import multiprocessing
 import shelve
+import signal
 import threading
 import time
 from collections import Counter
 from functools import partial
 
 from celery.events import EventReceiver
-from celery.events.state import State
+from celery.events.state import State, Worker
 from kombu.exceptions import OperationalError
-from prometheus_client import Counter as PrometheusCounter
-from prometheus_client import Gauge, Histogram
-from tornado.ioloop import PeriodicCallback
-from tornado.options import options
-
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from .metrics import get_prometheus_metrics
+from .utils.event_buffer import EventBuffer
+from .utils.events_publisher import EventsPublisher
+from .utils.compact_tasks import CompactTaskMap, TaskRef
+from .utils.eviction import (LRUEvictionPolicy, RetentionEvictionPolicy,
+                             parse_retention)
+from .utils.records import task_record, worker_record
 from .utils.search import TaskSearchEngine
+from .utils.sizes import document_size, stored_task_size, task_size
+from .utils.sketch import DDSketch
+from .utils.state_log import StateLog
+from .utils.timeseries import TaskTimeSeries
 
 logger = logging.getLogger(__name__)
 
-PROMETHEUS_METRICS = None
-
-
-def get_prometheus_metrics():
-    global PROMETHEUS_METRICS  # pylint: disable=global-statement
-    if PROMETHEUS_METRICS is None:
-        PROMETHEUS_METRICS = PrometheusMetrics()
-
-    return PROMETHEUS_METRICS
-
-
-class PrometheusMetrics:
-    def __init__(self):
-        self.events = PrometheusCounter('flower_events_total', "Number of events", ['worker', 'type', 'task'])
-
-        self.runtime = Histogram(
-            'flower_task_runtime_seconds',
-            "Task runtime",
-            ['worker', 'task'],
-            buckets=options.task_runtime_metric_buckets
-        )
-        self.prefetch_time = Gauge(
-            'flower_task_prefetch_time_seconds',
-            "The time the task spent waiting at the celery worker to be executed.",
-            ['worker', 'task']
-        )
-        self.number_of_prefetched_tasks = Gauge(
-            'flower_worker_prefetched_tasks',
-            'Number of tasks of given type prefetched at a worker',
-            ['worker', 'task']
-        )
-        self.worker_online = Gauge('flower_worker_online', "Worker online status", ['worker'])
-        self.worker_number_of_currently_executing_tasks = Gauge(
-            'flower_worker_number_of_currently_executing_tasks',
-            "Number of tasks currently executing at a worker",
-            ['worker']
-        )
-
-    def remove_workers(self, worker_names):
-        metrics = (
-            self.events,
-            self.runtime,
-            self.prefetch_time,
-            self.number_of_prefetched_tasks,
-            self.worker_online,
-            self.worker_number_of_currently_executing_tasks,
-        )
-        removed_workers = set()
-        for metric in metrics:
-            labels_to_remove = [
-                labels for labels in metric._metrics  # pylint: disable=protected-access
-                if labels and labels[0] in worker_names
-            ]
-            for labels in labels_to_remove:
-                removed_workers.add(labels[0])
-                metric.remove(*labels)
-        return len(removed_workers)
-
-
 class EventsState(State):
     # EventsState object is created and accessed only from ioloop thread
 
-    def __init__(self, *args, **kwargs):
+    # pylint: disable=too-many-arguments
+    def __init__(self, *args, compact_tasks=False, search_max_field_length=0,
+                 search_exclude_fields=(), max_tasks_memory=0,
+                 task_retention=(), eviction_policy=None, task_store=None,
+                 **kwargs):
         super().__init__(*args, **kwargs)
+        self.compact_tasks = compact_tasks
+        # Budget in bytes for tasks and their search documents, 0 for none
+        self.max_tasks_memory = max_tasks_memory
+        if eviction_policy is None:
+            eviction_policy = (
+                RetentionEvictionPolicy(parse_retention(task_retention))
+                if task_retention else LRUEvictionPolicy())
+        self.eviction_policy = eviction_policy
+        # Tasks are written to the task store when there is one, and kept
+        # there after they are removed from memory
+        self.task_store = task_store
+        self.task_sizes = {}
+        self.tasks_memory = 0
+        if compact_tasks:
+            data = CompactTaskMap(self)
+            data.update(self.tasks.data)
+            self.tasks.data = data
+            # The event dispatcher holds on to the bound methods of the data
+            self._event = self._create_dispatcher()
         self.counter = collections.defaultdict(Counter)
         self.metrics = get_prometheus_metrics()
-        self.search_engine = TaskSearchEngine()
+        # Runtime quantile sketches by task name
+        self.runtime_sketches = {}
+        self.timeseries = TaskTimeSeries()
+        self.search_engine = TaskSearchEngine(search_max_field_length,
+                                              search_exclude_fields)
         self._rebuild_search_index()
+        # Changes since the last save, tracked in persistent mode
+        self.track_changes = False
+        # Insertion ordered, to restore new tasks in LRU order
+        self.changed_tasks = {}
+        self.removed_tasks = set()
+        self.changed_workers = set()
+        self.restored_meta = None
+        self.restored_counter = None
+        # Restored tasks whose search documents were loaded from the index
+        self.indexed_task_ids = set()
 
     def _rebuild_search_index(self):
         self.search_engine.rebuild(self.tasks.items())
+        self.task_sizes.clear()
+        self.tasks_memory = 0
+        self.eviction_policy.clear()
+        for task_id, task in self.tasks.data.items():
+            self._task_updated(task_id, task)
+
+    def _index_task(self, task_id, task):
+        self.search_engine.upsert(task)
+        self._task_updated(task_id, task)
+
+    def _task_updated(self, task_id, task):
+        size = self._task_size(task_id, task) + document_size(
+            self.search_engine.documents.get(task_id))
+        self.tasks_memory += size - self.task_sizes.get(task_id, 0)
+        self.task_sizes[task_id] = size
+        self.eviction_policy.touch(task_id, task)
+        if self.task_store is not None:
+            self.task_store.touch(task_id)
+
+    def _forget_task(self, task_id):
+        "drops the search document and bookkeeping of a removed task"
+        self.search_engine.remove(task_id)
+        self.tasks_memory -= self.task_sizes.pop(task_id, 0)
+        self.eviction_policy.forget(task_id)
+
+    def flush_task_store(self, task_ids=None):
+        """Queues the tasks changed since they were last written, or those
+        among task_ids, to be written to the task store."""
+        records = []
+        for task_id in self.task_store.take_unflushed(task_ids):
+            task = self.tasks.data.get(task_id)
+            if task is not None:
+                records.append(task_record(task)[1])
+        self.task_store.put_many(records)
+
+    def _remove_task(self, task_id, reason):
+        if self.task_store is not None:
+            self.flush_task_store([task_id])
+        self.tasks.data.pop(task_id, None)
+        self._forget_task(task_id)
+        if self.track_changes:
+            self._track_removed_task(task_id)
+        self.metrics.tasks_evicted.labels(reason).inc()
+
+    def expire_tasks(self, now=None):
+        "removes tasks whose retention period elapsed"
+        now = time.time() if now is None else now
+        for task_id in self.eviction_policy.expired(now):
+            if task_id in self.tasks.data:
+                self._remove_task(task_id, 'expired')
+
+    def evict_tasks(self):
+        """Removes least recently updated finished tasks until the tasks fit
+        in the memory budget. Unfinished tasks are kept."""
+        if not self.max_tasks_memory or \
+                self.tasks_memory <= self.max_tasks_memory:
+            self.metrics.tasks_memory.set(self.tasks_memory)
+            return
+        memory = self.tasks_memory
+        evicted = []
+        for task_id in self.eviction_policy.victims(self):
+            if memory <= self.max_tasks_memory:
+                break
+            evicted.append(task_id)
+            memory -= self.task_sizes.get(task_id, 0)
+        for task_id in evicted:
+            self._remove_task(task_id, 'memory')
+        self.metrics.tasks_memory.set(self.tasks_memory)
 
     def _clear_tasks(self, ready=True):
+        task_ids = set(self.tasks)
         super()._clear_tasks(ready)
-        self._rebuild_search_index()
+        for task_id in task_ids:
+            if task_id not in self.tasks:
+                self._forget_task(task_id)
+                if self.track_changes:
+                    self._track_removed_task(task_id)
+
+    def _track_removed_task(self, task_id):
+        self.changed_tasks.pop(task_id, None)
+        self.removed_tasks.add(task_id)
+
+    def clear_changes(self):
+        self.changed_tasks.clear()
+        self.removed_tasks.clear()
+        self.changed_workers.clear()
+
+    def meta_records(self):
+        yield 'meta', {'event_count': self.event_count,
+                       'task_count': self.task_count}
+        yield 'counter', {
+            worker: dict(counter) for worker, counter in self.counter.items()
+        }
+
+    def snapshot_records(self):
+        "yields records describing the whole state"
+        yield from self.meta_records()
+        yield 'search-index', self.search_engine.dump()
+        for records in self.snapshot_chunks(len(self.tasks.data) or 1):
+            yield from records
+
+    def snapshot_chunks(self, size):
+        """Yields the worker and task records of the state in lists of up to
+        size records.
+
+        Each list is taken when it is requested, so the state may change in
+        between. Tasks added meanwhile are left out, tasks removed meanwhile
+        are skipped.
+        """
+        yield [worker_record(worker)
+               for worker in list(self.workers.data.values())]
+        # Oldest first, to restore the LRU order
+        task_ids = list(self.tasks.data)
+        task_map = self.tasks.data
+        for start in range(0, len(task_ids), size):
+            yield [task_record(task_map[task_id])
+                   for task_id in task_ids[start:start + size]
+                   if task_id in task_map]
+
+    def pop_change_records(self, counters=True):
+        """returns records describing the changes since the last call,
+        preceded by the counters unless ``counters`` is False"""
+        records = list(self.meta_records()) if counters else []
+        for hostname in self.changed_workers:
+            worker = self.workers.data.get(hostname)
+            if worker is None:
+                records.append(('remove-worker', hostname))
+            else:
+                records.append(worker_record(worker))
+        for task_id in self.removed_tasks:
+            records.append(('remove-task', task_id))
+        task_map = self.tasks.data
+        for task_id in self.changed_tasks:
+            task = task_map.get(task_id)
+            if task is None:
+                records.append(('remove-task', task_id))
+            else:
+                records.append(task_record(task))
+        self.clear_changes()
+        return records
+
+    def restore(self, records):
+        self.restore_records(records)
+        self.finish_restore()
 
     # pylint: disable=too-many-branches
+    def restore_records(self, records):
+        "applies persisted records, keeping newer changes made by events"
+        for kind, value in records:
+            if kind == 'meta':
+                self.restored_meta = value
+            elif kind == 'counter':
+                self.restored_counter = value
+            elif kind == 'search-index':
+                self._restore_search_engine(self.load_search_engine(value))
+            elif kind == 'search-engine':
+                self._restore_search_engine(value)
+            elif kind == 'worker':
+                if value['hostname'] not in self.changed_workers:
+                    self._restore_worker(dict(value))
+            elif kind == 'remove-worker':
+                if value not in self.changed_workers:
+                    self.workers.data.pop(value, None)
+            elif kind == 'task':
+                if value['uuid'] in self.changed_tasks:
+                    self._merge_task(value)
+                else:
+                    self._restore_task(dict(value))
+            elif kind == 'remove-task':
+                if value not in self.changed_tasks:
+                    self.tasks.data.pop(value, None)
+                    self._forget_task(value)
+
+    def finish_restore(self):
+        # Counters of events received while restoring are added up
+        if self.restored_meta:
+            self.event_count += self.restored_meta['event_count']
+            self.task_count += self.restored_meta['task_count']
+        for worker, counter in (self.restored_counter or {}).items():
+            self.counter[worker].update(counter)
+        self.restored_meta = self.restored_counter = None
+        for task_id in self.indexed_task_ids:
+            # Documents of tasks missing from the snapshot
+            if task_id not in self.tasks:
+                self._forget_task(task_id)
+        self.indexed_task_ids = set()
+        self.evict_tasks()
+        self.rebuild_taskheap()
+
+    def load_records(self, records):
+        """Yields the records with the search index loaded into a new engine,
+        as a 'search-engine' record.
+
+        The state isn't changed, so the records can be read in another
+        thread and restored on the ioloop.
+        """
+        for kind, value in records:
+            if kind == 'search-index':
+                kind, value = 'search-engine', self.load_search_engine(value)
+            yield kind, value
+
+    def load_search_engine(self, dump):
+        "returns a new search engine with the dumped index, or None if invalid"
+        engine = TaskSearchEngine(self.search_engine.max_field_length,
+                                  self.search_engine.excluded_fields)
+        if engine.load(dump) is None:
+            return None
+        return engine
+
+    def _restore_search_engine(self, engine):
+        if engine is None:
+            logger.warning("Persisted search index is invalid, "
+                           "it will be rebuilt")
+            self.indexed_task_ids = set()
+            return
+        # Tasks indexed since loading began are indexed again, the loaded
+        # documents of the other tasks are checked against their records
+        indexed = self.search_engine.documents
+        for task_id in indexed:
+            task = self.tasks.data.get(task_id)
+            if task is not None:
+                engine.upsert(task)
+        engine.take_standing_queries(self.search_engine)
+        self.indexed_task_ids = set(engine.documents).difference(indexed)
+        self.search_engine = engine
+
+    def _restore_worker(self, fields):
+        heartbeats = fields.pop('heartbeats')
+        worker, _ = self.get_or_create_worker(fields.pop('hostname'), **fields)
+        # The worker's event handler holds on to the heartbeats list
+        worker.heartbeats[:] = heartbeats
+
+    def _restore_task(self, fields):
+        task_id = fields['uuid']
+        hostname = fields.pop('worker')
+        children = None
+        if self.compact_tasks:
+            # Stored children are released, keep their IDs instead
+            children = set(map(TaskRef, fields.pop('children', ())))
+        task = self.Task(cluster_state=self, **fields)
+        if children is not None:
+            task.children = children
+        if hostname is not None:
+            task.worker, _ = self.get_or_create_worker(hostname)
+        if task_id in self.tasks.data:
+            # Keep the LRU position of the replaced task
+            self.tasks.data[task_id] = task
+        else:
+            lru_task_id = self._lru_task_id(task_id)
+            self.tasks[task_id] = task
+            if lru_task_id is not None and lru_task_id not in self.tasks:
+                self._forget_task(lru_task_id)
+                self.indexed_task_ids.discard(lru_task_id)
+        if task_id in self.indexed_task_ids:
+            # The snapshot record matches the loaded document, newer records
+            # of the task are indexed again
+            self.indexed_task_ids.discard(task_id)
+        else:
+            self.search_engine.upsert(task)
+        self._task_updated(task_id, task)
+        if task.name is not None:
+            self._seen_types.add(task.name)
+            self.tasks_by_type[task.name].add(task)
+            if hostname is not None:
+                self.tasks_by_worker[hostname].add(task)
+
+    async def stored_task(self, task_id):
+        "returns a task of the task store, or None"
+        return (await self.stored_tasks([task_id])).get(task_id)
+
+    async def stored_tasks(self, task_ids):
+        "returns the tasks of the task store among task_ids by ID"
+        store = self.task_store
+        if store is None or not task_ids:
+            return {}
+        records = await store.read(store.get_many, task_ids)
+        return {task_id: self._stored_task(fields)
+                for task_id, fields in records.items()}
+
+    def _stored_task(self, fields):
+        fields = dict(fields)
+        hostname = fields.pop('worker', None)
+        children = fields.pop('children', ())
+        # Created without cluster_state, which would look up the children
+        task = self.Task(**fields)
+        task.cluster_state = self
+        task.children = set(map(TaskRef, children))
+        if hostname is not None:
+            task.worker = (self.workers.data.get(hostname) or
+                           Worker(hostname=hostname))
+        return task
+
+    def _task_size(self, task_id, task):
+        if self.compact_tasks:
+            # Tasks stored in the columns don't hold on to the Task object
+            row = self.tasks.data.rows.get(task_id)
+            if row is not None:
+                return stored_task_size(self.tasks.data, row)
+        return task_size(task)
+
+    def _merge_task(self, fields):
+        # Fill in the fields missing from a task updated by newer events
+        task_id = fields['uuid']
+        if task_id not in self.tasks.data:
+            return
+        self._thaw_task(task_id)
+        task = self.tasks.data[task_id]
+        for field, value in fields.items():
+            if field not in ('worker', 'children') and \
+                    getattr(task, field, None) is None:
+                setattr(task, field, value)
+        self._settle_task(task_id)
+        if task.name is not None:
+            self._seen_types.add(task.name)
+        self._index_task(task_id, task)
+
+    def _thaw_task(self, task_id):
+        if self.compact_tasks:
+            self.tasks.data.thaw(task_id)
+
+    def _settle_task(self, task_id):
+        if self.compact_tasks:
+            self.tasks.data.settle(task_id)
+
+    def _lru_task_id(self, task_id):
+        # Celery may discard the least recently used task while adding this
+        # task. The eviction policy may pick another task to remove instead,
+        # otherwise remember its ID so its search entry can be removed
+        limit = getattr(self.tasks, 'limit', None)
+        if task_id in self.tasks or not limit or len(self.tasks) < limit:
+            return None
+        victim = self.eviction_policy.make_room(self)
+        if victim is None and self.task_store is not None:
+            # Removed here, to write its last changes to the task store
+            victim = next(iter(self.tasks), None)
+        if victim is not None:
+            self._remove_task(victim, 'limit')
+            return None
+        return next(iter(self.tasks), None)
+
+    def _discard_lru_task(self, lru_task_id):
+        if lru_task_id is not None and lru_task_id not in self.tasks:
+            self._forget_task(lru_task_id)
+            if self.track_changes:
+                self._track_removed_task(lru_task_id)
+            self.metrics.tasks_evicted.labels('limit').inc()
+
+    def _update_task_metrics(self, event, worker_name, task_name, task):
+        event_type = event['type']
+        self.timeseries.add(event, worker_name, task_name)
+        self.metrics.bind_task(worker_name, task_name, event_type)[self.metrics.events].inc()
+        metrics, bound = self.metrics, self.metrics.bind_task(worker_name, task_name)
+
+        runtime = event.get('runtime', 0)
+        if runtime:
+            bound[metrics.runtime].observe(runtime)
+            if task_name:
+                sketch = self.runtime_sketches.get(task_name)
+                if sketch is None:
+                    sketch = self.runtime_sketches[task_name] = DDSketch()
+                sketch.add(runtime)
+
+        if task is None:
+            return
+        task_started = task.started
+        task_received = task.received
+
+        if event_type == 'task-received' and not task.eta and task_received:
+            bound[metrics.number_of_prefetched_tasks].inc()
+
+        if event_type == 'task-started' and not task.eta and task_started and task_received:
+            bound[metrics.prefetch_time].set(task_started - task_received)
+            bound[metrics.number_of_prefetched_tasks].dec()
+
+        if event_type in ['task-succeeded', 'task-failed'] and not task.eta and task_started and task_received:
+            bound[metrics.prefetch_time].set(0)
+
     def event(self, event):
         event_type = event['type']
         lru_task_id = None
         if event_type.startswith('task-'):
-            task_id = event.get('uuid')
-            limit = getattr(self.tasks, 'limit', None)
-            # Celery may discard the least recently used task while applying
-            # this event. Remember its ID so its search entry can be removed
-            if task_id not in self.tasks and limit and len(self.tasks) >= limit:
-                lru_task_id = next(iter(self.tasks), None)
+            lru_task_id = self._lru_task_id(event.get('uuid'))
+            self._thaw_task(event.get('uuid'))
 
         # Save the event
         super().event(event)
+        if event_type.startswith('task-'):
+            self._settle_task(event.get('uuid'))
 
-        worker_name = event['hostname']
-
-        self.counter[worker_name][event_type] += 1
+        if self.track_changes:
+            self.changed_workers.add(event['hostname'])
 
+        task = None
         if event_type.startswith('task-'):
             task_id = event['uuid']
             task = self.tasks.get(task_id)
-            if lru_task_id is not None and lru_task_id not in self.tasks:
-                self.search_engine.remove(lru_task_id)
+            self._discard_lru_task(lru_task_id)
+            if self.track_changes:
+                self.changed_tasks[task_id] = None
             if task is not None:
-                self.search_engine.upsert(task)
-            task_name = event.get('name', '')
-            if not task_name and task_id in self.tasks:
-                task_name = task.name or ''
-            self.metrics.events.labels(worker_name, event_type, task_name).inc()
-
-            runtime = event.get('runtime', 0)
-            if runtime:
-                self.metrics.runtime.labels(worker_name, task_name).observe(runtime)
+                self._index_task(task_id, task)
+                self.evict_tasks()
 
-            task_started = task.started
-            task_received = task.received
+        self._count_event(event, task)
+        self.expire_tasks()
 
-            if event_type == 'task-received' and not task.eta and task_received:
-                self.metrics.number_of_prefetched_tasks.labels(worker_name, task_name).inc()
+    def _count_event(self, event, task):
+        "updates the counters and metrics of an event of the task"
+        event_type = event['type']
+        worker_name = event['hostname']
 
-            if event_type == 'task-started' and not task.eta and task_started and task_received:
-                self.metrics.prefetch_time.labels(worker_name, task_name).set(task_started - task_received)
-                self.metrics.number_of_prefetched_tasks.labels(worker_name, task_name).dec()
+        self.counter[worker_name][event_type] += 1
 
-            if event_type in ['task-succeeded', 'task-failed'] and not task.eta and task_started and task_received:
-                self.metrics.prefetch_time.labels(worker_name, task_name).set(0)
+        if event_type.startswith('task-'):
+            task_name = event.get('name', '')
+            if not task_name and task is not None:
+                task_name = task.name or ''
+            self._update_task_metrics(event, worker_name, task_name, task)
 
         if event_type == 'worker-online':
-            self.metrics.worker_online.labels(worker_name).set(1)
+            self.metrics.bind(worker_name)[self.metrics.worker_online].set(1)
 
         if event_type == 'worker-heartbeat':
-            self.metrics.worker_online.labels(worker_name).set(1)
+            bound = self.metrics.bind(worker_name)
+            bound[self.metrics.worker_online].set(1)
 
             num_executing_tasks = event.get('active')
             if num_executing_tasks is not None:
-                self.metrics.worker_number_of_currently_executing_tasks.labels(worker_name).set(num_executing_tasks)
+                bound[self.metrics.worker_number_of_currently_executing_tasks].set(num_executing_tasks)
 
         if event_type == 'worker-offline':
-            self.metrics.worker_online.labels(worker_name).set(0)
+            self.metrics.bind(worker_name)[self.metrics.worker_online].set(0)
+
+    def apply_changes(self, records, events):
+        """Applies the task and worker snapshot records sent by the events
+        process, then counts the summarized events that changed them."""
+        for kind, value in records:
+            if kind == 'worker':
+                self._restore_worker(dict(value))
+                if self.track_changes:
+                    self.changed_workers.add(value['hostname'])
+            elif kind == 'task':
+                self._apply_task(dict(value))
+        task_map = self.tasks.data
+        for event in events:
+            self.event_count += 1
+            task = None
+            if event['type'].startswith('task-'):
+                if event['type'] == 'task-received':
+                    self.task_count += 1
+                task = task_map.get(event['uuid'])
+            self._count_event(event, task)
+        self.expire_tasks()
+
+    def _apply_task(self, fields):
+        # Fields missing from the snapshot are kept, the events process may
+        # have been started after the task was received
+        task_id = fields['uuid']
+        hostname = fields.pop('worker')
+        del fields['children']
+        lru_task_id = self._lru_task_id(task_id)
+        self._thaw_task(task_id)
+        task = self.tasks.data.get(task_id)
+        if task is None:
+            task = self.tasks[task_id] = self.Task(task_id, cluster_state=self)
+        task.__dict__.update(fields)
+        if hostname is not None:
+            task.worker, _ = self.get_or_create_worker(hostname)
+        # Children are linked like celery does when applying events
+        if task.parent_id:
+            parent = self.tasks.data.get(task.parent_id)
+            if parent is None:
+                self._add_pending_task_child(task)
+            else:
+                parent.children.add(task)
+        task.children.update(self._tasks_to_resolve.pop(task_id, ()))
+        self._settle_task(task_id)
+        self._discard_lru_task(lru_task_id)
+        if task.name is not None:
+            self._seen_types.add(task.name)
+            self.tasks_by_type[task.name].add(task)
+            if hostname is not None:
+                self.tasks_by_worker[hostname].add(task)
+        if self.track_changes:
+            self.changed_tasks[task_id] = None
+        self._index_task(task_id, task)
+        self.evict_tasks()
+
+
+def capture_events(capp, handler):
+    try_interval = 1
+    while True:
+        try:
+            try_interval *= 2
+
+            with capp.connection() as conn:
+                recv = EventReceiver(conn,
+                                     handlers={"*": handler},
+                                     app=capp)
+                try_interval = 1
+                logger.debug("Capturing events...")
+                recv.capture(limit=None, timeout=None, wakeup=True)
+        except (KeyboardInterrupt, SystemExit):
+            try:
+                import _thread as thread
+            except ImportError:
+                import thread
+            thread.interrupt_main()
+        except Exception as e:
+            logger.error("Failed to capture events: '%s', "
+                         "trying again in %s seconds.",
+                         e, try_interval)
+            logger.debug(e, exc_info=True)
+            time.sleep(try_interval)
+
+
+def run_events_process(capp, conn, batch_size, flush_interval, **kwargs):
+    # The web process handles interrupts and stops this process on exit
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    publisher = EventsPublisher(conn, batch_size, flush_interval, **kwargs)
+    threading.Thread(target=publisher.run_flusher, daemon=True).start()
+    capture_events(capp, publisher.on_event)
 
 
 class Events(threading.Thread):
     events_enable_interval = 5000
+    task_store_flush_interval = 1000
+    restore_chunk_size = 1000
+    snapshot_chunk_size = 1000
+    process_batch_size = 100
+    process_restart_delay = 1
 
     # pylint: disable=too-many-arguments
     def __init__(self, capp, io_loop, db=None, persistent=False,
                  enable_events=True, state_save_interval=0,
+                 batch_size=0, flush_interval=100, max_queue_size=0,
+                 overflow_policy='block', sample_rate=10, use_process=False,
                  **kwargs):
         threading.Thread.__init__(self)
         self.daemon = True
@@ -173,36 +627,78 @@ class Events(threading.Thread):
         self.persistent = persistent
         self.enable_events = enable_events
         self.state = None
+        self.state_log = None
+        self.state_log_lock = threading.Lock()
+        self.compacting = False
+        self.loading = False
         self.state_save_timer = None
 
         if self.persistent:
-            logger.debug("Loading state from '%s'...", self.db)
-            state = shelve.open(self.db)
-            if state:
-                self.state = state['events']
-                self.state.counter.update(state.get('counter', {}))
-            state.close()
+            self.state_log = StateLog(self.db)
+            # The state log is loaded in the background by load_state
+            if not self.state_log.exists() and dbm.whichdb(self.db):
+                # Database written by an earlier version of Flower
+                logger.debug("Loading state from '%s'...", self.db)
+                state = shelve.open(self.db)
+                if state:
+                    self.state = state['events']
+                    self.state.counter.update(state.get('counter', {}))
+                state.close()
 
             if state_save_interval:
-                self.state_save_timer = PeriodicCallback(self.save_state,
-                                                         state_save_interval)
+                self.state_save_timer = PeriodicCallback(
+                    self.save_state_in_background, state_save_interval)
 
         if not self.state:
             self.state = EventsState(**kwargs)
+        if self.persistent:
+            self.state.track_changes = True
 
         self.timer = PeriodicCallback(self.on_enable_events,
                                       self.events_enable_interval)
+        self.task_store_timer = None
+        if self.state.task_store:
+            self.task_store_timer = PeriodicCallback(
+                self.state.flush_task_store, self.task_store_flush_interval)
+
+        self.buffer = None
+        self.flush_timer = None
+        self.use_process = use_process
+        self.process = None
+        self.process_conn = None
+        self.process_restart = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Events are batched by the events process in process mode
+        if (batch_size or max_queue_size) and not use_process:
+            self.buffer = EventBuffer(batch_size or 1, max_queue_size,
+                                      overflow_policy, sample_rate)
+            self.flush_timer = PeriodicCallback(self.flush_events,
+                                                flush_interval)
 
     def start(self):
-        threading.Thread.start(self)
+        if self.task_store_timer:
+            self.state.task_store.start()
+            self.task_store_timer.start()
+        if self.use_process:
+            self.start_process()
+        else:
+            threading.Thread.start(self)
         if self.enable_events:
             logger.debug("Starting enable events timer...")
             self.timer.start()
 
+        if self.persistent:
+            self.io_loop.add_callback(self.load_state)
+
         if self.state_save_timer:
             logger.debug("Starting state save timer...")
             self.state_save_timer.start()
 
+        if self.flush_timer:
+            logger.debug("Starting event flush timer...")
+            self.flush_timer.start()
+
     def stop(self):
         if self.enable_events:
             logger.debug("Stopping enable events timer...")
@@ -212,41 +708,188 @@ class Events(threading.Thread):
             logger.debug("Stopping state save timer...")
             self.state_save_timer.stop()
 
+        if self.flush_timer:
+            logger.debug("Stopping event flush timer...")
+            self.flush_timer.stop()
+            while self.buffer:
+                self.flush_events()
+
+        if self.process_restart:
+            self.io_loop.remove_timeout(self.process_restart)
+            self.process_restart = None
+
+        if self.process:
+            logger.debug("Stopping events process...")
+            self.stop_process()
+
         if self.persistent:
             self.save_state()
+            self.state_log.close()
+
+        if self.task_store_timer:
+            self.task_store_timer.stop()
+            self.state.flush_task_store()
+            self.state.task_store.close()
 
     def run(self):
-        try_interval = 1
-        while True:
-            try:
-                try_interval *= 2
-
-                with self.capp.connection() as conn:
-                    recv = EventReceiver(conn,
-                                         handlers={"*": self.on_event},
-                                         app=self.capp)
-                    try_interval = 1
-                    logger.debug("Capturing events...")
-                    recv.capture(limit=None, timeout=None, wakeup=True)
-            except (KeyboardInterrupt, SystemExit):
-                try:
-                    import _thread as thread
-                except ImportError:
-                    import thread
-                thread.interrupt_main()
-            except Exception as e:
-                logger.error("Failed to capture events: '%s', "
-                             "trying again in %s seconds.",
-                             e, try_interval)
-                logger.debug(e, exc_info=True)
-                time.sleep(try_interval)
+        capture_events(self.capp, self.on_event)
+
+    def start_process(self):
+        self.process_restart = None
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+            target=run_events_process,
+            args=(self.capp, sender,
+                  self.batch_size or self.process_batch_size,
+                  self.flush_interval),
+            kwargs={
+                'max_tasks_in_memory': self.state.max_tasks_in_memory,
+                'max_workers_in_memory': self.state.max_workers_in_memory,
+            },
+            name='flower-events', daemon=True)
+        logger.debug("Starting events process...")
+        self.process.start()
+        sender.close()
+        self.process_conn = receiver
+        self.io_loop.add_handler(receiver.fileno(), self.on_process_events,
+                                 IOLoop.READ)
+
+    def stop_process(self):
+        self.io_loop.remove_handler(self.process_conn.fileno())
+        self.process_conn.close()
+        self.process.terminate()
+        self.process.join()
+        self.process = None
+        self.process_conn = None
+
+    def on_process_events(self, fd, events):  # pylint: disable=unused-argument
+        try:
+            records, summaries = self.process_conn.recv()
+        except (EOFError, OSError):
+            logger.error("Events process exited with code %s, "
+                         "restarting in %s seconds.",
+                         self.process.exitcode, self.process_restart_delay)
+            self.stop_process()
+            self.process_restart = self.io_loop.call_later(
+                self.process_restart_delay, self.start_process)
+            return
+        try:
+            self.state.apply_changes(records, summaries)
+        except Exception:
+            logger.exception("Failed to apply changes of the events process")
+
+    async def load_state(self):
+        if not self.state_log.exists():
+            return
+        logger.info("Loading state from '%s'...", self.db)
+        started = time.monotonic()
+        state = self.state
+        records = state.load_records(self.state_log.read())
+        self.loading = True
+        try:
+            while True:
+                # Read in a thread and apply in chunks, so that the server
+                # keeps handling requests and events while loading
+                chunk = await self.io_loop.run_in_executor(
+                    None, list, itertools.islice(records, self.restore_chunk_size))
+                if not chunk:
+                    break
+                state.restore_records(chunk)
+        except Exception as e:
+            logger.error("Failed to load state from '%s': %s", self.db, e)
+            logger.debug(e, exc_info=True)
+        finally:
+            state.finish_restore()
+            self.loading = False
+        logger.info("Loaded %d tasks in %.3fs", len(state.tasks),
+                    time.monotonic() - started)
 
     def save_state(self):
         logger.debug("Saving state to '%s'...", self.db)
-        state = shelve.open(self.db, flag='n')
-        state['events'] = self.state
-        state['counter'] = dict(self.state.counter)
-        state.close()
+        state = self.state
+        with self.state_log_lock:
+            if self.loading:
+                # Counters don't include the persisted ones until loaded
+                self.state_log.append(state.pop_change_records(counters=False))
+            elif self.compacting:
+                # A snapshot is being written
+                self.state_log.append(state.pop_change_records())
+            elif not state.track_changes or self.state_log.should_compact():
+                # Changes of a replaced state object were not tracked
+                state.track_changes = True
+                state.clear_changes()
+                self.state_log.compact(state.snapshot_records())
+            else:
+                self.state_log.append(state.pop_change_records())
+
+    async def save_state_in_background(self):
+        state = self.state
+        if self.compacting or self.loading:
+            # Changes made while loading are tracked to take precedence over
+            # the persisted records, they are saved once the state is loaded
+            return
+        if not state.track_changes or self.state_log.should_compact():
+            await self.compact_state()
+            return
+
+        logger.debug("Saving state to '%s'...", self.db)
+        started = time.monotonic()
+        records = state.pop_change_records()
+        await self.io_loop.run_in_executor(
+            None, self._append_state_records, records)
+        get_prometheus_metrics().state_save_duration.labels('append').set(
+            time.monotonic() - started)
+
+    def _append_state_records(self, records):
+        with self.state_log_lock:
+            self.state_log.append(records)
+
+    async def compact_state(self):
+        logger.debug("Writing state snapshot to '%s'...", self.db)
+        started = time.monotonic()
+        state = self.state
+        state.track_changes = True
+        state.clear_changes()
+        with self.state_log_lock:
+            segment = self.state_log.rotate()
+        self.compacting = True
+        try:
+            size = await self._write_snapshot(state, segment)
+        except Exception as e:
+            logger.error("Failed to write state snapshot: %s", e)
+            return
+        finally:
+            self.compacting = False
+
+        with self.state_log_lock:
+            self.state_log.finish_compaction(segment, size)
+        metrics = get_prometheus_metrics()
+        metrics.state_save_duration.labels('snapshot').set(
+            time.monotonic() - started)
+        metrics.state_snapshot_size.set(size)
+
+    async def _write_snapshot(self, state, segment):
+        # Records are taken from the state a chunk at a time on the ioloop,
+        # and serialized and written in the executor. Tasks changed while
+        # the snapshot is written are also saved to the new segment, which
+        # is replayed after the snapshot.
+        run = partial(self.io_loop.run_in_executor, None)
+        snapshot = await run(self.state_log.open_snapshot, segment)
+        try:
+            # The search index is copied here and serialized in the executor
+            await run(self._write_snapshot_head, snapshot,
+                      list(state.meta_records()), state.search_engine,
+                      state.search_engine.copy_index())
+            for records in state.snapshot_chunks(self.snapshot_chunk_size):
+                await run(snapshot.write, records)
+        except BaseException:
+            snapshot.abort()
+            raise
+        return await run(snapshot.close)
+
+    @staticmethod
+    def _write_snapshot_head(snapshot, records, search_engine, index):
+        snapshot.write([*records, ('search-index', search_engine.dump(index))])
 
     async def on_enable_events(self):
         # Periodically enable events for workers
@@ -258,5 +901,24 @@ class Events(threading.Thread):
             logger.warning("Failed to enable events: %s", exc)
 
     def on_event(self, event):
-        # Call EventsState.event in ioloop thread to avoid synchronization
-        self.io_loop.add_callback(partial(self.state.event, event))
+        if self.buffer is None:
+            # Call EventsState.event in ioloop thread to avoid synchronization
+            self.io_loop.add_callback(partial(self.state.event, event))
+        elif self.buffer.put(event):
+            self.io_loop.add_callback(self.flush_events)
+
+    def flush_events(self):
+        # Process buffered events in ioloop thread, one batch per callback
+        batch, pending = self.buffer.drain()
+        self.process_events(batch)
+        get_prometheus_metrics().events_queue_depth.set(len(self.buffer))
+        if pending:
+            self.io_loop.add_callback(self.flush_events)
+
+    def process_events(self, batch):
+        state_event = self.state.event
+        for event in batch:
+            try:
+                state_event(event)
+            except Exception:
+                logger.exception("Failed to process event: %s", event)
@@ -0,0 +1,330 @@
+import gzip
+import logging
+import re
+import time
+from functools import partial
+
+from prometheus_client import REGISTRY
+from prometheus_client import Counter as PrometheusCounter
+from prometheus_client import Gauge, Histogram, generate_latest
+from prometheus_client.core import Metric
+from tornado.ioloop import IOLoop
+from tornado.options import options
+
+from .utils.sketch import QUANTILES
+
+logger = logging.getLogger(__name__)
+
+# Labels of task metrics that can be dropped
+TASK_LABELS = ('worker', 'task')
+# Label value of the series of tasks beyond the series limit
+OVERFLOW_LABEL = 'overflow'
+
+PROMETHEUS_METRICS = None
+
+
+def get_prometheus_metrics():
+    global PROMETHEUS_METRICS  # pylint: disable=global-statement
+    if PROMETHEUS_METRICS is None:
+        PROMETHEUS_METRICS = PrometheusMetrics()
+
+    return PROMETHEUS_METRICS
+
+
+class BoundMetrics:
+    """Children of labeled metrics bound to the same label values.
+
+    Binding labels hashes the values and takes the lock of the metric every
+    time, bound children are looked up in a dict instead. Children are bound
+    the first time they are used, so series appear when they are first
+    updated, as with ``labels``.
+    """
+
+    __slots__ = ('labels', 'children')
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.children = {}
+
+    def __getitem__(self, metric):
+        child = self.children.get(metric)
+        if child is None:
+            child = self.children[metric] = metric.labels(*self.labels)
+        return child
+
+
+class PrometheusMetrics:
+    def __init__(self):
+        # Bound metrics by label values starting with the worker name
+        self.bound = {}
+        self.worker_pattern = None
+        self.drop_labels = frozenset()
+        self.max_series = 0
+        # Task metric labels by worker and task name
+        self.task_labels = {}
+        # Worker and task labels of the task metrics
+        self.series = set()
+        self.runtime_quantiles = None
+        self.events = PrometheusCounter('flower_events_total', "Number of events", ['worker', 'type', 'task'])
+
+        self.runtime = Histogram(
+            'flower_task_runtime_seconds',
+            "Task runtime",
+            ['worker', 'task'],
+            buckets=options.task_runtime_metric_buckets
+        )
+        self.prefetch_time = Gauge(
+            'flower_task_prefetch_time_seconds',
+            "The time the task spent waiting at the celery worker to be executed.",
+            ['worker', 'task']
+        )
+        self.number_of_prefetched_tasks = Gauge(
+            'flower_worker_prefetched_tasks',
+            'Number of tasks of given type prefetched at a worker',
+            ['worker', 'task']
+        )
+        self.worker_online = Gauge('flower_worker_online', "Worker online status", ['worker'])
+        self.worker_number_of_currently_executing_tasks = Gauge(
+            'flower_worker_number_of_currently_executing_tasks',
+            "Number of tasks currently executing at a worker",
+            ['worker']
+        )
+        self.events_queue_depth = Gauge(
+            'flower_events_queue_depth',
+            "Number of received events waiting to be processed by the ioloop"
+        )
+        self.events_dropped = PrometheusCounter(
+            'flower_events_dropped_total',
+            "Number of events dropped because the events queue was full",
+            ['type']
+        )
+        self.state_save_duration = Gauge(
+            'flower_state_save_duration_seconds',
+            "Time it took to save the state in persistent mode",
+            ['kind']
+        )
+        self.state_snapshot_size = Gauge(
+            'flower_state_snapshot_size_bytes',
+            "Size of the last state snapshot written in persistent mode"
+        )
+        self.events_sampled = PrometheusCounter(
+            'flower_events_sampled_total',
+            "Number of task events skipped by events queue sampling",
+            ['type']
+        )
+        self.search_cache = PrometheusCounter(
+            'flower_search_cache_total',
+            "Number of task searches by the outcome of the result cache lookup",
+            ['result']
+        )
+        self.tasks_memory = Gauge(
+            'flower_tasks_memory_bytes',
+            "Approximate memory held by tasks in memory and their search documents"
+        )
+        self.tasks_evicted = PrometheusCounter(
+            'flower_tasks_evicted_total',
+            "Number of tasks removed from memory by the reason of the removal",
+            ['reason']
+        )
+        self.scrape_duration = Gauge(
+            'flower_metrics_scrape_duration_seconds',
+            "Time it took to render the metrics exposition"
+        )
+        self.series_count = Gauge(
+            'flower_metrics_series',
+            "Number of label combinations of the labeled metrics",
+            ['metric']
+        )
+
+    def configure(self, worker_pattern=None, drop_labels=(), max_series=0):
+        """Sets how the worker and task labels of task metrics are chosen.
+
+        The worker label is the first group, or the match, of worker_pattern
+        in the worker name when it matches, so workers can be aggregated in
+        groups. Labels in drop_labels are left empty, which Prometheus treats
+        as missing labels. Past max_series combinations of worker and task
+        labels, new combinations are counted under the overflow label.
+        """
+        self.worker_pattern = (re.compile(worker_pattern)
+                               if worker_pattern else None)
+        self.drop_labels = frozenset(drop_labels)
+        self.max_series = max_series
+        self.task_labels.clear()
+        self.series.clear()
+
+    def _task_labels(self, worker, task):
+        if 'worker' in self.drop_labels:
+            worker = ''
+        elif self.worker_pattern is not None:
+            match = self.worker_pattern.search(worker)
+            if match is not None:
+                worker = match.group(1 if match.re.groups else 0)
+        if 'task' in self.drop_labels:
+            task = ''
+        labels = (worker, task)
+        if self.max_series and labels not in self.series:
+            if len(self.series) >= self.max_series:
+                # The overflow labels are added past the limit, so this is
+                # logged once
+                if len(self.series) == self.max_series:
+                    logger.warning("Reached the limit of %d metrics series, "
+                                   "new series are counted as '%s'",
+                                   self.max_series, OVERFLOW_LABEL)
+                labels = (OVERFLOW_LABEL, OVERFLOW_LABEL)
+            self.series.add(labels)
+        return labels
+
+    def bind(self, *labels):
+        """Returns the metrics bound to label values that start with a worker
+        name, such as ``(worker, task)``."""
+        bound = self.bound.get(labels)
+        if bound is None:
+            bound = self.bound[labels] = BoundMetrics(labels)
+        return bound
+
+    def bind_task(self, worker, task, event_type=None):
+        """Returns the task metrics bound to the labels of tasks of a worker,
+        with the event type for the events counter."""
+        labels = self.task_labels.get((worker, task))
+        if labels is None:
+            labels = self.task_labels[(worker, task)] = \
+                self._task_labels(worker, task)
+        if event_type is None:
+            return self.bind(*labels)
+        return self.bind(labels[0], event_type, labels[1])
+
+    def expose_runtime_quantiles(self, sketches):
+        """Exports the quantiles of the runtime sketches by task name that
+        the sketches callable returns, None stops exporting them."""
+        if self.runtime_quantiles is None:
+            if sketches is None:
+                return
+            self.runtime_quantiles = RuntimeQuantilesCollector()
+            REGISTRY.register(self.runtime_quantiles)
+        self.runtime_quantiles.sketches = sketches
+
+    def count_series(self):
+        "updates the number of series of the labeled metrics"
+        metrics = {
+            'flower_events_total': self.events,
+            'flower_task_runtime_seconds': self.runtime,
+            'flower_task_prefetch_time_seconds': self.prefetch_time,
+            'flower_worker_prefetched_tasks': self.number_of_prefetched_tasks,
+            'flower_worker_online': self.worker_online,
+            'flower_worker_number_of_currently_executing_tasks':
+                self.worker_number_of_currently_executing_tasks,
+        }
+        for name, metric in metrics.items():
+            self.series_count.labels(name).set(
+                len(metric._metrics))  # pylint: disable=protected-access
+
+    def remove_workers(self, worker_names):
+        # Children of removed series must not be updated anymore
+        for labels in [labels for labels in self.bound
+                       if labels[0] in worker_names]:
+            del self.bound[labels]
+        for key in [key for key in self.task_labels
+                    if key[0] in worker_names]:
+            del self.task_labels[key]
+        self.series = {labels for labels in self.series
+                       if labels[0] not in worker_names}
+        metrics = (
+            self.events,
+            self.runtime,
+            self.prefetch_time,
+            self.number_of_prefetched_tasks,
+            self.worker_online,
+            self.worker_number_of_currently_executing_tasks,
+        )
+        removed_workers = set()
+        for metric in metrics:
+            labels_to_remove = [
+                labels for labels in metric._metrics  # pylint: disable=protected-access
+                if labels and labels[0] in worker_names
+            ]
+            for labels in labels_to_remove:
+                removed_workers.add(labels[0])
+                metric.remove(*labels)
+        return len(removed_workers)
+
+
+class RuntimeQuantilesCollector:
+    "Collects the quantiles of task runtime sketches as a summary"
+
+    name = 'flower_task_runtime_quantiles_seconds'
+
+    def __init__(self):
+        self.sketches = None
+
+    def describe(self):
+        # Not collected at registration, the sketches may change
+        return []
+
+    def collect(self):
+        if self.sketches is None:
+            return
+        metric = Metric(self.name, "Task runtime quantiles", 'summary')
+        # Collected in the executor while sketches are added to
+        for task, sketch in list(self.sketches().items()):
+            for quantile, value in zip(QUANTILES, sketch.quantiles()):
+                if value is not None:
+                    metric.add_sample(
+                        self.name, {'task': task, 'quantile': str(quantile)},
+                        value)
+            metric.add_sample(self.name + '_count', {'task': task},
+                              sketch.count)
+            metric.add_sample(self.name + '_sum', {'task': task}, sketch.sum)
+        yield metric
+
+
+class MetricsCache:
+    """Caches the rendered exposition of the metrics.
+
+    The exposition is rendered in the default executor of the ioloop, so
+    scrapes don't block it, and is reused for ``ttl`` seconds. Scrapes
+    arriving while it is rendered wait for the same rendering. A rendering
+    is gzipped in the executor as well, by the first scrape that accepts
+    gzip.
+    """
+
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+        # (render time, body)
+        self.rendered = None
+        self.rendering = None
+        # (rendered, future of the gzipped body)
+        self.compressed = None
+
+    def _render(self):
+        start = time.perf_counter()
+        get_prometheus_metrics().count_series()
+        body = generate_latest(self.registry)
+        get_prometheus_metrics().scrape_duration.set(
+            time.perf_counter() - start)
+        return time.monotonic(), body
+
+    async def get(self, ttl=0, before_render=None, compress=False):
+        """Returns the body of the exposition, gzipped if compress is true.
+
+        before_render is called on the ioloop before a new rendering starts.
+        """
+        rendered = self.rendered
+        if rendered is None or time.monotonic() - rendered[0] >= ttl:
+            if self.rendering is None:
+                if before_render is not None:
+                    before_render()
+                self.rendering = IOLoop.current().run_in_executor(
+                    None, self._render)
+                self.rendering.add_done_callback(self._rendered)
+            rendered = await self.rendering
+        if not compress:
+            return rendered[1]
+        if self.compressed is None or self.compressed[0] is not rendered:
+            self.compressed = (rendered, IOLoop.current().run_in_executor(
+                None, partial(gzip.compress, rendered[1], compresslevel=6)))
+        return await self.compressed[1]
+
+    def _rendered(self, future):
+        self.rendering = None
+        if not future.cancelled() and future.exception() is None:
+            self.rendered = future.result()
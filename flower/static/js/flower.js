@@ -757,6 +757,7 @@ var flower = (function () {
 
         var initialState = $.urlParam('state') || '',
             mobileTasks = window.matchMedia('(max-width: 767.98px)'),
+            nextTasksPage = null,
             tasksTable = $('#tasks-table').DataTable({
             rowId: 'uuid',
             searching: true,
@@ -787,7 +788,16 @@ var flower = (function () {
             ajax: {
                 type: 'POST',
                 url: url_prefix() + '/tasks/datatable',
+                data: function (data) {
+                    // Moving to the next page resumes from the cursor of the
+                    // current one instead of skipping `start` tasks
+                    if (nextTasksPage && nextTasksPage.start === data.start && nextTasksPage.cursor) {
+                        data.cursor = nextTasksPage.cursor;
+                    }
+                    nextTasksPage = {start: data.start + data.length, cursor: null};
+                },
                 dataSrc: function (response) {
+                    nextTasksPage.cursor = response.nextCursor || null;
                     var searchError = $('#task-search-error'),
                         searchErrorMessage = $('#task-search-error-message');
                     if (response.searchError) {
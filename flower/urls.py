@@ -2,7 +2,7 @@ import os
 
 from tornado.web import StaticFileHandler, url
 
-from .api import control, tasks, workers
+from .api import control, stats, tasks, workers
 from .utils import gen_cookie_secret
 from .views import auth, monitor
 from .views.broker import BrokerView
@@ -40,7 +40,11 @@ handlers = [
         control.WorkerQueueCancelConsumer),
     # Task API
     (r"/api/tasks", tasks.ListTasks),
+    (r"/api/tasks/standing", tasks.StandingQueries),
+    (r"/api/tasks/standing/(.+)", tasks.StandingQueryResult),
     (r"/api/task/types", tasks.ListTaskTypes),
+    (r"/api/task/stats", tasks.TaskStats),
+    (r"/api/stats/timeseries", stats.TimeSeries),
     (r"/api/queues/length", tasks.GetQueueLengths),
     (r"/api/task/info/(.*)", tasks.TaskInfo),
     (r"/api/task/apply/(.+)", tasks.TaskApply),
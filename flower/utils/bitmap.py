@@ -0,0 +1,262 @@
+from array import array
+from bisect import bisect_left
+from itertools import chain
+
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+CHUNK_BYTES = (1 << CHUNK_BITS) // 8
+# Chunks with more values are kept as bitsets
+MAX_ARRAY_SIZE = 4096
+
+# Positions of the set bits of every byte
+_BYTE_BITS = tuple(
+    tuple(bit for bit in range(8) if byte >> bit & 1)
+    for byte in range(256))
+
+
+class _Bits(bytearray):
+    "bitset chunk that keeps its number of set bits"
+
+    __slots__ = ('count',)
+
+    def __init__(self, data, count):
+        super().__init__(data)
+        self.count = count
+
+
+def _to_bits(lows):
+    "returns the bitset of distinct values"
+    bits = _Bits(CHUNK_BYTES, len(lows))
+    for low in lows:
+        bits[low >> 3] |= 1 << (low & 7)
+    return bits
+
+
+def _from_bits(bits):
+    "returns the positions of the set bits in order"
+    lows = []
+    for position, byte in enumerate(bits):
+        if byte:
+            lows.extend(map((position << 3).__add__, _BYTE_BITS[byte]))
+    return lows
+
+
+def _int(bits):
+    return int.from_bytes(bits, 'little')
+
+
+def _has_bit(bits, low):
+    return bits[low >> 3] >> (low & 7) & 1
+
+
+def _chunk(lows):
+    "returns the chunk of the sorted values, or None if there are none"
+    if not lows:
+        return None
+    if len(lows) > MAX_ARRAY_SIZE:
+        return _to_bits(lows)
+    return array('H', lows)
+
+
+def _bits_chunk(value):
+    "returns the chunk of the bits of an int, as an array if it is sparse"
+    if not value:
+        return None
+    count = value.bit_count()
+    if count > MAX_ARRAY_SIZE:
+        return _Bits(value.to_bytes(CHUNK_BYTES, 'little'), count)
+    return array('H', _from_bits(value.to_bytes(CHUNK_BYTES, 'little')))
+
+
+def _array_contains(chunk, low):
+    position = bisect_left(chunk, low)
+    return position < len(chunk) and chunk[position] == low
+
+
+def _and(first, second):
+    if isinstance(first, bytearray):
+        if isinstance(second, bytearray):
+            return _bits_chunk(_int(first) & _int(second))
+        first, second = second, first
+    if isinstance(second, bytearray):
+        return _chunk([low for low in first if _has_bit(second, low)])
+    if len(first) > len(second):
+        first, second = second, first
+    if len(first) * 16 < len(second):
+        return _chunk([low for low in first if _array_contains(second, low)])
+    return _chunk(sorted(set(first).intersection(second)))
+
+
+def _or(first, second):
+    if isinstance(first, bytearray) or isinstance(second, bytearray):
+        if not isinstance(first, bytearray):
+            first = _to_bits(first)
+        if not isinstance(second, bytearray):
+            second = _to_bits(second)
+        return _bits_chunk(_int(first) | _int(second))
+    return _chunk(sorted(set(first).union(second)))
+
+
+def _sub(first, second):
+    if isinstance(first, bytearray):
+        if not isinstance(second, bytearray):
+            second = _to_bits(second)
+        return _bits_chunk(_int(first) & ~_int(second))
+    if isinstance(second, bytearray):
+        return _chunk([low for low in first if not _has_bit(second, low)])
+    return _chunk(sorted(set(first).difference(second)))
+
+
+def _copy(chunk):
+    if isinstance(chunk, bytearray):
+        return _Bits(chunk, chunk.count)
+    return array('H', chunk)
+
+
+class Bitmap:
+    """Set of non-negative integers in the style of roaring bitmaps.
+
+    Integers are grouped in chunks of 2**16 by their high bits. A chunk
+    holds the low bits of its integers as a sorted array of 16-bit values
+    while it has up to MAX_ARRAY_SIZE of them, and as a bitset in a
+    bytearray when it is denser. Set operations combine the chunks one by
+    one, bitsets are combined with the bitwise operators of int. Bitsets
+    keep their number of values, so the length is known without counting.
+
+    The operators return new bitmaps, only add and discard change a bitmap
+    in place.
+    """
+
+    __slots__ = ('chunks',)
+
+    def __init__(self, values=()):
+        self.chunks = {}
+        values = sorted(set(values))
+        start = 0
+        while start < len(values):
+            high = values[start] >> CHUNK_BITS
+            base = high << CHUNK_BITS
+            end = bisect_left(values, base + CHUNK_MASK + 1, start)
+            lows = values[start:end]
+            if base:
+                lows = [value - base for value in lows]
+            self.chunks[high] = _chunk(lows)
+            start = end
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        bitmap = cls()
+        bitmap.chunks = chunks
+        return bitmap
+
+    def __len__(self):
+        return sum(
+            chunk.count if isinstance(chunk, bytearray) else len(chunk)
+            for chunk in self.chunks.values())
+
+    def __bool__(self):
+        return bool(self.chunks)
+
+    def __contains__(self, value):
+        chunk = self.chunks.get(value >> CHUNK_BITS)
+        if chunk is None:
+            return False
+        low = value & CHUNK_MASK
+        if isinstance(chunk, bytearray):
+            return bool(_has_bit(chunk, low))
+        return _array_contains(chunk, low)
+
+    def __iter__(self):
+        return chain.from_iterable(
+            self._values(high) for high in sorted(self.chunks))
+
+    def _values(self, high):
+        chunk = self.chunks[high]
+        lows = _from_bits(chunk) if isinstance(chunk, bytearray) else chunk
+        base = high << CHUNK_BITS
+        return map(base.__or__, lows) if base else lows
+
+    def __eq__(self, other):
+        if not isinstance(other, Bitmap):
+            return NotImplemented
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'Bitmap({list(self)!r})'
+
+    def copy(self):
+        return Bitmap.from_chunks({
+            high: _copy(chunk) for high, chunk in self.chunks.items()})
+
+    def add(self, value):
+        high, low = value >> CHUNK_BITS, value & CHUNK_MASK
+        chunk = self.chunks.get(high)
+        if chunk is None:
+            self.chunks[high] = array('H', (low,))
+        elif isinstance(chunk, bytearray):
+            bit = 1 << (low & 7)
+            if not chunk[low >> 3] & bit:
+                chunk[low >> 3] |= bit
+                chunk.count += 1
+        else:
+            position = bisect_left(chunk, low)
+            if position == len(chunk) or chunk[position] != low:
+                chunk.insert(position, low)
+                if len(chunk) > MAX_ARRAY_SIZE:
+                    self.chunks[high] = _to_bits(chunk)
+
+    def discard(self, value):
+        high, low = value >> CHUNK_BITS, value & CHUNK_MASK
+        chunk = self.chunks.get(high)
+        if chunk is None:
+            return
+        if isinstance(chunk, bytearray):
+            bit = 1 << (low & 7)
+            if not chunk[low >> 3] & bit:
+                return
+            chunk[low >> 3] &= ~bit
+            chunk.count -= 1
+            # Half the array limit, so that a chunk at the limit doesn't
+            # change its kind on every add and discard
+            if chunk.count <= MAX_ARRAY_SIZE // 2:
+                chunk = _chunk(_from_bits(chunk))
+                if chunk is None:
+                    del self.chunks[high]
+                else:
+                    self.chunks[high] = chunk
+            return
+        position = bisect_left(chunk, low)
+        if position < len(chunk) and chunk[position] == low:
+            del chunk[position]
+            if not chunk:
+                del self.chunks[high]
+
+    def _combine(self, other, operation, keep_other):
+        chunks = {}
+        for high, chunk in self.chunks.items():
+            other_chunk = other.chunks.get(high)
+            if other_chunk is None:
+                if operation is not _and:
+                    chunks[high] = _copy(chunk)
+                continue
+            chunk = operation(chunk, other_chunk)
+            if chunk is not None:
+                chunks[high] = chunk
+        if keep_other:
+            for high, chunk in other.chunks.items():
+                if high not in self.chunks:
+                    chunks[high] = _copy(chunk)
+        return Bitmap.from_chunks(chunks)
+
+    def __and__(self, other):
+        if len(self.chunks) > len(other.chunks):
+            return other._combine(self, _and, False)
+        return self._combine(other, _and, False)
+
+    def __or__(self, other):
+        return self._combine(other, _or, True)
+
+    def __sub__(self, other):
+        return self._combine(other, _sub, False)
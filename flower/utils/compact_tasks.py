@@ -0,0 +1,265 @@
+import math
+from array import array
+from collections import OrderedDict, namedtuple
+
+from celery.events.state import Worker
+
+from .symbols import SymbolTable
+
+FLOAT_FIELDS = ('received', 'sent', 'started', 'rejected', 'succeeded',
+                'failed', 'retried', 'revoked', 'timestamp', 'runtime')
+SYMBOL_FIELDS = ('name', 'state', 'worker', 'exchange', 'routing_key',
+                 'client')
+INT_FIELDS = ('retries', 'clock')
+OBJECT_FIELDS = ('args', 'kwargs', 'eta', 'expires', 'result', 'exception',
+                 'traceback', 'root_id', 'parent_id')
+
+# Missing floats are stored as NaN and missing integers as MISSING_INT
+MISSING_INT = -2 ** 63
+
+# Stands for a child task in the children of materialized tasks
+TaskRef = namedtuple('TaskRef', ('id',))
+
+
+def _float(value):
+    return float('nan') if value is None else float(value)
+
+
+def _int(value):
+    return MISSING_INT if value is None else int(value)
+
+
+class CompactTaskMap:
+    """Ordered mapping of task IDs to tasks that keeps ready tasks in columns.
+
+    Tasks that haven't finished yet are kept as ``Task`` objects. Once a task
+    is ready its fields are moved to array columns, with task names, states
+    and workers interned, and the ``Task`` object is released. Reading a
+    stored task materializes a new ``Task``, so changes made to it are lost
+    unless the task is thawed first. Children of materialized tasks are
+    ``TaskRef`` tuples holding the child task IDs.
+
+    The mapping keeps insertion order and implements the part of the
+    ``OrderedDict`` interface that celery's ``LRUCache`` relies on, so it can
+    replace the data of ``State.tasks``.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        # Task ID -> row, or None for tasks kept as objects
+        self.rows = OrderedDict()
+        self.live = {}
+        self.symbols = SymbolTable()
+        self.floats = {field: array('d') for field in FLOAT_FIELDS}
+        self.symbol_columns = {field: array('I') for field in SYMBOL_FIELDS}
+        self.ints = {field: array('q') for field in INT_FIELDS}
+        self.details = []
+        self.children = []
+        self.free_rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, task_id):
+        return task_id in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, task_id):
+        row = self.rows[task_id]
+        if row is None:
+            return self.live[task_id]
+        return self._materialize(task_id, row)
+
+    def __setitem__(self, task_id, task):
+        if task_id in self.rows:
+            self._release(task_id)
+        if not isinstance(task.children, set):
+            # Child tasks may be released when they are stored
+            task.children = set(task.children)
+        self.rows[task_id] = None
+        self.live[task_id] = task
+        self.freeze(task_id)
+
+    def __delitem__(self, task_id):
+        self.pop(task_id)
+
+    def get(self, task_id, default=None):
+        if task_id in self.rows:
+            return self[task_id]
+        return default
+
+    def pop(self, task_id, *default):
+        if task_id not in self.rows:
+            if default:
+                return default[0]
+            raise KeyError(task_id)
+        task = self[task_id]
+        self._release(task_id)
+        del self.rows[task_id]
+        return task
+
+    def popitem(self, last=True):
+        if not self.rows:
+            raise KeyError('popitem(): mapping is empty')
+        task_id = next(reversed(self.rows)) if last else next(iter(self.rows))
+        return task_id, self.pop(task_id)
+
+    def move_to_end(self, task_id, last=True):
+        self.rows.move_to_end(task_id, last)
+
+    def keys(self):
+        return self.rows.keys()
+
+    def values(self):
+        for task_id in list(self.rows):
+            yield self[task_id]
+
+    def items(self):
+        for task_id in list(self.rows):
+            yield task_id, self[task_id]
+
+    def update(self, other=(), **kwargs):
+        items = other.items() if hasattr(other, 'items') else other
+        for task_id, task in items:
+            self[task_id] = task
+        for task_id, task in kwargs.items():
+            self[task_id] = task
+
+    def clear(self):
+        self.rows.clear()
+        self.live.clear()
+        for columns in (self.floats, self.symbol_columns, self.ints):
+            for field, column in columns.items():
+                columns[field] = array(column.typecode)
+        self.symbols = SymbolTable()
+        self.details = []
+        self.children = []
+        self.free_rows = []
+
+    def freeze(self, task_id):
+        "stores a ready task in the columns, returns True if it was stored"
+        task = self.live.get(task_id)
+        if task is None or not task.ready:
+            return False
+        try:
+            row = self._store(task)
+        except (TypeError, ValueError, OverflowError):
+            # Unexpected field types, the task is kept as an object
+            return False
+        del self.live[task_id]
+        self.rows[task_id] = row
+        return True
+
+    def thaw(self, task_id):
+        "turns a stored task back into an object that can be updated"
+        row = self.rows.get(task_id)
+        if row is not None:
+            self.live[task_id] = self._materialize(task_id, row)
+            self._free(row)
+            self.rows[task_id] = None
+
+    def settle(self, task_id):
+        "stores the task after an event updated it and links it to its parent"
+        task = self.live.get(task_id)
+        if task is None:
+            return
+        frozen = self.freeze(task_id)
+        parent_id = task.parent_id
+        if parent_id not in self.rows:
+            return
+        row = self.rows[parent_id]
+        if row is not None:
+            # Celery adds children to a materialized copy of the parent
+            children = self.children[row] or ()
+            if task_id not in children:
+                self.children[row] = children + (task_id,)
+        elif frozen:
+            children = self.live[parent_id].children
+            if task in children:
+                children.discard(task)
+                children.add(TaskRef(task_id))
+
+    def _store(self, task):
+        # Values are converted before anything is written, so a failed
+        # conversion leaves the columns untouched
+        floats = [_float(getattr(task, field)) for field in FLOAT_FIELDS]
+        ints = [_int(getattr(task, field)) for field in INT_FIELDS]
+        symbols = [
+            self.symbols.encode(
+                getattr(task.worker, 'hostname', None) if field == 'worker'
+                else getattr(task, field))
+            for field in SYMBOL_FIELDS]
+        details = tuple(getattr(task, field) for field in OBJECT_FIELDS)
+        if not any(value is not None for value in details):
+            details = None
+        children = tuple(child.id for child in task.children) or None
+
+        if self.free_rows:
+            row = self.free_rows.pop()
+            for field, value in zip(FLOAT_FIELDS, floats):
+                self.floats[field][row] = value
+            for field, value in zip(INT_FIELDS, ints):
+                self.ints[field][row] = value
+            for field, value in zip(SYMBOL_FIELDS, symbols):
+                self.symbol_columns[field][row] = value
+            self.details[row] = details
+            self.children[row] = children
+        else:
+            row = len(self.details)
+            for field, value in zip(FLOAT_FIELDS, floats):
+                self.floats[field].append(value)
+            for field, value in zip(INT_FIELDS, ints):
+                self.ints[field].append(value)
+            for field, value in zip(SYMBOL_FIELDS, symbols):
+                self.symbol_columns[field].append(value)
+            self.details.append(details)
+            self.children.append(children)
+        return row
+
+    def _materialize(self, task_id, row):
+        # The task is created without cluster_state, which would look up
+        # the children and change their LRU order
+        task = self.state.Task(task_id)
+        task.cluster_state = self.state
+        fields = task.__dict__
+        for field, column in self.floats.items():
+            value = column[row]
+            if not math.isnan(value):
+                fields[field] = value
+        for field, column in self.ints.items():
+            value = column[row]
+            if value != MISSING_INT:
+                fields[field] = value
+        for field, column in self.symbol_columns.items():
+            value = self.symbols.decode(column[row])
+            if value is not None and field != 'worker':
+                fields[field] = value
+        hostname = self.symbols.decode(self.symbol_columns['worker'][row])
+        if hostname is not None:
+            task.worker = (self.state.workers.data.get(hostname) or
+                           Worker(hostname=hostname))
+        details = self.details[row]
+        if details is not None:
+            for field, value in zip(OBJECT_FIELDS, details):
+                if value is not None:
+                    fields[field] = value
+        task.children = set(TaskRef(child_id)
+                            for child_id in self.children[row] or ())
+        return task
+
+    def _free(self, row):
+        for column in self.symbol_columns.values():
+            self.symbols.release(column[row])
+            column[row] = 0
+        self.details[row] = None
+        self.children[row] = None
+        self.free_rows.append(row)
+
+    def _release(self, task_id):
+        row = self.rows[task_id]
+        if row is None:
+            del self.live[task_id]
+        else:
+            self._free(row)
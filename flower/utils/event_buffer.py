@@ -0,0 +1,92 @@
+import collections
+import threading
+
+from ..metrics import get_prometheus_metrics
+
+
+OVERFLOW_POLICIES = frozenset({'block', 'drop-heartbeats', 'sample'})
+
+
+class EventBuffer:
+    """Hands events from the receiver thread over to the ioloop in batches.
+
+    When ``maxsize`` is set the buffer is bounded and ``policy`` decides what
+    happens to events arriving at a full buffer: ``block`` stalls the receiver
+    thread, ``drop-heartbeats`` discards worker heartbeats before anything
+    else and ``sample`` additionally admits only one in ``sample_rate`` tasks
+    once the buffer is half full.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, batch_size, maxsize=0, policy='block', sample_rate=10):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown events overflow policy '{policy}'")
+        self.batch_size = batch_size
+        self.maxsize = maxsize
+        self.policy = policy
+        self.sample_rate = max(sample_rate, 1)
+        self.events = collections.deque()
+        self.heartbeats = 0
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        self.flush_scheduled = False
+        self.metrics = get_prometheus_metrics()
+
+    def __len__(self):
+        return len(self.events)
+
+    def put(self, event):
+        "buffers the event and returns True if a flush should be scheduled"
+        with self.lock:
+            if self.maxsize and not self._admit(event):
+                return False
+            self.events.append(event)
+            if event.get('type') == 'worker-heartbeat':
+                self.heartbeats += 1
+            if self.flush_scheduled or len(self.events) < self.batch_size:
+                return False
+            self.flush_scheduled = True
+            return True
+
+    def _admit(self, event):
+        event_type = event.get('type', '')
+        if self.policy == 'sample' and event_type.startswith('task-') and \
+                len(self.events) >= self.maxsize // 2:
+            # Sample by task id to keep all events of an admitted task
+            if hash(event.get('uuid')) % self.sample_rate:
+                self.metrics.events_sampled.labels(event_type).inc()
+                return False
+
+        if len(self.events) < self.maxsize:
+            return True
+
+        if self.policy == 'block':
+            while len(self.events) >= self.maxsize:
+                self.not_full.wait()
+            return True
+
+        if event_type != 'worker-heartbeat' and self.heartbeats:
+            self._drop_oldest_heartbeat()
+            return True
+
+        self.metrics.events_dropped.labels(event_type).inc()
+        return False
+
+    def _drop_oldest_heartbeat(self):
+        for index, event in enumerate(self.events):
+            if event.get('type') == 'worker-heartbeat':
+                del self.events[index]
+                self.heartbeats -= 1
+                self.metrics.events_dropped.labels('worker-heartbeat').inc()
+                return
+
+    def drain(self):
+        "returns the next batch and whether another full batch is waiting"
+        with self.lock:
+            count = min(self.batch_size, len(self.events))
+            batch = [self.events.popleft() for _ in range(count)]
+            self.heartbeats -= sum(
+                1 for event in batch if event.get('type') == 'worker-heartbeat')
+            self.flush_scheduled = len(self.events) >= self.batch_size
+            self.not_full.notify_all()
+            return batch, self.flush_scheduled
@@ -0,0 +1,82 @@
+import logging
+import threading
+import time
+
+from celery.events.state import State
+
+from .records import task_record, worker_record
+
+logger = logging.getLogger(__name__)
+
+# Fields of the events summarized by the events process
+EVENT_SUMMARY_FIELDS = ('type', 'hostname', 'uuid', 'name', 'runtime',
+                        'active', 'timestamp')
+
+
+class EventsPublisher:
+    """Applies captured events to a state and sends the changes to the web
+    process in batches.
+
+    Used in the events process. A batch holds a snapshot record of each
+    task and worker changed by its events, and a summary of each event for
+    the counters and metrics of the web process, so the events of a task
+    within a batch are applied by the web process at once. Sending blocks
+    while the web process is busy, which stops consuming and leaves the
+    backlog in the broker.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, conn, batch_size, flush_interval,
+                 max_tasks_in_memory=10000, max_workers_in_memory=5000):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval / 1000.0
+        self.state = State(max_tasks_in_memory=max_tasks_in_memory,
+                           max_workers_in_memory=max_workers_in_memory)
+        self.events = []
+        # Insertion ordered, so that new tasks are sent in LRU order
+        self.changed_tasks = {}
+        self.changed_workers = {}
+        self.lock = threading.Lock()
+
+    def on_event(self, event):
+        with self.lock:
+            try:
+                self.state.event(event)
+            except Exception:
+                logger.exception("Failed to process event: %s", event)
+                return
+            if event['type'].startswith('task-'):
+                self.changed_tasks[event['uuid']] = None
+            hostname = event.get('hostname')
+            if hostname in self.state.workers.data:
+                self.changed_workers[hostname] = None
+            self.events.append({field: event[field]
+                                for field in EVENT_SUMMARY_FIELDS
+                                if field in event})
+            if len(self.events) >= self.batch_size:
+                self.flush()
+
+    def pop_records(self):
+        """returns snapshot records of the tasks and workers changed since
+        the last call"""
+        workers, tasks = self.state.workers.data, self.state.tasks.data
+        records = [worker_record(workers[hostname])
+                   for hostname in self.changed_workers
+                   if hostname in workers]
+        records.extend(task_record(tasks[task_id])
+                       for task_id in self.changed_tasks if task_id in tasks)
+        self.changed_workers.clear()
+        self.changed_tasks.clear()
+        return records
+
+    def flush(self):
+        if self.events:
+            self.conn.send((self.pop_records(), self.events))
+            self.events = []
+
+    def run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            with self.lock:
+                self.flush()
@@ -0,0 +1,176 @@
+import heapq
+import time
+from collections import OrderedDict, deque
+
+from celery import states
+
+
+def parse_retention(values):
+    """Returns the retention periods of ``STATE=seconds`` values as a dict.
+
+    Raises ValueError for malformed values.
+    """
+    ttls = {}
+    for value in values:
+        state, separator, seconds = value.partition('=')
+        state = state.strip().upper()
+        if not separator or not state:
+            raise ValueError(f"Invalid task retention '{value}'")
+        try:
+            ttls[state] = float(seconds)
+        except ValueError:
+            raise ValueError(f"Invalid task retention '{value}'") from None
+        if ttls[state] < 0:
+            raise ValueError(f"Invalid task retention '{value}'")
+    return ttls
+
+
+class LRUEvictionPolicy:
+    """Decides which tasks are removed from memory.
+
+    Policies are told about every task update and removal. The events state
+    asks them for the tasks to remove when it runs out of room and for the
+    tasks that expired. This policy keeps celery's behavior: the least
+    recently used task is removed when ``max_tasks`` is reached and the
+    least recently updated finished tasks when the memory budget is
+    exceeded. Tasks never expire.
+    """
+
+    def __init__(self):
+        # IDs of finished tasks, least recently updated first
+        self.finished = OrderedDict()
+
+    def touch(self, task_id, task):
+        "called when a task is added or updated"
+        if task.state in states.READY_STATES:
+            self.finished[task_id] = None
+            self.finished.move_to_end(task_id)
+        else:
+            self.finished.pop(task_id, None)
+
+    def forget(self, task_id):
+        "called when a task is removed"
+        self.finished.pop(task_id, None)
+
+    def clear(self):
+        "called when all tasks are removed"
+        self.finished.clear()
+
+    def expired(self, now):  # pylint: disable=unused-argument
+        "returns IDs of tasks whose retention period elapsed"
+        return []
+
+    def victims(self, state):  # pylint: disable=unused-argument
+        "yields IDs of finished tasks in the order they should be removed"
+        yield from self.finished
+
+    def make_room(self, state):
+        """Returns the ID of a task to remove before a new task is added at
+        the ``max_tasks`` limit, or None to let the least recently used task
+        be removed."""
+        # pylint: disable=unused-argument
+        return None
+
+
+class RetentionEvictionPolicy(LRUEvictionPolicy):
+    """Keeps tasks for a period that depends on their state.
+
+    ``ttls`` maps task states to the number of seconds tasks in that state
+    are kept after their last event, for instance a few minutes for
+    ``SUCCESS`` and a day for ``FAILURE``. Tasks in other states don't
+    expire. When room is needed, finished tasks closest to their expiry are
+    removed first and finished tasks without a retention period last.
+    """
+
+    def __init__(self, ttls):
+        super().__init__()
+        self.ttls = dict(ttls)
+        # Task ID -> (expiry, state), for tasks in states with a retention
+        # period
+        self.deadlines = {}
+        # (expiry, task ID) per state, in the order tasks were touched.
+        # Entries that don't match deadlines are stale and skipped.
+        self.queues = {state: deque() for state in self.ttls}
+        self.stale = 0
+
+    def touch(self, task_id, task):
+        super().touch(task_id, task)
+        ttl = self.ttls.get(task.state)
+        if ttl is None:
+            self._forget_deadline(task_id)
+            return
+        deadline = ((task.timestamp or time.time()) + ttl, task.state)
+        previous = self.deadlines.get(task_id)
+        if previous != deadline:
+            if previous is not None:
+                self.stale += 1
+            self.deadlines[task_id] = deadline
+            self.queues[task.state].append((deadline[0], task_id))
+            if self.stale > max(len(self.deadlines), 1024):
+                self._compact()
+
+    def forget(self, task_id):
+        super().forget(task_id)
+        self._forget_deadline(task_id)
+
+    def _forget_deadline(self, task_id):
+        if self.deadlines.pop(task_id, None) is not None:
+            self.stale += 1
+
+    def clear(self):
+        super().clear()
+        self.deadlines.clear()
+        for queue in self.queues.values():
+            queue.clear()
+        self.stale = 0
+
+    def _valid(self, state, entry):
+        deadline, task_id = entry
+        return self.deadlines.get(task_id) == (deadline, state)
+
+    def _compact(self):
+        for state, queue in self.queues.items():
+            entries = sorted(entry for entry in queue
+                             if self._valid(state, entry))
+            queue.clear()
+            queue.extend(entries)
+        self.stale = 0
+
+    def _pop_stale(self, state, queue):
+        while queue and not self._valid(state, queue[0]):
+            queue.popleft()
+            self.stale -= 1
+
+    def expired(self, now):
+        task_ids = []
+        for state, queue in self.queues.items():
+            # Retention periods are fixed per state, so queues are sorted by
+            # expiry unless events arrive out of order
+            self._pop_stale(state, queue)
+            while queue and queue[0][0] <= now:
+                task_id = queue.popleft()[1]
+                del self.deadlines[task_id]
+                task_ids.append(task_id)
+                self._pop_stale(state, queue)
+        return task_ids
+
+    def _entries(self, state, queue):
+        self._pop_stale(state, queue)
+        for entry in queue:
+            if self._valid(state, entry):
+                yield entry
+
+    def victims(self, state):
+        finished = [self._entries(task_state, queue)
+                    for task_state, queue in self.queues.items()
+                    if task_state in states.READY_STATES]
+        victims = set()
+        for _, task_id in heapq.merge(*finished):
+            victims.add(task_id)
+            yield task_id
+        for task_id in super().victims(state):
+            if task_id not in victims:
+                yield task_id
+
+    def make_room(self, state):
+        return next(self.victims(state), None)
@@ -0,0 +1,220 @@
+from dataclasses import dataclass
+from functools import lru_cache
+
+from kombu.utils.encoding import safe_str
+
+
+SEARCH_FIELDS = frozenset({'name', 'state', 'worker', 'args', 'kwargs', 'result'})
+EXACT_FIELDS = frozenset({'state'})
+MIN_SUBSTRING_LENGTH = 3
+MAX_QUERY_LENGTH = 2048
+MAX_QUERY_TOKENS = 128
+MAX_QUERY_DEPTH = 5
+
+
+class QuerySyntaxError(ValueError):
+    def __init__(self, message, position=None):
+        self.message = message
+        self.position = position
+        detail = message if position is None else f'{message} at position {position}'
+        super().__init__(f'{detail}.')
+
+
+@dataclass(frozen=True)
+class MatchAll:
+    pass
+
+
+@dataclass(frozen=True)
+class Term:
+    field: str
+    value: str
+
+
+@dataclass(frozen=True)
+class And:
+    children: tuple
+
+
+@dataclass(frozen=True)
+class Or:
+    children: tuple
+
+
+@dataclass(frozen=True)
+class _Token:
+    kind: str
+    value: str
+    position: int
+
+
+def _append_token(tokens, kind, value, position):
+    tokens.append(_Token(kind, value, position))
+    if len(tokens) > MAX_QUERY_TOKENS:
+        raise QuerySyntaxError(f'Query exceeds {MAX_QUERY_TOKENS} tokens')
+
+
+# pylint: disable=too-many-branches
+def _tokenize(raw_query):
+    tokens = []
+    index = 0
+    length = len(raw_query)
+
+    while index < length:
+        if raw_query[index].isspace():
+            index += 1
+            continue
+
+        position = index
+        if raw_query[index] == '(':
+            _append_token(tokens, 'LPAREN', '(', position)
+            index += 1
+            continue
+        if raw_query[index] == ')':
+            _append_token(tokens, 'RPAREN', ')', position)
+            index += 1
+            continue
+
+        value = []
+        quoted = False
+        in_quote = False
+        while index < length:
+            char = raw_query[index]
+            if char == '\\' and index + 1 < length and raw_query[index + 1] in ('"', '\\'):
+                value.append(raw_query[index + 1])
+                index += 2
+                continue
+            if char == '"':
+                quoted = True
+                in_quote = not in_quote
+                index += 1
+                continue
+            if not in_quote and (char.isspace() or char in '()'):
+                break
+            value.append(char)
+            index += 1
+
+        if in_quote:
+            raise QuerySyntaxError('Unterminated quoted phrase', position)
+
+        token_value = ''.join(value)
+        if not token_value:
+            raise QuerySyntaxError('Empty search term', position)
+        if not quoted and token_value in ('AND', 'OR'):
+            kind = token_value
+        elif not quoted and token_value == 'NOT':
+            raise QuerySyntaxError('NOT is not supported', position)
+        else:
+            kind = 'TERM'
+        _append_token(tokens, kind, token_value, position)
+
+    tokens.append(_Token('EOF', '', length))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.index = 0
+
+    @property
+    def current(self):
+        return self.tokens[self.index]
+
+    def advance(self):
+        token = self.current
+        self.index += 1
+        return token
+
+    def parse(self):
+        if self.current.kind == 'EOF':
+            return MatchAll()
+        expression = self.parse_or(0)
+        if self.current.kind != 'EOF':
+            raise QuerySyntaxError(f'Unexpected {self.current.value!r}', self.current.position)
+        return expression
+
+    def parse_or(self, depth):
+        children = [self.parse_and(depth)]
+        while self.current.kind == 'OR':
+            operator = self.advance()
+            if self.current.kind in ('EOF', 'RPAREN', 'AND', 'OR'):
+                raise QuerySyntaxError('OR must be followed by a search term', operator.position)
+            children.append(self.parse_and(depth))
+        return _combine(Or, children)
+
+    def parse_and(self, depth):
+        children = [self.parse_primary(depth)]
+        while self.current.kind not in ('EOF', 'RPAREN', 'OR'):
+            if self.current.kind == 'AND':
+                operator = self.advance()
+                if self.current.kind in ('EOF', 'RPAREN', 'AND', 'OR'):
+                    raise QuerySyntaxError(
+                        'AND must be followed by a search term', operator.position)
+            elif self.current.kind not in ('TERM', 'LPAREN'):
+                raise QuerySyntaxError(f'Unexpected {self.current.value!r}', self.current.position)
+            children.append(self.parse_primary(depth))
+        return _combine(And, children)
+
+    def parse_primary(self, depth):
+        token = self.current
+        if token.kind == 'LPAREN':
+            if depth >= MAX_QUERY_DEPTH:
+                raise QuerySyntaxError(
+                    f'Query nesting exceeds {MAX_QUERY_DEPTH} levels', token.position)
+            self.advance()
+            if self.current.kind == 'RPAREN':
+                raise QuerySyntaxError('Empty group', token.position)
+            expression = self.parse_or(depth + 1)
+            if self.current.kind != 'RPAREN':
+                raise QuerySyntaxError('Missing closing parenthesis', token.position)
+            self.advance()
+            return expression
+        if token.kind != 'TERM':
+            raise QuerySyntaxError('Expected a search term', token.position)
+        self.advance()
+        return _parse_term(token)
+
+
+def _combine(node_type, children):
+    flattened = []
+    for child in children:
+        candidates = child.children if isinstance(child, node_type) else (child,)
+        for candidate in candidates:
+            if candidate not in flattened:
+                flattened.append(candidate)
+    if len(flattened) == 1:
+        return flattened[0]
+    return node_type(tuple(flattened))
+
+
+def _parse_term(token):
+    field = None
+    value = token.value
+    if ':' in value:
+        candidate, candidate_value = value.split(':', 1)
+        if candidate.casefold() in SEARCH_FIELDS:
+            field = candidate.casefold()
+            value = candidate_value
+    if field is None and value.startswith('-'):
+        raise QuerySyntaxError("Negation with '-' is not supported", token.position)
+    if not value:
+        raise QuerySyntaxError('Search qualifier requires a value', token.position)
+    is_exact = field in EXACT_FIELDS or (field == 'kwargs' and '=' in value)
+    if not is_exact and len(value.strip()) < MIN_SUBSTRING_LENGTH:
+        raise QuerySyntaxError(
+            f'Substring search terms must contain at least '
+            f'{MIN_SUBSTRING_LENGTH} characters', token.position)
+    return Term(field, value)
+
+
+def parse_query(raw_query):
+    query = safe_str(raw_query or '').strip()
+    if len(query) > MAX_QUERY_LENGTH:
+        raise QuerySyntaxError(f'Query exceeds {MAX_QUERY_LENGTH} characters')
+    return _parse_query_cached(query)
+
+
+@lru_cache(maxsize=512)
+def _parse_query_cached(query):
+    return _Parser(_tokenize(query)).parse()
@@ -0,0 +1,26 @@
+from celery.events.state import Task, Worker
+
+
+TASK_RECORD_FIELDS = tuple(
+    field for field in Task._fields  # pylint: disable=protected-access
+    if field not in ('worker', 'root', 'parent', 'children'))
+
+
+def task_record(task):
+    fields = {}
+    for field in TASK_RECORD_FIELDS:
+        value = getattr(task, field)
+        if value is not None:
+            fields[field] = value
+    fields['worker'] = getattr(task.worker, 'hostname', None)
+    fields['children'] = [child.id for child in task.children]
+    return 'task', fields
+
+
+def worker_record(worker):
+    fields = {
+        field: getattr(worker, field)
+        for field in Worker._fields  # pylint: disable=protected-access
+    }
+    fields['heartbeats'] = list(worker.heartbeats)
+    return 'worker', fields
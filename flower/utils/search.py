@@ -1,233 +1,41 @@
 import ast
 import heapq
-from collections import defaultdict
-from dataclasses import dataclass
-from functools import lru_cache
+import pickle
+import zlib
+from collections import Counter, OrderedDict, defaultdict, deque
+from itertools import chain, islice
 
+from kombu import uuid as new_id
 from kombu.utils.encoding import safe_str
 
+from .bitmap import Bitmap
+from .query import EXACT_FIELDS, And, MatchAll, Or, Term, parse_query
+from .search_pages import (SearchPage, SearchRequest, decode_cursor,
+                           encode_cursor, merge_stored)
+from .sorted_index import SortedIndex
+from .symbols import SymbolTable
 
-SEARCH_FIELDS = frozenset({'name', 'state', 'worker', 'args', 'kwargs', 'result'})
-EXACT_FIELDS = frozenset({'state'})
-EXACT_INDEX_FIELDS = frozenset({'name', 'state', 'worker'})
-MIN_SUBSTRING_LENGTH = 3
-MAX_QUERY_LENGTH = 2048
-MAX_QUERY_TOKENS = 128
-MAX_QUERY_DEPTH = 5
 
+# Fields matched by unqualified terms
+TEXT_FIELDS = ('uuid', 'name', 'state', 'worker', 'args', 'kwargs', 'result')
+# Low cardinality fields, stored as symbols of the engine's symbol table
+SYMBOL_FIELDS = ('name', 'state', 'worker')
+TRIGRAM_FIELDS = ('uuid', 'args', 'kwargs', 'result')
+SORTED_INDEX_FIELDS = ('received', 'started', 'timestamp', 'runtime')
+# Fields whose indexed text can be truncated or that can be left out
+TRUNCATABLE_FIELDS = ('args', 'kwargs', 'result')
+# Bump when the format of SearchDocument or of the postings changes
+INDEX_FORMAT_VERSION = 7
 
-class QuerySyntaxError(ValueError):
-    def __init__(self, message, position=None):
-        self.message = message
-        self.position = position
-        detail = message if position is None else f'{message} at position {position}'
-        super().__init__(f'{detail}.')
 
-
-@dataclass(frozen=True)
-class MatchAll:
-    pass
-
-
-@dataclass(frozen=True)
-class Term:
-    field: str
-    value: str
-
-
-@dataclass(frozen=True)
-class And:
-    children: tuple
-
-
-@dataclass(frozen=True)
-class Or:
-    children: tuple
-
-
-@dataclass(frozen=True)
-class _Token:
-    kind: str
-    value: str
-    position: int
-
-
-def _append_token(tokens, kind, value, position):
-    tokens.append(_Token(kind, value, position))
-    if len(tokens) > MAX_QUERY_TOKENS:
-        raise QuerySyntaxError(f'Query exceeds {MAX_QUERY_TOKENS} tokens')
-
-
-# pylint: disable=too-many-branches
-def _tokenize(raw_query):
-    tokens = []
-    index = 0
-    length = len(raw_query)
-
-    while index < length:
-        if raw_query[index].isspace():
-            index += 1
-            continue
-
-        position = index
-        if raw_query[index] == '(':
-            _append_token(tokens, 'LPAREN', '(', position)
-            index += 1
-            continue
-        if raw_query[index] == ')':
-            _append_token(tokens, 'RPAREN', ')', position)
-            index += 1
-            continue
-
-        value = []
-        quoted = False
-        in_quote = False
-        while index < length:
-            char = raw_query[index]
-            if char == '\\' and index + 1 < length and raw_query[index + 1] in ('"', '\\'):
-                value.append(raw_query[index + 1])
-                index += 2
-                continue
-            if char == '"':
-                quoted = True
-                in_quote = not in_quote
-                index += 1
-                continue
-            if not in_quote and (char.isspace() or char in '()'):
-                break
-            value.append(char)
-            index += 1
-
-        if in_quote:
-            raise QuerySyntaxError('Unterminated quoted phrase', position)
-
-        token_value = ''.join(value)
-        if not token_value:
-            raise QuerySyntaxError('Empty search term', position)
-        if not quoted and token_value in ('AND', 'OR'):
-            kind = token_value
-        elif not quoted and token_value == 'NOT':
-            raise QuerySyntaxError('NOT is not supported', position)
-        else:
-            kind = 'TERM'
-        _append_token(tokens, kind, token_value, position)
-
-    tokens.append(_Token('EOF', '', length))
-    return tokens
-
-
-class _Parser:
-    def __init__(self, tokens):
-        self.tokens = tokens
-        self.index = 0
-
-    @property
-    def current(self):
-        return self.tokens[self.index]
-
-    def advance(self):
-        token = self.current
-        self.index += 1
-        return token
-
-    def parse(self):
-        if self.current.kind == 'EOF':
-            return MatchAll()
-        expression = self.parse_or(0)
-        if self.current.kind != 'EOF':
-            raise QuerySyntaxError(f'Unexpected {self.current.value!r}', self.current.position)
-        return expression
-
-    def parse_or(self, depth):
-        children = [self.parse_and(depth)]
-        while self.current.kind == 'OR':
-            operator = self.advance()
-            if self.current.kind in ('EOF', 'RPAREN', 'AND', 'OR'):
-                raise QuerySyntaxError('OR must be followed by a search term', operator.position)
-            children.append(self.parse_and(depth))
-        return _combine(Or, children)
-
-    def parse_and(self, depth):
-        children = [self.parse_primary(depth)]
-        while self.current.kind not in ('EOF', 'RPAREN', 'OR'):
-            if self.current.kind == 'AND':
-                operator = self.advance()
-                if self.current.kind in ('EOF', 'RPAREN', 'AND', 'OR'):
-                    raise QuerySyntaxError(
-                        'AND must be followed by a search term', operator.position)
-            elif self.current.kind not in ('TERM', 'LPAREN'):
-                raise QuerySyntaxError(f'Unexpected {self.current.value!r}', self.current.position)
-            children.append(self.parse_primary(depth))
-        return _combine(And, children)
-
-    def parse_primary(self, depth):
-        token = self.current
-        if token.kind == 'LPAREN':
-            if depth >= MAX_QUERY_DEPTH:
-                raise QuerySyntaxError(
-                    f'Query nesting exceeds {MAX_QUERY_DEPTH} levels', token.position)
-            self.advance()
-            if self.current.kind == 'RPAREN':
-                raise QuerySyntaxError('Empty group', token.position)
-            expression = self.parse_or(depth + 1)
-            if self.current.kind != 'RPAREN':
-                raise QuerySyntaxError('Missing closing parenthesis', token.position)
-            self.advance()
-            return expression
-        if token.kind != 'TERM':
-            raise QuerySyntaxError('Expected a search term', token.position)
-        self.advance()
-        return _parse_term(token)
-
-
-def _combine(node_type, children):
-    flattened = []
-    for child in children:
-        candidates = child.children if isinstance(child, node_type) else (child,)
-        for candidate in candidates:
-            if candidate not in flattened:
-                flattened.append(candidate)
-    if len(flattened) == 1:
-        return flattened[0]
-    return node_type(tuple(flattened))
-
-
-def _parse_term(token):
-    field = None
-    value = token.value
-    if ':' in value:
-        candidate, candidate_value = value.split(':', 1)
-        if candidate.casefold() in SEARCH_FIELDS:
-            field = candidate.casefold()
-            value = candidate_value
-    if field is None and value.startswith('-'):
-        raise QuerySyntaxError("Negation with '-' is not supported", token.position)
-    if not value:
-        raise QuerySyntaxError('Search qualifier requires a value', token.position)
-    is_exact = field in EXACT_FIELDS or (field == 'kwargs' and '=' in value)
-    if not is_exact and len(value.strip()) < MIN_SUBSTRING_LENGTH:
-        raise QuerySyntaxError(
-            f'Substring search terms must contain at least '
-            f'{MIN_SUBSTRING_LENGTH} characters', token.position)
-    return Term(field, value)
-
-
-def parse_query(raw_query):
-    query = safe_str(raw_query or '').strip()
-    if len(query) > MAX_QUERY_LENGTH:
-        raise QuerySyntaxError(f'Query exceeds {MAX_QUERY_LENGTH} characters')
-    return _parse_query_cached(query)
-
-
-@lru_cache(maxsize=512)
-def _parse_query_cached(query):
-    return _Parser(_tokenize(query)).parse()
-
-
-def _normalize(value):
+def _normalize(value, max_length=0):
+    "returns the casefolded text, with at most one character past max_length"
     if value is None:
         return ''
-    return safe_str(value).casefold()
+    text = safe_str(value)
+    if max_length:
+        text = text[:max_length + 1]
+    return text.casefold()
 
 
 def _worker_name(task):
@@ -259,13 +67,29 @@ def _kwargs_query_pair(value):
     return f'{key.strip()}={item.strip()}'
 
 
-class SearchDocument:
-    __slots__ = ('name', 'state', 'worker', 'args', 'kwargs',
-                 'result', 'all_text', 'kwargs_pairs')
+def _sort_value(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _trigrams(value):
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class SearchDocument:  # pylint: disable=too-many-instance-attributes
+    __slots__ = ('uuid', 'name', 'state', 'worker', 'args', 'kwargs',
+                 'result', 'all_text', 'kwargs_pairs', 'received', 'started',
+                 'timestamp', 'runtime', 'truncated')
 
     # pylint: disable=too-many-arguments
-    def __init__(self, name, state, worker, args, kwargs, result,
-                 all_text, kwargs_pairs):
+    def __init__(self, uuid, name, state, worker, args, kwargs, result,
+                 all_text, kwargs_pairs, received=None, started=None,
+                 timestamp=None, runtime=None, truncated=()):
+        self.uuid = uuid
         self.name = name
         self.state = state
         self.worker = worker
@@ -274,148 +98,669 @@ class SearchDocument:
         self.result = result
         self.all_text = all_text
         self.kwargs_pairs = kwargs_pairs
+        self.received = received
+        self.started = started
+        self.timestamp = timestamp
+        self.runtime = runtime
+        # Fields whose text is cut at the maximum length. Only their
+        # beginning is searchable and only by qualified terms.
+        self.truncated = truncated
 
     @classmethod
-    def from_task(cls, task):
+    def from_task(cls, task, symbols, max_length=0, excluded_fields=()):
+        """Returns the document of the task, with symbols of the given table.
+
+        Texts of truncatable fields longer than max_length are truncated,
+        excluded fields are not indexed.
+        """
         uuid = _normalize(getattr(task, 'uuid', ''))
-        name = _normalize(getattr(task, 'name', ''))
-        state = _normalize(getattr(task, 'state', ''))
-        worker = _normalize(_worker_name(task))
-        args = _normalize(getattr(task, 'args', ''))
-        kwargs = _normalize(getattr(task, 'kwargs', ''))
-        result = _normalize(getattr(task, 'result', ''))
+        texts = []
+        truncated = []
+        for field in TRUNCATABLE_FIELDS:
+            text = ''
+            if field not in excluded_fields:
+                text = _normalize(getattr(task, field, ''), max_length)
+                if max_length and len(text) > max_length:
+                    text = text[:max_length]
+                    truncated.append(field)
+            texts.append(text)
+        kwargs_pairs = frozenset()
+        if 'kwargs' not in excluded_fields and 'kwargs' not in truncated:
+            kwargs_pairs = _kwargs_pairs(getattr(task, 'kwargs', None))
         return cls(
-            name,
-            state,
-            worker,
-            args,
-            kwargs,
-            result,
-            '\0'.join((uuid, name, state, worker, args, kwargs, result)),
-            _kwargs_pairs(getattr(task, 'kwargs', None)))
-
-
-@dataclass(frozen=True)
-class SearchPage:
-    task_ids: list
-    filtered_count: int
-    total_count: int
+            uuid,
+            symbols.encode(_normalize(getattr(task, 'name', '')) or None),
+            symbols.encode(_normalize(getattr(task, 'state', '')) or None),
+            symbols.encode(_normalize(_worker_name(task)) or None),
+            *texts,
+            '\0'.join([uuid] + [
+                text for field, text in zip(TRUNCATABLE_FIELDS, texts)
+                if field not in truncated
+            ]),
+            kwargs_pairs,
+            *(_sort_value(getattr(task, field, None))
+              for field in SORTED_INDEX_FIELDS),
+            tuple(truncated))
+
+
+# Positions of the symbol fields in the dumped fields of a document
+SYMBOL_POSITIONS = tuple(
+    SearchDocument.__slots__.index(field) for field in SYMBOL_FIELDS)
+
+
+class StandingQuery:
+    """A registered search whose matches are kept up to date.
+
+    The engine checks every changed task against the query, so the matching
+    IDs and their count by state are available without a search.
+    """
+
+    def __init__(self, query_id, query):
+        self.id = query_id
+        self.query = query
+        self.expression = parse_query(query)
+        self.task_ids = set()
+        self.states = Counter()
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'query': self.query,
+            'count': len(self.task_ids),
+            'states': {state.upper(): count for state, count in self.states.items()},
+        }
 
 
 class TaskSearchEngine:
-    def __init__(self):
+    result_cache_size = 8
+    change_log_size = 10000
+
+    def __init__(self, max_field_length=0, excluded_fields=()):
+        unknown_fields = set(excluded_fields).difference(TRUNCATABLE_FIELDS)
+        if unknown_fields:
+            raise ValueError(
+                f"Unknown search index fields: {', '.join(sorted(unknown_fields))}")
+        self.max_field_length = max_field_length
+        self.excluded_fields = frozenset(excluded_fields)
         self.documents = {}
+        # Documents are numbered with dense rows, the postings are bitmaps
+        # of rows. Rows of removed documents are reused.
+        self.rows = {}
+        self.row_ids = []
+        self.free_rows = []
+        self.all_rows = Bitmap()
+        # Names, states and workers are few, documents refer to them by
+        # symbol and their postings are keyed by symbol. Substring terms
+        # scan the symbols instead of a trigram index.
+        self.symbols = SymbolTable()
         self.exact_postings = {
-            field: defaultdict(set)
-            for field in EXACT_INDEX_FIELDS
+            field: defaultdict(Bitmap)
+            for field in SYMBOL_FIELDS
+        }
+        self.kwargs_postings = defaultdict(Bitmap)
+        # Substring terms are narrowed down by the trigrams of each field
+        # before the final substring check
+        self.trigram_postings = {
+            field: defaultdict(Bitmap)
+            for field in TRIGRAM_FIELDS
+        }
+        self.sorted_indexes = {
+            field: SortedIndex()
+            for field in SORTED_INDEX_FIELDS
         }
-        self.kwargs_postings = defaultdict(set)
+        # Filtered IDs of recent searches with the generation they were
+        # computed at. The IDs of the documents changed in the following
+        # generations are in the change log, so an outdated result is patched
+        # by filtering the changed documents only.
+        self.generation = 0
+        self.change_log = deque(maxlen=self.change_log_size)
+        self.result_cache = OrderedDict()
+        self.standing_queries = {}
+
+    def _changed(self, task_id, previous=None):
+        self.generation += 1
+        self.change_log.append(task_id)
+        if self.standing_queries:
+            self._update_standing_queries(task_id, previous)
+
+    def add_standing_query(self, query):
+        "registers a query and returns it with its current matches"
+        standing_query = StandingQuery(new_id(), query)
+        self._refresh_standing_query(standing_query)
+        self.standing_queries[standing_query.id] = standing_query
+        return standing_query
+
+    def take_standing_queries(self, engine):
+        "moves the standing queries of another engine to this one"
+        for standing_query in engine.standing_queries.values():
+            self._refresh_standing_query(standing_query)
+        self.standing_queries.update(engine.standing_queries)
+        engine.standing_queries = {}
+
+    def remove_standing_query(self, query_id):
+        return self.standing_queries.pop(query_id, None) is not None
+
+    def most_recent(self, task_ids, limit=None):
+        "returns the IDs ordered by timestamp, most recent first"
+        return self._ordered_ids(
+            task_ids, self._sort_key({}, 'timestamp'), 'timestamp', True,
+            None, limit)
+
+    def _refresh_standing_query(self, standing_query):
+        standing_query.task_ids = self._task_ids(
+            self._evaluate(standing_query.expression))
+        standing_query.states = Counter(
+            self._text(self.documents[task_id], 'state')
+            for task_id in standing_query.task_ids)
+
+    def _update_standing_queries(self, task_id, previous):
+        document = self.documents.get(task_id)
+        for standing_query in self.standing_queries.values():
+            if task_id in standing_query.task_ids:
+                state = self._text(previous, 'state')
+                standing_query.task_ids.discard(task_id)
+                standing_query.states[state] -= 1
+                if not standing_query.states[state]:
+                    del standing_query.states[state]
+            if document is not None and self._matches(
+                    document, standing_query.expression):
+                standing_query.task_ids.add(task_id)
+                standing_query.states[self._text(document, 'state')] += 1
+
+    def _add_row(self, task_id):
+        row = self.free_rows.pop() if self.free_rows else len(self.row_ids)
+        if row == len(self.row_ids):
+            self.row_ids.append(task_id)
+        else:
+            self.row_ids[row] = task_id
+        self.rows[task_id] = row
+        self.all_rows.add(row)
+        return row
+
+    def _remove_row(self, task_id):
+        row = self.rows.pop(task_id)
+        self.row_ids[row] = None
+        self.free_rows.append(row)
+        self.all_rows.discard(row)
+
+    def _row_bitmap(self, task_ids):
+        "returns the rows of the indexed tasks among the IDs"
+        rows = self.rows
+        return Bitmap(rows[task_id] for task_id in task_ids if task_id in rows)
+
+    def _task_ids(self, rows):
+        if len(rows) == len(self.rows):
+            return set(self.rows)
+        return set(map(self.row_ids.__getitem__, rows))
+
+    def _text(self, document, field):
+        "returns the normalized text of a document field"
+        value = getattr(document, field)
+        if field in self.exact_postings:
+            return self.symbols.decode(value) or ''
+        return value
+
+    def _changes_since(self, generation):
+        "returns the IDs changed since the generation, or None if unknown"
+        count = self.generation - generation
+        if count > len(self.change_log):
+            return None
+        return set(islice(reversed(self.change_log), count))
 
     def _clear(self):
         self.documents.clear()
+        self.symbols = SymbolTable()
+        self.rows.clear()
+        self.row_ids = []
+        self.free_rows = []
+        self.all_rows = Bitmap()
         for index in self.exact_postings.values():
             index.clear()
         self.kwargs_postings.clear()
+        for index in self.trigram_postings.values():
+            index.clear()
+        for field in SORTED_INDEX_FIELDS:
+            self.sorted_indexes[field] = SortedIndex()
+        self.result_cache.clear()
+        for standing_query in self.standing_queries.values():
+            standing_query.task_ids = set()
+            standing_query.states = Counter()
 
     def rebuild(self, tasks):
         self._clear()
         for _, task in tasks:
             task_id = safe_str(getattr(task, 'uuid', ''))
             if task_id:
-                self._index(task_id, task)
+                self._add_document(
+                    task_id, self._document(task), bulk=True)
+        # Sorting once is much cheaper than inserting in random order
+        for field, index in self.sorted_indexes.items():
+            index.build(
+                (getattr(document, field), task_id)
+                for task_id, document in self.documents.items())
+        for standing_query in self.standing_queries.values():
+            self._refresh_standing_query(standing_query)
 
     def upsert(self, task):
         task_id = safe_str(getattr(task, 'uuid', ''))
         if not task_id:
             return
-        self.remove(task_id)
-        self._index(task_id, task)
+        previous = self.documents.get(task_id)
+        if previous is None:
+            self._index(task_id, task)
+            return
 
-    def _index(self, task_id, task):
-        document = SearchDocument.from_task(task)
+        # Only the postings of the changed fields are updated, most events
+        # change the state and little else
+        document = self._document(task)
+        changed = [
+            field for field in TEXT_FIELDS
+            if getattr(document, field) != getattr(previous, field)
+        ]
+        row = self.rows[task_id]
+        for index, key in self._postings(previous, changed):
+            _remove_posting(index, key, row)
+        for index, key in self._postings(document, changed):
+            index[key].add(row)
+        for field in SORTED_INDEX_FIELDS:
+            value = getattr(document, field)
+            if value != getattr(previous, field):
+                self.sorted_indexes[field].remove(task_id, getattr(previous, field))
+                self.sorted_indexes[field].add(task_id, value)
         self.documents[task_id] = document
+        self._release_symbols(previous)
+        self._changed(task_id, previous)
+
+    def _index(self, task_id, task):
+        self._add_document(task_id, self._document(task))
+
+    def _document(self, task):
+        return SearchDocument.from_task(
+            task, self.symbols, self.max_field_length, self.excluded_fields)
 
-        for field, index in self.exact_postings.items():
+    def _add_document(self, task_id, document, bulk=False):
+        """Indexes a new document.
+
+        In bulk mode the caller builds the sorted indexes and refreshes the
+        standing queries once all documents are added.
+        """
+        self.documents[task_id] = document
+        row = self._add_row(task_id)
+        for index, key in self._postings(document, TEXT_FIELDS):
+            index[key].add(row)
+        if not bulk:
+            for field, index in self.sorted_indexes.items():
+                index.add(task_id, getattr(document, field))
+            self._changed(task_id)
+
+    def _release_symbols(self, document):
+        for field in SYMBOL_FIELDS:
+            self.symbols.release(getattr(document, field))
+
+    def _postings(self, document, fields):
+        "yields the (index, key) postings of the given document fields"
+        for field in fields:
             value = getattr(document, field)
-            if value:
-                index[value].add(task_id)
-        for pair in document.kwargs_pairs:
-            self.kwargs_postings[pair].add(task_id)
+            if field == 'kwargs':
+                for pair in document.kwargs_pairs:
+                    yield self.kwargs_postings, pair
+            if not value:
+                continue
+            if field in self.exact_postings:
+                yield self.exact_postings[field], value
+                continue
+            index = self.trigram_postings[field]
+            for trigram in _trigrams(value):
+                yield index, trigram
+
+    def copy_index(self):
+        """Returns a copy of the index for dump.
+
+        Documents are replaced rather than changed, so they are shared with
+        the copy, and postings are copied. The copy is much cheaper to take
+        than to serialize, dump can then run in another thread while the
+        index changes.
+        """
+        return (
+            list(self.symbols.values),
+            list(self.row_ids),
+            dict(self.documents),
+            {
+                field: {value: rows.copy().chunks for value, rows in index.items()}
+                for field, index in self.exact_postings.items()
+            },
+            {pair: rows.copy().chunks for pair, rows in self.kwargs_postings.items()},
+            {
+                field: {trigram: rows.copy().chunks for trigram, rows in index.items()}
+                for field, index in self.trigram_postings.items()
+            },
+            {
+                field: (list(index.values), list(index.ids), list(index.missing))
+                for field, index in self.sorted_indexes.items()
+            },
+        )
+
+    def dump(self, index=None):
+        """Returns the index serialized with a version and a checksum.
+
+        ``index`` is a copy returned by copy_index, the current index is
+        serialized if it is not given.
+        """
+        (symbols, row_ids, documents, exact_postings, kwargs_postings,
+         trigram_postings, sorted_indexes) = index or self.copy_index()
+        data = pickle.dumps((
+            symbols,
+            row_ids,
+            {
+                task_id: tuple(getattr(document, slot)
+                               for slot in SearchDocument.__slots__)
+                for task_id, document in documents.items()
+            },
+            exact_postings,
+            kwargs_postings,
+            trigram_postings,
+            sorted_indexes,
+        ), protocol=pickle.HIGHEST_PROTOCOL)
+        return {'version': INDEX_FORMAT_VERSION,
+                'fields': self._field_settings(),
+                'checksum': zlib.crc32(data),
+                'data': data}
+
+    def _field_settings(self):
+        return [self.max_field_length, sorted(self.excluded_fields)]
+
+    # pylint: disable=too-many-locals
+    def load(self, dump):
+        """Loads an index returned by dump.
+
+        Returns the IDs of the loaded documents, or None if the dump is
+        invalid or was indexed with other field settings. Documents already
+        in the index are kept.
+        """
+        if not isinstance(dump, dict) or \
+                dump.get('version') != INDEX_FORMAT_VERSION or \
+                dump.get('fields') != self._field_settings() or \
+                zlib.crc32(dump.get('data', b'')) != dump.get('checksum'):
+            return None
+        try:
+            (symbols, row_ids, documents, exact_postings, kwargs_postings,
+             trigram_postings, sorted_indexes) = pickle.loads(dump['data'])
+        except Exception:
+            return None
+
+        # Loaded symbols are translated to symbols of this engine, with a
+        # reference for each loaded document
+        refs = Counter(
+            fields[position] for fields in documents.values()
+            for position in SYMBOL_POSITIONS)
+        symbols = [self.symbols.encode(value, refs[symbol])
+                   for symbol, value in enumerate(symbols)]
+        documents = {
+            task_id: SearchDocument(*_translate_symbols(fields, symbols))
+            for task_id, fields in documents.items()
+        }
+        if self.documents:
+            loaded = set()
+            for task_id, document in documents.items():
+                if task_id in self.documents:
+                    self._release_symbols(document)
+                else:
+                    self._add_document(task_id, document)
+                    loaded.add(task_id)
+            return loaded
+
+        # Fast path for an empty index: take the rows and the postings as
+        # they are
+        self.documents = documents
+        self.row_ids = row_ids
+        self.rows = {
+            task_id: row for row, task_id in enumerate(row_ids)
+            if task_id is not None
+        }
+        self.free_rows = [
+            row for row, task_id in enumerate(row_ids) if task_id is None
+        ]
+        self.all_rows = Bitmap(self.rows.values())
+        for field, index in exact_postings.items():
+            self.exact_postings[field].update(
+                (symbols[value], Bitmap.from_chunks(chunks))
+                for value, chunks in index.items())
+        self.kwargs_postings.update(
+            (pair, Bitmap.from_chunks(chunks))
+            for pair, chunks in kwargs_postings.items())
+        for field, index in trigram_postings.items():
+            self.trigram_postings[field].update(
+                (trigram, Bitmap.from_chunks(chunks))
+                for trigram, chunks in index.items())
+        for field, (values, ids, missing) in sorted_indexes.items():
+            index = self.sorted_indexes[field]
+            index.values, index.ids, index.missing = values, ids, set(missing)
+        self.result_cache.clear()
+        for standing_query in self.standing_queries.values():
+            self._refresh_standing_query(standing_query)
+        return set(self.documents)
 
     def remove(self, task_id):
         document = self.documents.pop(task_id, None)
         if document is None:
             return
-        for field, index in self.exact_postings.items():
-            value = getattr(document, field)
-            if value:
-                _remove_posting(index, value, task_id)
-        for pair in document.kwargs_pairs:
-            _remove_posting(self.kwargs_postings, pair, task_id)
+        row = self.rows[task_id]
+        for index, key in self._postings(document, TEXT_FIELDS):
+            _remove_posting(index, key, row)
+        self._remove_row(task_id)
+        for field, index in self.sorted_indexes.items():
+            index.remove(task_id, getattr(document, field))
+        self._release_symbols(document)
+        self._changed(task_id, document)
 
     def matching_ids(self, query, candidates=None):
-        return self._evaluate(parse_query(query), candidates)
+        if candidates is not None:
+            candidates = self._row_bitmap(candidates)
+        return self._task_ids(self._evaluate(parse_query(query), candidates))
 
-    # pylint: disable=too-many-arguments,too-many-locals
+    # pylint: disable=too-many-arguments
     def search(self, tasks, query='', *, task_type=None, worker=None, state=None,
                received_start=None, received_end=None, started_start=None,
                started_end=None, sort_by=None, descending=False, offset=0,
-               limit=None):
-        task_map = getattr(tasks, 'data', tasks)
-        task_ids = set(self.documents)
-        task_ids.intersection_update(task_map.keys())
-
-        if task_type:
-            task_ids.intersection_update(
-                self.exact_postings['name'].get(_normalize(task_type), ()))
-        if worker:
-            task_ids.intersection_update(
-                self.exact_postings['worker'].get(_normalize(worker), ()))
-        if state:
-            task_ids.intersection_update(
-                self.exact_postings['state'].get(_normalize(state), ()))
-
-        if any(value is not None for value in (
-                received_start, received_end, started_start, started_end)):
-            task_ids = {
-                task_id for task_id in task_ids
-                if _task_in_time_range(
-                    task_map[task_id], received_start, received_end,
-                    started_start, started_end)
-            }
+               limit=None, cursor=None, store=None):
+        """Returns a page of the matching tasks.
+
+        The page has a cursor for the next page when there are more results.
+        Passing it back as cursor, with the same query and filters, resumes
+        after the last task of the page and offset is counted from there.
+
+        Tasks of the task store, when given, are searched as well and merged
+        with the tasks in memory, if the store can sort by the sort key.
+        Tasks in memory take precedence over their stored records.
+        """
+        request = self.search_request(
+            query, task_type=task_type, worker=worker, state=state,
+            received_start=received_start, received_end=received_end,
+            started_start=started_start, started_end=started_end,
+            sort_by=sort_by, descending=descending, offset=offset,
+            limit=limit, cursor=cursor)
+        stored = None
+        if store is not None and store.can_sort(request.sort_by):
+            stored = store.fetch(request, store.recent_ids())
+        return self.search_page(tasks, request, stored)
 
-        task_ids = self.matching_ids(query, task_ids)
-
-        filtered_count = len(task_ids)
-        ordered_ids = list(task_ids)
+    # pylint: disable=too-many-arguments
+    def search_request(self, query='', *, task_type=None, worker=None,
+                       state=None, received_start=None, received_end=None,
+                       started_start=None, started_end=None, sort_by=None,
+                       descending=False, offset=0, limit=None, cursor=None):
+        """Returns the request of a search with the arguments of search.
+
+        Raises QuerySyntaxError for invalid queries and CursorError for
+        cursors of other searches.
+        """
+        filters = (task_type, worker, state, received_start, received_end,
+                   started_start, started_end)
+        expression = parse_query(query)
         offset = max(offset, 0)
         end = None if limit is None else offset + max(limit, 0)
-        if sort_by:
+        if not sort_by:
+            sort_by = 'timestamp'
+            descending = True
+
+        # Filters are fingerprinted so that a cursor is not reused for a
+        # different result set
+        fingerprint = zlib.crc32(repr((query, filters)).encode())
+        after = None
+        if cursor is not None:
+            after = decode_cursor(cursor, sort_by, descending, fingerprint,
+                                   sort_by in self.sorted_indexes)
+        return SearchRequest(expression, filters, sort_by, descending,
+                             offset, end, after, fingerprint)
+
+    def search_page(self, tasks, request, stored=None):
+        """Returns the page of a search request.
+
+        ``stored`` are the results of the request fetched from the task
+        store, they are merged with the tasks in memory.
+        """
+        task_map = getattr(tasks, 'data', tasks)
+        task_ids, cache = self._filtered_ids(
+            task_map, request.expression, request.filters)
+        filtered_count = len(task_ids)
+        total_count = len(task_map)
+
+        key = self._sort_key(task_map, request.sort_by)
+        ordered_ids = self._ordered_ids(
+            task_ids, key, request.sort_by, request.descending,
+            request.after, request.count)
+        if stored is not None:
+            ordered_ids, key = merge_stored(
+                ordered_ids, key, task_map, stored.keys, request.descending,
+                request.count)
+            # Tasks in memory are written to the store as well
+            filtered_count = stored.count + stored.count_unstored(task_ids)
+            total_count = stored.size + stored.count_unstored(task_map)
+        end = request.end
+        page_ids = ordered_ids[request.offset:end]
+        next_cursor = None
+        if end is not None and len(ordered_ids) > end and page_ids:
+            next_cursor = encode_cursor(
+                request.sort_by, request.descending, request.fingerprint,
+                key(page_ids[-1]))
+        return SearchPage(
+            page_ids, filtered_count, total_count, next_cursor, cache)
+
+    def _filtered_ids(self, task_map, expression, filters):
+        "returns the IDs matching the search and whether they were cached"
+        key = (expression, filters)
+        entry = self.result_cache.get(key)
+        if entry is not None:
+            self.result_cache.move_to_end(key)
+            generation, task_ids = entry
+            changed = self._changes_since(generation)
+            if changed is not None:
+                # Cached sets are shared, so they are never updated in place
+                cache = 'patch' if changed else 'hit'
+                if changed:
+                    task_ids = task_ids.difference(changed)
+                    task_ids.update(self._filter(
+                        task_map, expression, filters, changed))
+                    self.result_cache[key] = (self.generation, task_ids)
+                return task_ids, cache
+
+        task_ids = self._filter(task_map, expression, filters)
+        self.result_cache[key] = (self.generation, task_ids)
+        while len(self.result_cache) > self.result_cache_size:
+            self.result_cache.popitem(last=False)
+        return task_ids, 'miss'
+
+    def _filter(self, task_map, expression, filters, candidates=None):
+        (task_type, worker, state, received_start, received_end,
+         started_start, started_end) = filters
+        if candidates is None:
+            rows = self.all_rows
+            stale = self.rows.keys() - task_map.keys()
+        else:
+            candidates = [
+                task_id for task_id in candidates if task_id in self.rows
+            ]
+            rows = self._row_bitmap(candidates)
+            stale = [
+                task_id for task_id in candidates if task_id not in task_map
+            ]
+        if stale:
+            rows = rows - self._row_bitmap(stale)
+
+        for field, value in (('name', task_type), ('worker', worker),
+                             ('state', state)):
+            if value:
+                rows = rows & self._symbol_postings(field, _normalize(value))
+
+        for field, start, end in (('received', received_start, received_end),
+                                  ('started', started_start, started_end)):
+            if start is not None or end is not None:
+                rows = self._filter_range(field, rows, start, end)
+
+        return self._task_ids(self._evaluate(expression, rows))
+
+    def _sort_key(self, task_map, sort_by):
+        if sort_by in self.sorted_indexes:
+            documents = self.documents
+
             def key(task_id):
-                return _task_sort_key(task_map[task_id], sort_by, task_id)
+                value = getattr(documents[task_id], sort_by)
+                return value is not None, value or 0.0, task_id
         else:
             def key(task_id):
-                return (
-                    getattr(task_map[task_id], 'timestamp', None) or 0,
-                    task_id)
-            descending = True
+                return _task_sort_key(task_map[task_id], sort_by, task_id)
+        return key
 
-        if end is not None and end < filtered_count:
+    # pylint: disable=too-many-arguments
+    def _ordered_ids(self, task_ids, key, sort_by, descending, after, count):
+        "returns the first count IDs in the sort order that come after after"
+        index = self.sorted_indexes.get(sort_by)
+        if index is not None and count is not None and \
+                count * len(index) <= len(task_ids) ** 2:
+            # The page is found by walking the index, which on average visits
+            # count * len(index) / len(task_ids) tasks
+            return list(islice(
+                index.ordered_ids(task_ids, descending, after), count))
+
+        if after is not None:
+            task_ids = {
+                task_id for task_id in task_ids
+                if (key(task_id) < after if descending else key(task_id) > after)
+            }
+        if count is not None and count < len(task_ids):
             select = heapq.nlargest if descending else heapq.nsmallest
-            ordered_ids = select(end, ordered_ids, key=key)
-        else:
-            ordered_ids.sort(key=key, reverse=descending)
-        return SearchPage(
-            ordered_ids[offset:end], filtered_count, len(task_map))
+            return select(count, task_ids, key=key)
+        return sorted(task_ids, key=key, reverse=descending)
+
+    def _filter_range(self, field, rows, start, end):
+        "keeps the tasks in the range, tasks without a value are kept as well"
+        index = self.sorted_indexes[field]
+        low, high = index.bounds(start, end)
+        inside = high - low
+        outside = len(index.ids) - inside
+        if len(rows) <= min(inside + len(index.missing), outside):
+            documents, row_ids = self.documents, self.row_ids
+            return Bitmap(
+                row for row in rows
+                if _in_range(getattr(documents[row_ids[row]], field),
+                             start, end))
+        # Every ID of the sorted index has a row
+        row_of = self.rows.__getitem__
+        if inside + len(index.missing) <= outside:
+            return rows & Bitmap(
+                map(row_of, chain(index.ids[low:high], index.missing)))
+        return rows - Bitmap(
+            map(row_of, chain(index.ids[:low], index.ids[high:])))
 
     def _evaluate(self, expression, candidates=None):
-        universe = set(self.documents) if candidates is None else candidates
+        "returns the rows of the candidate rows matching the expression"
+        universe = self.all_rows if candidates is None else candidates
         if isinstance(expression, MatchAll):
             return universe.copy()
         if isinstance(expression, Term):
-            return self._term_ids(expression, universe)
+            return self._term_rows(expression, universe)
         if isinstance(expression, And):
-            result = universe.copy()
+            result = universe
             children = sorted(expression.children, key=self._estimate_size)
             for child in children:
                 result = self._evaluate(child, result)
@@ -423,43 +768,140 @@ class TaskSearchEngine:
                     break
             return result
         if isinstance(expression, Or):
-            result = set()
+            result = Bitmap()
             for child in expression.children:
-                result.update(self._evaluate(child, universe))
+                result = result | self._evaluate(child, universe)
             return result
         raise TypeError(f'Unsupported search expression: {type(expression)!r}')
 
-    def _term_ids(self, term, candidates):
+    def _matches(self, document, expression):
+        """Returns whether the document matches the expression.
+
+        Checks the document's fields directly, which is cheaper than
+        evaluating the expression over a single row.
+        """
+        if isinstance(expression, MatchAll):
+            return True
+        if isinstance(expression, Term):
+            return self._term_matches(document, expression)
+        if isinstance(expression, And):
+            return all(self._matches(document, child)
+                       for child in expression.children)
+        if isinstance(expression, Or):
+            return any(self._matches(document, child)
+                       for child in expression.children)
+        raise TypeError(f'Unsupported search expression: {type(expression)!r}')
+
+    def _term_matches(self, document, term):
         value = _normalize(term.value)
         if term.field in EXACT_FIELDS:
-            result = set(self.exact_postings[term.field].get(value, ()))
-            result.intersection_update(candidates)
-            return result
+            return getattr(document, term.field) == self.symbols.get(value)
         kwargs_pair = _kwargs_query_pair(value) if term.field == 'kwargs' else None
         if kwargs_pair is not None:
-            result = set(self.kwargs_postings.get(kwargs_pair, ()))
-            result.intersection_update(candidates)
-            return result
-        field = term.field or 'all'
-        return {
-            task_id for task_id in candidates
-            if value in (
-                self.documents[task_id].all_text
-                if field == 'all'
-                else getattr(self.documents[task_id], field))
-        }
+            return kwargs_pair in document.kwargs_pairs
+        if term.field is None:
+            return self._text_contains(document, value)
+        return value in self._text(document, term.field)
+
+    def _symbol_postings(self, field, value):
+        "returns the rows of the tasks with the value in a symbol field"
+        rows = self.exact_postings[field].get(self.symbols.get(value))
+        return Bitmap() if rows is None else rows
+
+    def _matching_symbols(self, field, value):
+        "returns the postings of the symbols of a field containing the value"
+        decode = self.symbols.decode
+        return [
+            rows for symbol, rows in self.exact_postings[field].items()
+            if value in decode(symbol)
+        ]
+
+    def _term_rows(self, term, candidates):
+        value = _normalize(term.value)
+        if term.field in EXACT_FIELDS:
+            return self._symbol_postings(term.field, value) & candidates
+        kwargs_pair = _kwargs_query_pair(value) if term.field == 'kwargs' else None
+        if kwargs_pair is not None:
+            return self.kwargs_postings.get(kwargs_pair, Bitmap()) & candidates
+        documents, row_ids = self.documents, self.row_ids
+        if len(candidates) <= self._substring_estimate(term.field, value):
+            # Fewer candidates than trigram matches, checking them is cheaper
+            if term.field is None:
+                return Bitmap(
+                    row for row in candidates
+                    if self._text_contains(documents[row_ids[row]], value))
+            return Bitmap(
+                row for row in candidates
+                if value in self._text(documents[row_ids[row]], term.field))
+
+        result = Bitmap()
+        for field in (term.field,) if term.field else TEXT_FIELDS:
+            if field in self.exact_postings:
+                for rows in self._matching_symbols(field, value):
+                    result = result | (rows & candidates)
+                continue
+            # Unqualified terms are checked against all_text, which leaves
+            # out truncated fields
+            text_field = field if term.field else 'all_text'
+            result = result | Bitmap(
+                row for row in self._trigram_rows(field, value, candidates) - result
+                if value in getattr(documents[row_ids[row]], text_field))
+        return result
+
+    def _text_contains(self, document, value):
+        if value in document.all_text:
+            return True
+        decode = self.symbols.decode
+        return any(value in (decode(getattr(document, field)) or '')
+                   for field in SYMBOL_FIELDS)
+
+    def _trigram_postings(self, field, value):
+        "returns the postings of the value trigrams, smallest first"
+        index = self.trigram_postings[field]
+        postings = []
+        for trigram in _trigrams(value):
+            rows = index.get(trigram)
+            if not rows:
+                return []
+            postings.append((len(rows), rows))
+        postings.sort(key=lambda item: item[0])
+        return [rows for _, rows in postings]
+
+    def _trigram_rows(self, field, value, candidates):
+        postings = self._trigram_postings(field, value)
+        if not postings:
+            return Bitmap()
+        result = postings[0] & candidates
+        for rows in postings[1:]:
+            if not result:
+                break
+            result = result & rows
+        return result
+
+    def _substring_estimate(self, field, value):
+        "returns an upper bound of the number of tasks matching the substring"
+        estimate = 0
+        for name in (field,) if field else TEXT_FIELDS:
+            if name in self.exact_postings:
+                estimate += sum(
+                    map(len, self._matching_symbols(name, value)))
+                continue
+            postings = self._trigram_postings(name, value)
+            if postings:
+                estimate += len(postings[0])
+        return estimate
 
     def _estimate_size(self, expression):
         if isinstance(expression, Term):
             value = _normalize(expression.value)
             if expression.field in EXACT_FIELDS:
-                return len(self.exact_postings[expression.field].get(value, ())), 0
+                return len(self._symbol_postings(expression.field, value)), 0
             kwargs_pair = (
                 _kwargs_query_pair(value)
                 if expression.field == 'kwargs' else None)
             if kwargs_pair is not None:
                 return len(self.kwargs_postings.get(kwargs_pair, ())), 0
-            return len(self.documents), -len(value)
+            return self._substring_estimate(expression.field, value), -len(value)
         if isinstance(expression, And):
             return min(
                 (self._estimate_size(child) for child in expression.children),
@@ -473,40 +915,32 @@ class TaskSearchEngine:
         return len(self.documents), 1
 
 
-def _remove_posting(index, value, task_id):
-    task_ids = index.get(value)
-    if task_ids is None:
+def _translate_symbols(fields, symbols):
+    "returns document fields with the symbols translated by the mapping"
+    fields = list(fields)
+    for position in SYMBOL_POSITIONS:
+        fields[position] = symbols[fields[position]]
+    return fields
+
+
+def _remove_posting(index, value, row):
+    rows = index.get(value)
+    if rows is None:
         return
-    task_ids.discard(task_id)
-    if not task_ids:
+    rows.discard(row)
+    if not rows:
         del index[value]
 
 
-# pylint: disable=too-many-return-statements
-def _task_in_time_range(task, received_start, received_end,
-                        started_start, started_end):
-    received = getattr(task, 'received', None)
-    started = getattr(task, 'started', None)
-    if received_start is not None and received is not None and received < received_start:
-        return False
-    if received_end is not None and received is not None and received > received_end:
-        return False
-    if started_start is not None and started is not None and started < started_start:
-        return False
-    if started_end is not None and started is not None and started > started_end:
-        return False
-    return True
+# pylint: disable=too-many-arguments
+def _in_range(value, start, end):
+    if value is None:
+        return True
+    return (start is None or value >= start) and (end is None or value <= end)
 
 
 def _task_sort_key(task, sort_by, task_id):
     value = getattr(task, sort_by, None)
     if value is None:
         return False, '', task_id
-    if sort_by in ('received', 'started', 'runtime'):
-        try:
-            value = float(value)
-        except (TypeError, ValueError):
-            value = 0.0
-    else:
-        value = _normalize(value)
-    return True, value, task_id
+    return True, _normalize(value), task_id
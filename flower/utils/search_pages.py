@@ -0,0 +1,87 @@
+import base64
+import heapq
+import json
+from dataclasses import dataclass
+from itertools import islice
+
+from .query import QuerySyntaxError
+
+
+class CursorError(QuerySyntaxError):
+    def __init__(self):
+        super().__init__('Invalid pagination cursor')
+
+
+@dataclass(frozen=True)
+class SearchRequest:
+    "a parsed search with its sort order and the range of its page"
+    expression: object
+    filters: tuple
+    sort_by: str
+    descending: bool
+    offset: int
+    end: int = None
+    # Sort key of the last task of the previous page
+    after: tuple = None
+    fingerprint: int = 0
+
+    @property
+    def count(self):
+        "returns the number of tasks to look up, one more than the page end"
+        # One more task tells whether there is a next page
+        return None if self.end is None else self.end + 1
+
+
+@dataclass(frozen=True)
+class SearchPage:
+    task_ids: list
+    filtered_count: int
+    total_count: int
+    next_cursor: str = None
+    # 'hit', 'patch' or 'miss' of the filtered IDs in the result cache
+    cache: str = 'miss'
+
+
+# pylint: disable=too-many-arguments
+def merge_stored(ordered_ids, key, task_map, stored, descending, count):
+    """Returns the first count IDs of the ordered tasks and of the stored
+    (key, task ID) pairs in the sort order, with a key of both."""
+    # Tasks in memory are stored as well, they are listed once by their
+    # key in memory
+    keys = {
+        task_id: stored_key for stored_key, task_id in stored
+        if task_id not in task_map
+    }
+    ordered = heapq.merge(
+        ((key(task_id), task_id) for task_id in ordered_ids),
+        ((stored_key, task_id) for task_id, stored_key in keys.items()),
+        reverse=descending)
+    ordered_ids = [task_id for _, task_id in islice(ordered, count)]
+
+    def merged_key(task_id):
+        stored_key = keys.get(task_id)
+        return key(task_id) if stored_key is None else stored_key
+    return ordered_ids, merged_key
+
+
+def encode_cursor(sort_by, descending, filters, key):
+    data = json.dumps([sort_by, descending, filters, list(key)])
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor, sort_by, descending, filters, numeric):
+    "returns the sort key stored in the cursor"
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        cursor_sort_by, cursor_descending, cursor_filters, key = data
+        has_value, value, task_id = key
+    except (ValueError, TypeError):
+        raise CursorError() from None
+    value_types = (int, float) if numeric else (str,)
+    if [cursor_sort_by, cursor_descending, cursor_filters] != \
+            [sort_by, descending, filters] or \
+            not isinstance(has_value, bool) or \
+            not isinstance(value, value_types) or isinstance(value, bool) or \
+            not isinstance(task_id, str):
+        raise CursorError()
+    return has_value, value, task_id
@@ -0,0 +1,53 @@
+import sys
+
+from .search import TRIGRAM_FIELDS
+
+# Bytes of a Task object with its attribute dict, and of the references
+# held by the task maps and indexes
+TASK_OVERHEAD = 1200
+# Bytes of the references held by the task maps and indexes to a task
+# stored in the columns of a compact task map
+ROW_OVERHEAD = 300
+DOCUMENT_OVERHEAD = 300
+# Bytes per indexed character, for the trigram postings of the text
+POSTING_BYTES = 2
+
+
+def _value_size(value):
+    if value is None or isinstance(value, (bool, int, float)):
+        # Small values are shared or part of the overhead
+        return 0
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_value_size(key) + _value_size(item)
+                    for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(map(_value_size, value))
+    return size
+
+
+def task_size(task):
+    "returns the approximate number of bytes held by the task"
+    return TASK_OVERHEAD + sum(map(_value_size, task.__dict__.values()))
+
+
+def stored_task_size(task_map, row):
+    "returns the approximate number of bytes held by a row of a CompactTaskMap"
+    size = ROW_OVERHEAD + _value_size(task_map.details[row]) + \
+        _value_size(task_map.children[row])
+    for columns in (task_map.floats, task_map.ints, task_map.symbol_columns):
+        size += sum(column.itemsize for column in columns.values())
+    return size
+
+
+def document_size(document):
+    """Returns the approximate number of bytes held by a search document,
+    including its share of the trigram postings."""
+    if document is None:
+        return 0
+    size = DOCUMENT_OVERHEAD + _value_size(document.all_text)
+    size += sum(map(_value_size, document.kwargs_pairs))
+    for field in TRIGRAM_FIELDS:
+        text = getattr(document, field)
+        size += _value_size(text) + POSTING_BYTES * len(text)
+    return size
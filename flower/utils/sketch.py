@@ -0,0 +1,99 @@
+import math
+
+# Quantiles reported for task runtimes
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+
+class DDSketch:
+    """Streaming quantile sketch with a relative accuracy guarantee.
+
+    Values are counted in bins whose bounds grow geometrically by
+    ``gamma``, so a quantile is returned within ``relative_accuracy`` of the
+    exact value whatever the distribution. Positive values down to
+    ``min_value`` get their own bins, smaller values are counted as zeros.
+    When there are more than ``max_bins`` bins the lowest ones are merged,
+    which only affects the accuracy of the lowest quantiles, so the memory
+    used is constant.
+
+    Sketches are updated from the ioloop thread and may be read from other
+    threads, quantiles are computed from a copy of the bins.
+    """
+
+    __slots__ = ('gamma', 'log_gamma', 'min_value', 'max_bins', 'bins',
+                 'zeros', 'count', 'sum', 'min', 'max')
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048, min_value=1e-9):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.max_bins = max_bins
+        # Bin index -> number of values
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def __len__(self):
+        return self.count
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value < self.min_value:
+            self.zeros += 1
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        bins = self.bins
+        bins[index] = bins.get(index, 0) + 1
+        if len(bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self):
+        lowest = sorted(self.bins)[:len(self.bins) - self.max_bins + 1]
+        self.bins[lowest[-1]] += sum(self.bins.pop(index)
+                                     for index in lowest[:-1])
+
+    def _value(self, index):
+        "returns the value a bin stands for, with the least relative error"
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantiles(self, quantiles=QUANTILES):
+        "returns the values of the quantiles, or None without values"
+        zeros = self.zeros
+        bins = sorted(self.bins.items())
+        total = zeros + sum(count for _, count in bins)
+        if not total:
+            return [None] * len(quantiles)
+        values = []
+        for quantile in quantiles:
+            rank = quantile * (total - 1)
+            seen = zeros
+            value = 0.0
+            if rank >= zeros:
+                for index, count in bins:
+                    seen += count
+                    if seen > rank:
+                        value = self._value(index)
+                        break
+            # The bin value may be outside of the values seen
+            values.append(min(max(value, self.min), self.max))
+        return values
+
+    def quantile(self, quantile):
+        return self.quantiles((quantile,))[0]
+
+    def stats(self, quantiles=QUANTILES):
+        "returns a dict of the count, sum, min, max and quantiles"
+        stats = {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+        }
+        for quantile, value in zip(quantiles, self.quantiles(quantiles)):
+            stats[f'p{quantile * 100:g}'] = value
+        return stats
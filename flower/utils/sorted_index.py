@@ -0,0 +1,105 @@
+import bisect
+from itertools import chain
+
+
+class SortedIndex:
+    """Task IDs ordered by a numeric field.
+
+    The values and the IDs are kept in two parallel lists ordered by value
+    and then by ID, tasks without a value are kept apart.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.ids = []
+        self.missing = set()
+
+    def __len__(self):
+        return len(self.ids) + len(self.missing)
+
+    def build(self, items):
+        "replaces the index with the given (value, task ID) pairs"
+        entries = []
+        self.missing = set()
+        for value, task_id in items:
+            if value is None:
+                self.missing.add(task_id)
+            else:
+                entries.append((value, task_id))
+        entries.sort()
+        self.values = [value for value, _ in entries]
+        self.ids = [task_id for _, task_id in entries]
+
+    def _position(self, value, task_id):
+        low = bisect.bisect_left(self.values, value)
+        high = bisect.bisect_right(self.values, value, low)
+        return bisect.bisect_left(self.ids, task_id, low, high)
+
+    def add(self, task_id, value):
+        if value is None:
+            self.missing.add(task_id)
+            return
+        position = self._position(value, task_id)
+        self.values.insert(position, value)
+        self.ids.insert(position, task_id)
+
+    def remove(self, task_id, value):
+        if value is None:
+            self.missing.discard(task_id)
+            return
+        position = self._position(value, task_id)
+        if position < len(self.ids) and self.ids[position] == task_id:
+            del self.values[position]
+            del self.ids[position]
+
+    def bounds(self, start=None, end=None):
+        "returns the slice of the IDs with values between start and end"
+        low = 0 if start is None else bisect.bisect_left(self.values, start)
+        high = len(self.values) if end is None else \
+            bisect.bisect_right(self.values, end, low)
+        return low, max(low, high)
+
+    # pylint: disable=too-many-locals
+    def ordered_ids(self, task_ids, descending=False, after=None):
+        """Yields the given IDs in index order, tasks without a value first.
+
+        The walk starts after the (has value, value, task ID) sort key given
+        by after.
+        """
+        low, high = 0, len(self.ids)
+        missing_after = None
+        with_missing = True
+        if after is not None:
+            has_value, value, last_id = after
+            if has_value:
+                position = self._position(value, last_id)
+                if descending:
+                    high = position
+                else:
+                    if position < high and self.ids[position] == last_id:
+                        position += 1
+                    low = position
+                    with_missing = False
+            else:
+                missing_after = last_id
+                if descending:
+                    high = low
+
+        positions = range(high - 1, low - 1, -1) if descending else range(low, high)
+        ids = map(self.ids.__getitem__, positions)
+        missing = _sorted_lazily(
+            self.missing if with_missing else (), task_ids, descending,
+            missing_after)
+        ordered = chain(ids, missing) if descending else chain(missing, ids)
+        return (task_id for task_id in ordered if task_id in task_ids)
+
+
+def _sorted_lazily(task_ids, candidates, descending, after=None):
+    # Only sorted once the walk gets past the tasks with a value
+    task_ids = candidates.intersection(task_ids)
+    if after is not None:
+        task_ids = {
+            task_id for task_id in task_ids
+            if (task_id < after if descending else task_id > after)
+        }
+    yield from sorted(task_ids, reverse=descending)
@@ -0,0 +1,189 @@
+import glob
+import os
+import pickle
+import struct
+import zlib
+
+
+FORMAT_VERSION = 1
+HEADER = struct.Struct('>II')
+
+
+class StateLogError(ValueError):
+    pass
+
+
+def encode_record(record):
+    payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(fileobj):
+    "yields records until the end of file or the first incomplete record"
+    while True:
+        header = fileobj.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        size, checksum = HEADER.unpack(header)
+        payload = fileobj.read(size)
+        if len(payload) < size or zlib.crc32(payload) != checksum:
+            # A partially written tail left by a crash
+            return
+        yield pickle.loads(payload)
+
+
+class SnapshotWriter:
+    """Writes a snapshot to a temporary file that replaces the snapshot once
+    it is closed.
+
+    Records can be written in several calls, by any thread.
+    """
+
+    def __init__(self, path, segment):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        # pylint: disable=consider-using-with
+        self.file = open(self.tmp_path, 'wb')
+        self.write([('header', {'version': FORMAT_VERSION,
+                                'segment': segment})])
+
+    def write(self, records):
+        self.file.write(b''.join(encode_record(record) for record in records))
+
+    def close(self):
+        "replaces the snapshot and returns its size"
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        return os.path.getsize(self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+class StateLog:
+    """Append-only log of state changes with periodic compaction.
+
+    Changes are appended to numbered segment files (``<path>.<n>.log``).
+    Compaction writes a snapshot of the full state (``<path>.snapshot``)
+    whose header records the first segment that is not covered by it, after
+    which older segments are deleted. Loading reads the snapshot and replays
+    the newer segments.
+    """
+
+    min_compaction_size = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.segment = None
+        self.segment_file = None
+        self.log_size = sum(
+            os.path.getsize(self.segment_path(number))
+            for number in self.segments())
+        self.snapshot_size = (
+            os.path.getsize(self.snapshot_path)
+            if os.path.exists(self.snapshot_path) else 0)
+
+    @property
+    def snapshot_path(self):
+        return f'{self.path}.snapshot'
+
+    def segment_path(self, number):
+        return f'{self.path}.{number:08d}.log'
+
+    def segments(self):
+        numbers = []
+        for filename in glob.glob(glob.escape(self.path) + '.*.log'):
+            number = filename[len(self.path) + 1:-len('.log')]
+            if number.isdigit():
+                numbers.append(int(number))
+        return sorted(numbers)
+
+    def exists(self):
+        return os.path.exists(self.snapshot_path) or bool(self.segments())
+
+    def read(self):
+        """Returns an iterator over the records of the last snapshot followed
+        by newer changes.
+
+        Segments are listed when this is called, segments started while the
+        records are being read are not replayed.
+        """
+        return self._read(self.segments())
+
+    def _read(self, segments):
+        first_segment = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as snapshot:
+                records = read_records(snapshot)
+                kind, header = next(records, (None, None))
+                if kind != 'header' or header.get('version') != FORMAT_VERSION:
+                    raise StateLogError(
+                        f"Unsupported state snapshot '{self.snapshot_path}'")
+                first_segment = header['segment']
+                yield from records
+
+        for number in segments:
+            if number >= first_segment:
+                with open(self.segment_path(number), 'rb') as segment:
+                    yield from read_records(segment)
+
+    def append(self, records):
+        if self.segment_file is None:
+            self.rotate()
+        data = b''.join(encode_record(record) for record in records)
+        self.segment_file.write(data)
+        self.segment_file.flush()
+        self.log_size += len(data)
+
+    def rotate(self):
+        "starts a new segment and returns its number"
+        if self.segment_file is not None:
+            self.segment_file.close()
+        segments = self.segments()
+        self.segment = (segments[-1] + 1) if segments else 0
+        # pylint: disable=consider-using-with
+        self.segment_file = open(self.segment_path(self.segment), 'ab')
+        return self.segment
+
+    def should_compact(self):
+        if not os.path.exists(self.snapshot_path):
+            return True
+        return self.log_size > max(self.snapshot_size,
+                                   self.min_compaction_size)
+
+    def open_snapshot(self, segment):
+        "returns a writer of a snapshot of the state preceding the segment"
+        return SnapshotWriter(self.snapshot_path, segment)
+
+    def write_snapshot(self, records, segment):
+        "writes a snapshot of the state preceding the given segment"
+        snapshot = self.open_snapshot(segment)
+        try:
+            for record in records:
+                snapshot.write([record])
+        except BaseException:
+            snapshot.abort()
+            raise
+        return snapshot.close()
+
+    def finish_compaction(self, segment, snapshot_size):
+        "deletes the segments covered by the snapshot"
+        for number in self.segments():
+            if number < segment:
+                os.remove(self.segment_path(number))
+        self.snapshot_size = snapshot_size
+        self.log_size = sum(
+            os.path.getsize(self.segment_path(number))
+            for number in self.segments())
+
+    def compact(self, records):
+        segment = self.rotate()
+        self.finish_compaction(segment, self.write_snapshot(records, segment))
+
+    def close(self):
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.segment_file = None
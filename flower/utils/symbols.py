@@ -0,0 +1,51 @@
+class SymbolTable:
+    """Interns strings as small integers.
+
+    Symbol ``0`` stands for ``None``. The table is meant for low cardinality
+    values such as task names, states and worker hostnames. Each encoding of
+    a value counts as a reference to its symbol, which holders drop with
+    release. The symbol of a value no longer referenced is freed and reused
+    for another value.
+    """
+
+    def __init__(self):
+        self.values = [None]
+        self.symbols = {None: 0}
+        self.refs = [0]
+        self.free_symbols = []
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def encode(self, value, refs=1):
+        "returns the symbol of the value, adding it if needed, and references it"
+        symbol = self.symbols.get(value)
+        if symbol is None:
+            if self.free_symbols:
+                symbol = self.free_symbols.pop()
+                self.values[symbol] = value
+            else:
+                symbol = len(self.values)
+                self.values.append(value)
+                self.refs.append(0)
+            self.symbols[value] = symbol
+        if symbol:
+            self.refs[symbol] += refs
+        return symbol
+
+    def release(self, symbol):
+        "drops a reference to the symbol, freeing it after the last one"
+        if not symbol:
+            return
+        self.refs[symbol] -= 1
+        if not self.refs[symbol]:
+            del self.symbols[self.values[symbol]]
+            self.values[symbol] = None
+            self.free_symbols.append(symbol)
+
+    def get(self, value):
+        "returns the symbol of the value, or None if it is unknown"
+        return self.symbols.get(value)
+
+    def decode(self, symbol):
+        return self.values[symbol]
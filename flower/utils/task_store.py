@@ -0,0 +1,456 @@
+import asyncio
+import logging
+import pickle
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+from .query import EXACT_FIELDS, And, MatchAll, Or, Term
+from .search import (SORTED_INDEX_FIELDS, TEXT_FIELDS, _kwargs_pairs,
+                     _kwargs_query_pair, _normalize, _sort_value)
+
+logger = logging.getLogger(__name__)
+
+# Columns holding normalized text, compared exactly by filters
+SYMBOL_COLUMNS = ('name', 'state', 'worker')
+# Sort keys of the search engine the store can order by, with the value
+# that stands for missing values
+SORT_COLUMNS = dict(
+    [(field, 0.0) for field in SORTED_INDEX_FIELDS] +
+    [('name', ''), ('state', '')])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    uuid TEXT NOT NULL UNIQUE,
+    name TEXT,
+    state TEXT,
+    worker TEXT,
+    received REAL,
+    started REAL,
+    timestamp REAL,
+    runtime REAL,
+    record BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_name ON tasks (name);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state);
+CREATE INDEX IF NOT EXISTS tasks_worker ON tasks (worker);
+CREATE INDEX IF NOT EXISTS tasks_received ON tasks (received);
+CREATE INDEX IF NOT EXISTS tasks_started ON tasks (started);
+CREATE INDEX IF NOT EXISTS tasks_timestamp ON tasks (timestamp);
+CREATE TABLE IF NOT EXISTS task_kwargs (
+    pair TEXT NOT NULL,
+    task INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS task_kwargs_pair ON task_kwargs (pair);
+CREATE INDEX IF NOT EXISTS task_kwargs_task ON task_kwargs (task);
+CREATE VIRTUAL TABLE IF NOT EXISTS task_text USING fts5(
+    uuid, name, state, worker, args, kwargs, result, tokenize='trigram');
+"""
+
+
+def task_store_path(url):
+    """Returns the database path of a ``sqlite:///path`` URL.
+
+    Raises ValueError for other URLs.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme != 'sqlite' or parsed.netloc or not parsed.path[1:]:
+        raise ValueError(f"Unsupported task store '{url}'")
+    return parsed.path[1:]
+
+
+def check_sqlite():
+    """Raises ValueError unless SQLite has FTS5 with the trigram tokenizer,
+    which came with SQLite 3.34."""
+    if sqlite3.sqlite_version_info < (3, 34):
+        raise ValueError(
+            f"SQLite 3.34 or later is required, found {sqlite3.sqlite_version}")
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute(
+            "CREATE VIRTUAL TABLE test USING fts5(value, tokenize='trigram')")
+    except sqlite3.Error as e:
+        raise ValueError(f"SQLite full text search is unavailable: {e}") from None
+    finally:
+        connection.close()
+
+
+def open_task_store(url, max_age=0):
+    return TaskStore(task_store_path(url), max_age)
+
+
+def _sort_terms(column):
+    "returns the SQL terms of the sort key, matching the sort indexes"
+    return [f'{column} IS NOT NULL',
+            f'coalesce({column}, {SORT_COLUMNS[column]!r})', 'uuid']
+
+
+def _phrase(value):
+    return '"' + value.replace('"', '""') + '"'
+
+
+def _translate(expression):
+    "returns the SQL condition and parameters of a search expression"
+    if isinstance(expression, MatchAll):
+        return '1', []
+    if isinstance(expression, Term):
+        value = _normalize(expression.value)
+        if expression.field in EXACT_FIELDS:
+            return f'{expression.field} = ?', [value]
+        kwargs_pair = (_kwargs_query_pair(value)
+                       if expression.field == 'kwargs' else None)
+        if kwargs_pair is not None:
+            return ('id IN (SELECT task FROM task_kwargs WHERE pair = ?)',
+                    [kwargs_pair])
+        match = _phrase(value)
+        if expression.field:
+            match = f'{expression.field} : {match}'
+        return ('id IN (SELECT rowid FROM task_text WHERE task_text MATCH ?)',
+                [match])
+    if isinstance(expression, (And, Or)):
+        operator = ' AND ' if isinstance(expression, And) else ' OR '
+        conditions, params = [], []
+        for child in expression.children:
+            condition, child_params = _translate(child)
+            conditions.append(f'({condition})')
+            params.extend(child_params)
+        return operator.join(conditions), params
+    raise TypeError(f'Unsupported search expression: {type(expression)!r}')
+
+
+def _where(expression, filters):
+    (task_type, worker, state, received_start, received_end,
+     started_start, started_end) = filters
+    condition, params = _translate(expression)
+    conditions = [condition]
+    for column, value in (('name', task_type), ('worker', worker),
+                          ('state', state)):
+        if value:
+            conditions.append(f'{column} = ?')
+            params.append(_normalize(value))
+    # Like the search engine, tasks without a value are kept
+    for column, operator, value in (
+            ('received', '>=', received_start), ('received', '<=', received_end),
+            ('started', '>=', started_start), ('started', '<=', started_end)):
+        if value is not None:
+            conditions.append(f'({column} IS NULL OR {column} {operator} ?)')
+            params.append(value)
+    return ' AND '.join(conditions), params
+
+
+@dataclass(frozen=True)
+class StoredResults:
+    "results of a search request in the task store"
+    # (sort key, task ID) pairs of the first matching tasks
+    keys: list
+    count: int
+    size: int
+    # IDs of tasks changed or queued before the search that weren't written
+    unstored: set
+
+    def count_unstored(self, task_ids):
+        """Returns the number of tasks among task_ids that aren't written
+        yet. Other tasks in memory are stored."""
+        return sum(1 for task_id in self.unstored if task_id in task_ids)
+
+
+class TaskStore:
+    """On-disk store of tasks in SQLite.
+
+    Tasks are written by a background thread in batched transactions, tasks
+    waiting to be written are kept in ``pending``. Text fields are indexed
+    in an FTS5 table with the trigram tokenizer, so the substring terms of
+    the search syntax become full text queries, and the filters and sort
+    keys of the search engine use regular indexes. Records of a task written
+    again are merged, newer fields replacing older ones.
+
+    IDs of tasks changed in memory since they were last queued are kept in
+    ``unflushed`` by the events state, which queues them periodically.
+    Reads use their own connection, the server makes them in the reader
+    thread with read. Tasks are only visible to searches once they are
+    written.
+
+    Tasks whose last event is older than ``max_age`` seconds are deleted,
+    when it is set. ``size`` counts the written tasks and is updated under
+    ``lock``.
+    """
+
+    batch_size = 500
+    prune_interval = 60
+
+    def __init__(self, path, max_age=0):
+        check_sqlite()
+        self.path = path
+        self.max_age = max_age
+        self.pruned = 0
+        self.connection = self._connect()
+        self.connection.executescript(SCHEMA)
+        for column in SORT_COLUMNS:
+            self.connection.execute(
+                f'CREATE INDEX IF NOT EXISTS tasks_sort_{column} ON tasks '
+                f'({", ".join(_sort_terms(column))})')
+        self.size = self.connection.execute(
+            'SELECT count(*) FROM tasks').fetchone()[0]
+        self.lock = threading.Lock()
+        # Task ID -> fields, for tasks that aren't written yet
+        self.pending = {}
+        # Insertion ordered, accessed only from the ioloop thread
+        self.unflushed = {}
+        self.queue = queue.Queue()
+        self.writer = None
+        self.reader = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='flower-task-store-reader')
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def __len__(self):
+        return self.size
+
+    def start(self):
+        self.writer = threading.Thread(
+            target=self._write_batches, name='flower-task-store', daemon=True)
+        self.writer.start()
+
+    def close(self):
+        "writes the pending tasks and closes the store"
+        if self.writer is not None:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+        self.reader.shutdown()
+        self.connection.close()
+
+    async def read(self, method, *args):
+        "calls a read method in the reader thread and returns its result"
+        return await asyncio.get_running_loop().run_in_executor(
+            self.reader, method, *args)
+
+    def touch(self, task_id):
+        "marks a task in memory as changed"
+        self.unflushed[task_id] = None
+
+    def take_unflushed(self, task_ids=None):
+        """Returns the IDs of the changed tasks, or of the changed tasks
+        among task_ids, and clears their changes."""
+        if task_ids is None:
+            task_ids, self.unflushed = list(self.unflushed), {}
+            return task_ids
+        return [task_id for task_id in task_ids
+                if self.unflushed.pop(task_id, False) is None]
+
+    def put(self, fields):
+        "queues the fields of a task record to be written"
+        self.put_many([fields])
+
+    def put_many(self, records):
+        "queues the fields of task records to be written together"
+        if not records:
+            return
+        with self.lock:
+            for fields in records:
+                self.pending[fields['uuid']] = fields
+        self.queue.put(records)
+
+    def flush(self, timeout=None):
+        "waits until the tasks queued so far are written"
+        written = threading.Event()
+        self.queue.put(written)
+        return written.wait(timeout)
+
+    def _write_batches(self):
+        connection = self._connect()
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [fields for item in batch if isinstance(item, list)
+                       for fields in item]
+            if records:
+                try:
+                    self._write(connection, records)
+                except sqlite3.Error:
+                    logger.exception("Failed to write %d tasks to '%s'",
+                                     len(records), self.path)
+                with self.lock:
+                    for fields in records:
+                        if self.pending.get(fields['uuid']) is fields:
+                            del self.pending[fields['uuid']]
+            if self.max_age and \
+                    time.time() - self.pruned >= self.prune_interval:
+                self._prune(connection)
+            for item in batch:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    item.set()
+        connection.close()
+
+    def _prune(self, connection):
+        "deletes the tasks whose last event is older than max_age"
+        cutoff = time.time() - self.max_age
+        expired = 'SELECT id FROM tasks WHERE timestamp < ?'
+        try:
+            with connection:
+                connection.execute(
+                    f'DELETE FROM task_text WHERE rowid IN ({expired})',
+                    (cutoff,))
+                connection.execute(
+                    f'DELETE FROM task_kwargs WHERE task IN ({expired})',
+                    (cutoff,))
+                removed = connection.execute(
+                    'DELETE FROM tasks WHERE timestamp < ?',
+                    (cutoff,)).rowcount
+        except sqlite3.Error:
+            logger.exception("Failed to prune tasks of '%s'", self.path)
+            return
+        with self.lock:
+            self.size -= removed
+        self.pruned = time.time()
+
+    def _write(self, connection, records):
+        added = 0
+        with connection:
+            for fields in records:
+                row = connection.execute(
+                    'SELECT id, record FROM tasks WHERE uuid = ?',
+                    (fields['uuid'],)).fetchone()
+                if row is not None:
+                    fields = self._merge(pickle.loads(row[1]), fields)
+                values = (
+                    [None if fields.get(column) is None
+                     else _normalize(fields[column])
+                     for column in SYMBOL_COLUMNS] +
+                    [_sort_value(fields.get(column))
+                     for column in SORTED_INDEX_FIELDS] +
+                    [pickle.dumps(fields, protocol=pickle.HIGHEST_PROTOCOL)])
+                if row is None:
+                    task_id = connection.execute(
+                        'INSERT INTO tasks (uuid, name, state, worker, '
+                        'received, started, timestamp, runtime, record) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        [fields['uuid']] + values).lastrowid
+                    added += 1
+                else:
+                    task_id = row[0]
+                    connection.execute(
+                        'UPDATE tasks SET name = ?, state = ?, worker = ?, '
+                        'received = ?, started = ?, timestamp = ?, '
+                        'runtime = ?, record = ? WHERE id = ?',
+                        values + [task_id])
+                    connection.execute(
+                        'DELETE FROM task_text WHERE rowid = ?', (task_id,))
+                    connection.execute(
+                        'DELETE FROM task_kwargs WHERE task = ?', (task_id,))
+                connection.execute(
+                    'INSERT INTO task_text (rowid, uuid, name, state, worker, '
+                    'args, kwargs, result) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [task_id] + [_normalize(fields.get(field))
+                                 for field in TEXT_FIELDS])
+                connection.executemany(
+                    'INSERT INTO task_kwargs (pair, task) VALUES (?, ?)',
+                    [(pair, task_id)
+                     for pair in _kwargs_pairs(fields.get('kwargs'))])
+        with self.lock:
+            self.size += added
+
+    @staticmethod
+    def _merge(stored, fields):
+        merged = dict(stored)
+        merged.update(fields)
+        merged['children'] = list(dict.fromkeys(
+            stored.get('children', []) + fields.get('children', [])))
+        return merged
+
+    def _select_chunks(self, columns, task_ids):
+        "yields the rows of the given tasks, a chunk of IDs at a time"
+        task_ids = list(task_ids)
+        for start in range(0, len(task_ids), self.batch_size):
+            chunk = task_ids[start:start + self.batch_size]
+            yield from self.connection.execute(
+                f'SELECT {columns} FROM tasks WHERE uuid IN '
+                f'({", ".join("?" * len(chunk))})', chunk)
+
+    def get_many(self, task_ids):
+        "returns the fields of the stored tasks among task_ids by ID"
+        with self.lock:
+            found = {task_id: self.pending[task_id] for task_id in task_ids
+                     if task_id in self.pending}
+        for task_id, record in self._select_chunks(
+                'uuid, record',
+                [task_id for task_id in task_ids if task_id not in found]):
+            found[task_id] = pickle.loads(record)
+        return found
+
+    def get(self, task_id):
+        "returns the fields of a stored task, or None"
+        return self.get_many([task_id]).get(task_id)
+
+    def recent_ids(self):
+        """Returns the IDs of the tasks that are changed or queued, and may
+        not be written yet."""
+        with self.lock:
+            recent = set(self.pending)
+        recent.update(self.unflushed)
+        return recent
+
+    def fetch(self, request, recent):
+        """Returns the StoredResults of a search request.
+
+        ``recent`` are IDs returned by recent_ids. Only the database is read,
+        so it can be called by the reader thread.
+        """
+        written = {task_id for task_id, in self._select_chunks('uuid', recent)}
+        return StoredResults(
+            self.search(request.expression, request.filters, request.sort_by,
+                        request.descending, request.after, request.count),
+            self.count(request.expression, request.filters),
+            self.size, recent - written)
+
+    def can_sort(self, sort_by):
+        return sort_by in SORT_COLUMNS
+
+    def count(self, expression, filters):
+        "returns the number of stored tasks matching the search"
+        if expression == MatchAll() and not any(
+                value is not None and value != '' for value in filters):
+            return self.size
+        where, params = _where(expression, filters)
+        return self.connection.execute(
+            f'SELECT count(*) FROM tasks WHERE {where}', params).fetchone()[0]
+
+    # pylint: disable=too-many-arguments
+    def search(self, expression, filters, sort_by, descending, after=None,
+               count=None):
+        """Returns the sort keys and IDs of the first count stored tasks
+        matching the search that come after the after key.
+
+        Keys are the keys the search engine sorts tasks in memory by.
+        """
+        where, params = _where(expression, filters)
+        terms = _sort_terms(sort_by)
+        key = ', '.join(terms)
+        if after is not None:
+            where += f" AND ({key}) {'<' if descending else '>'} (?, ?, ?)"
+            params.extend(after)
+        direction = ' DESC' if descending else ''
+        sql = (f'SELECT {key} FROM tasks WHERE {where} ORDER BY ' +
+               ', '.join(term + direction for term in terms))
+        if count is not None:
+            sql += ' LIMIT ?'
+            params.append(count)
+        rows = self.connection.execute(sql, params).fetchall()
+        return [((bool(has_value), value, task_id), task_id)
+                for has_value, value, task_id in rows]
@@ -1,36 +1,56 @@
 import datetime
 import time
 
+from ..metrics import get_prometheus_metrics
 
-# pylint: disable=too-many-branches,too-many-locals,too-many-arguments
-def iter_tasks(events, limit=None, offset=0, type=None, worker=None, state=None,
-               sort_by=None, received_start=None, received_end=None,
-               started_start=None, started_end=None, search=None):
-    descending = False
-    if sort_by is not None:
-        assert sort_by.lstrip('-') in SORT_KEYS
-        descending = sort_by.startswith('-')
-        sort_by = sort_by.lstrip('-')
-
-    page = search_tasks(
+
+# pylint: disable=too-many-arguments,too-many-locals
+async def iter_tasks(events, limit=None, offset=0, type=None, worker=None,
+                     state=None, sort_by=None, received_start=None,
+                     received_end=None, started_start=None, started_end=None,
+                     search=None, cursor=None):
+    sort_by, descending = parse_sort_by(sort_by)
+    page = await search_tasks(
         events, limit=limit, offset=offset, type=type, worker=worker,
         state=state, sort_by=sort_by, descending=descending,
         received_start=received_start, received_end=received_end,
         started_start=started_start, started_end=started_end,
-        search=search)
+        search=search, cursor=cursor)
+    return await page_tasks(events, page)
+
+
+def parse_sort_by(sort_by):
+    "returns the sort key and whether the order is descending"
+    if sort_by is None:
+        return None, False
+    assert sort_by.lstrip('-') in SORT_KEYS
+    return sort_by.lstrip('-'), sort_by.startswith('-')
+
+
+async def page_tasks(events, page):
+    "returns the (task id, task) pairs of a search page"
     task_map = getattr(events.state.tasks, 'data', events.state.tasks)
+    stored = await events.state.stored_tasks(
+        [task_id for task_id in page.task_ids if task_id not in task_map])
+    result = []
     for task_id in page.task_ids:
-        task = task_map.get(task_id)
+        task = task_map.get(task_id) or stored.get(task_id)
         if task is not None:
-            yield task_id, task
+            result.append((task_id, task))
+    return result
 
 
-def search_tasks(events, limit=None, offset=0, type=None, worker=None,
-                 state=None, sort_by=None, descending=False,
-                 received_start=None, received_end=None,
-                 started_start=None, started_end=None, search=None):
-    return events.state.search_engine.search(
-        events.state.tasks,
+async def search_tasks(events, limit=None, offset=0, type=None, worker=None,
+                       state=None, sort_by=None, descending=False,
+                       received_start=None, received_end=None,
+                       started_start=None, started_end=None, search=None,
+                       cursor=None):
+    store = events.state.task_store
+    if limit is None and store is not None:
+        # The stored history is unbounded, a search without a limit returns
+        # as many tasks as are kept in memory at most
+        limit = events.state.max_tasks_in_memory
+    request = events.state.search_engine.search_request(
         search or '',
         task_type=type,
         worker=worker,
@@ -42,7 +62,17 @@ def search_tasks(events, limit=None, offset=0, type=None, worker=None,
         sort_by=sort_by,
         descending=descending,
         offset=offset,
-        limit=limit)
+        limit=limit,
+        cursor=cursor)
+    stored = None
+    if store is not None and store.can_sort(request.sort_by):
+        # The database is read in the reader thread of the store, the
+        # tasks in memory are searched once it's done
+        stored = await store.read(store.fetch, request, store.recent_ids())
+    page = events.state.search_engine.search_page(
+        events.state.tasks, request, stored)
+    get_prometheus_metrics().search_cache.labels(page.cache).inc()
+    return page
 
 
 def _convert_datetime(value):
@@ -55,8 +85,11 @@ def _convert_datetime(value):
 SORT_KEYS = frozenset({'name', 'state', 'received', 'started'})
 
 
-def get_task_by_id(events, task_id):
-    return events.state.tasks.get(task_id)
+async def get_task_by_id(events, task_id):
+    task = events.state.tasks.get(task_id)
+    if task is None:
+        task = await events.state.stored_task(task_id)
+    return task
 
 
 def as_dict(task):
@@ -0,0 +1,149 @@
+import time
+from array import array
+
+# Values counted per time slot
+FIELDS = ('received', 'started', 'succeeded', 'failed', 'runtime')
+EVENT_FIELDS = {
+    'task-received': FIELDS.index('received'),
+    'task-started': FIELDS.index('started'),
+    'task-succeeded': FIELDS.index('succeeded'),
+    'task-failed': FIELDS.index('failed'),
+}
+RUNTIME_FIELD = FIELDS.index('runtime')
+WIDTH = len(FIELDS)
+ZEROS = array('d', bytes(8 * WIDTH))
+# Resolution name -> (seconds per slot, number of slots)
+RESOLUTIONS = {
+    'second': (1, 300),
+    'minute': (60, 180),
+}
+# Resolution whose buffers span the longest time
+LONGEST = max(RESOLUTIONS, key=lambda name: RESOLUTIONS[name][0] *
+              RESOLUTIONS[name][1])
+
+
+class RingBuffer:
+    """Sums of the FIELDS values over the latest time slots.
+
+    Slots of ``resolution`` seconds are kept in a flat array of doubles, the
+    slot of a timestamp at position ``slot % size``. A position is reset when
+    a newer slot takes it over, values of slots older than the one at their
+    position are dropped.
+    """
+
+    __slots__ = ('resolution', 'size', 'values', 'slots')
+
+    def __init__(self, resolution, size):
+        self.resolution = resolution
+        self.size = size
+        self.values = ZEROS * size
+        # Slot at each position, -1 for none
+        self.slots = array('q', [-1]) * size
+
+    def add(self, timestamp, field, runtime=0):
+        "counts an event of the field and adds its runtime"
+        slot = int(timestamp // self.resolution)
+        position = slot % self.size
+        start = position * WIDTH
+        current = self.slots[position]
+        if current != slot:
+            if slot < current:
+                return
+            self.values[start:start + WIDTH] = ZEROS
+            self.slots[position] = slot
+        values = self.values
+        values[start + field] += 1
+        if runtime:
+            values[start + RUNTIME_FIELD] += runtime
+
+    def last_slot(self):
+        return max(self.slots)
+
+    def series(self, last_slot):
+        "returns the values of each field for the size slots up to last_slot"
+        series = {field: [0] * self.size for field in FIELDS}
+        columns = [series[field] for field in FIELDS]
+        for index, slot in enumerate(
+                range(last_slot - self.size + 1, last_slot + 1)):
+            position = slot % self.size
+            if self.slots[position] == slot:
+                start = position * WIDTH
+                values = self.values[start:start + WIDTH]
+                for field, column, value in zip(FIELDS, columns, values):
+                    column[index] = value if field == 'runtime' else int(value)
+        return series
+
+
+class TaskTimeSeries:
+    """Ring buffers of task event counts and runtime sums, per task name
+    and per worker, at each of the RESOLUTIONS.
+
+    Adding an event updates a slot of each buffer of its task name and
+    worker. Series without events in the window of their largest
+    resolution are removed.
+    """
+
+    prune_interval = 60
+
+    def __init__(self):
+        # Name -> {resolution name: RingBuffer}
+        self.tasks = {}
+        self.workers = {}
+        self.pruned = time.time()
+
+    @staticmethod
+    def _buffers():
+        return {name: RingBuffer(resolution, size)
+                for name, (resolution, size) in RESOLUTIONS.items()}
+
+    def add(self, event, worker_name, task_name):
+        field = EVENT_FIELDS.get(event['type'])
+        if field is None:
+            return
+        timestamp = event.get('timestamp') or time.time()
+        runtime = event.get('runtime') or 0
+        for series, name in ((self.tasks, task_name),
+                             (self.workers, worker_name)):
+            if not name:
+                continue
+            buffers = series.get(name)
+            if buffers is None:
+                buffers = series[name] = self._buffers()
+            for buffer in buffers.values():
+                buffer.add(timestamp, field, runtime)
+        if timestamp - self.pruned >= self.prune_interval:
+            self.prune(timestamp)
+
+    def prune(self, now):
+        "removes the series without events in their largest window"
+        self.pruned = now
+        resolution, size = RESOLUTIONS[LONGEST]
+        oldest = int(now // resolution) - size
+        for series in (self.tasks, self.workers):
+            for key in [key for key, buffers in series.items()
+                        if buffers[LONGEST].last_slot() <= oldest]:
+                del series[key]
+
+    def query(self, resolution='minute', task_name=None, worker_name=None,
+              now=None):
+        """Returns the slot start times and the series of the task names and
+        workers, up to the current slot.
+
+        Raises KeyError for an unknown resolution.
+        """
+        seconds, size = RESOLUTIONS[resolution]
+        now = time.time() if now is None else now
+        last_slot = int(now // seconds)
+        result = {
+            'resolution': seconds,
+            'timestamps': [slot * seconds for slot in
+                           range(last_slot - size + 1, last_slot + 1)],
+        }
+        for key, series, name in (('tasks', self.tasks, task_name),
+                                  ('workers', self.workers, worker_name)):
+            result[key] = {
+                series_name: buffers[resolution].series(last_slot)
+                for series_name, buffers in sorted(series.items())
+                if name is None or series_name == name
+            }
+        return result
@@ -1,12 +1,34 @@
-import prometheus_client
-
 from ..views import BaseHandler
 
 
+def accepts_gzip(accept_encoding):
+    "returns whether an Accept-Encoding header accepts gzip"
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+    return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+
 class Metrics(BaseHandler):
     async def get(self):
-        self.application.purge_offline_worker_metrics()
-        self.write(prometheus_client.generate_latest())
+        compress = accepts_gzip(self.request.headers.get('Accept-Encoding', ''))
+        body = await self.application.metrics_cache.get(
+            self.application.options.metrics_cache_ttl,
+            self.application.purge_offline_worker_metrics,
+            compress=compress)
+        self.set_header("Vary", "Accept-Encoding")
+        if compress:
+            self.set_header("Content-Encoding", "gzip")
+        self.write(body)
         self.set_header("Content-Type", "text/plain")
 
 
@@ -3,8 +3,9 @@ import logging
 
 from tornado import web
 
-from ..utils.search import QuerySyntaxError
-from ..utils.tasks import as_dict, get_task_by_id, search_tasks
+from ..utils.query import QuerySyntaxError
+from ..utils.search_pages import CursorError
+from ..utils.tasks import as_dict, get_task_by_id, page_tasks, search_tasks
 from ..views import BaseHandler
 
 logger = logging.getLogger(__name__)
@@ -12,8 +13,8 @@ logger = logging.getLogger(__name__)
 
 class TaskView(BaseHandler):
     @web.authenticated
-    def get(self, task_id):
-        task = get_task_by_id(self.application.events, task_id)
+    async def get(self, task_id):
+        task = await get_task_by_id(self.application.events, task_id)
 
         if task is None:
             raise web.HTTPError(404, f"Unknown task '{task_id}'")
@@ -28,25 +29,34 @@ class TaskView(BaseHandler):
 class TasksDataTable(BaseHandler):
     @web.authenticated
     # pylint: disable=too-many-locals
-    def get(self):
+    async def get(self):
         app = self.application
         draw = self.get_argument('draw', type=int)
         start = self.get_argument('start', type=int)
         length = self.get_argument('length', type=int)
         search = self.get_argument('search[value]', type=str)
+        cursor = self.get_argument('cursor', None)
 
         column = self.get_argument('order[0][column]', type=int)
         sort_by = self.get_argument(f'columns[{column}][data]', type=str)
         sort_order = self.get_argument('order[0][dir]', type=str) == 'desc'
 
-        try:
-            page = search_tasks(
+        async def search_page(cursor):
+            return await search_tasks(
                 app.events,
                 search=search,
                 sort_by=sort_by,
                 descending=sort_order,
-                offset=start,
-                limit=length)
+                offset=0 if cursor else start,
+                limit=length,
+                cursor=cursor)
+
+        try:
+            try:
+                page = await search_page(cursor)
+            except CursorError:
+                # The cursor of a page with another search or order
+                page = await search_page(None)
         except QuerySyntaxError as exc:
             self.write(dict(
                 draw=draw,
@@ -57,12 +67,7 @@ class TasksDataTable(BaseHandler):
             return
 
         filtered_tasks = []
-        task_map = getattr(app.events.state.tasks, 'data', app.events.state.tasks)
-
-        for task_id in page.task_ids:
-            task = task_map.get(task_id)
-            if task is None:
-                continue
+        for task_id, task in await page_tasks(app.events, page):
             task_dict = as_dict(self.format_task((task_id, task))[1])
             if task_dict.get('worker'):
                 task_dict['worker'] = task_dict['worker'].hostname
@@ -71,7 +76,8 @@ class TasksDataTable(BaseHandler):
 
         self.write(dict(draw=draw, data=filtered_tasks,
                         recordsTotal=page.total_count,
-                        recordsFiltered=page.filtered_count))
+                        recordsFiltered=page.filtered_count,
+                        nextCursor=page.next_cursor))
 
     @web.authenticated
     def post(self):
@@ -0,0 +1,44 @@
+"""Compares updating the task metrics of events through labels() with
+updating them through the bound children of PrometheusMetrics.bind_task.
+
+    python -m tests.benchmark_metrics
+"""
+import timeit
+
+import flower.options  # noqa: F401, defines the histogram buckets
+from flower.metrics import get_prometheus_metrics
+
+WORKERS = [f'worker{i}' for i in range(10)]
+TASKS = [f'tasks.task{i}' for i in range(20)]
+LABELS = [(worker, task) for worker in WORKERS for task in TASKS]
+NUMBER = 20
+
+
+def with_labels(metrics):
+    for worker, task in LABELS:
+        metrics.events.labels(worker, 'task-succeeded', task).inc()
+        metrics.runtime.labels(worker, task).observe(0.1)
+        metrics.prefetch_time.labels(worker, task).set(0)
+
+
+def with_bound_children(metrics):
+    for worker, task in LABELS:
+        metrics.bind_task(worker, task, 'task-succeeded')[metrics.events].inc()
+        bound = metrics.bind_task(worker, task)
+        bound[metrics.runtime].observe(0.1)
+        bound[metrics.prefetch_time].set(0)
+
+
+def main():
+    metrics = get_prometheus_metrics()
+    updates = len(LABELS) * NUMBER
+    for function in (with_labels, with_bound_children):
+        function(metrics)
+        seconds = min(timeit.repeat(
+            lambda: function(metrics), number=NUMBER, repeat=5))
+        print(f'{function.__name__:>20}: '
+              f'{seconds / updates * 1e6:.2f} us per event')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import json
+
+from flower.events import EventsState
+from tests.unit.utils import (send_events, task_failed_events,
+                              task_succeeded_events)
+
+from . import BaseApiTestCase
+
+
+class TimeSeriesTests(BaseApiTestCase):
+    def setUp(self):
+        self.app = super().get_app()
+        super().setUp()
+
+    def get_app(self, capp=None):
+        return self.app
+
+    def test_timeseries(self):
+        state = EventsState()
+        events = task_succeeded_events(worker='worker1', name='task1', id='1')
+        events += task_failed_events(worker='worker2', name='task1', id='2')
+        send_events(state, events)
+        self.app.events.state = state
+
+        r = self.get('/api/stats/timeseries?resolution=second&taskname=task1')
+        self.assertEqual(200, r.code)
+        result = json.loads(r.body.decode('utf-8'))
+        self.assertEqual(1, result['resolution'])
+        self.assertEqual(300, len(result['timestamps']))
+        task = result['tasks']['task1']
+        self.assertEqual(2, sum(task['received']))
+        self.assertEqual(1, sum(task['succeeded']))
+        self.assertEqual(1, sum(task['failed']))
+        self.assertEqual(['worker1', 'worker2'], list(result['workers']))
+
+    def test_invalid_resolution(self):
+        r = self.get('/api/stats/timeseries?resolution=hour')
+        self.assertEqual(400, r.code)
@@ -3,6 +3,7 @@ import time
 from collections import OrderedDict
 from datetime import datetime, timedelta
 from unittest.mock import MagicMock, Mock, PropertyMock, patch
+from urllib.parse import urlencode
 
 import celery.states as states
 from celery.events import Event
@@ -10,8 +11,10 @@ from celery.result import AsyncResult
 from kombu.exceptions import OperationalError
 from tornado.options import options
 
+from flower.api.tasks import StandingQueries
 from flower.events import EventsState
-from tests.unit.utils import task_succeeded_events
+from tests.unit.utils import (send_events, task_failed_events,
+                              task_succeeded_events)
 
 from . import BaseApiTestCase
 
@@ -171,7 +174,7 @@ class TaskAbortTests(BaseApiTestCase):
 class MockTasks:
 
     @staticmethod
-    def get_task_by_id(events, task_id):
+    async def get_task_by_id(events, task_id):
         from celery.events.state import Task
         return Task()
 
@@ -306,3 +309,126 @@ class TaskTests(BaseApiTestCase):
             'Substring search terms must contain at least 3 characters '
             'at position 0.',
             error['error'])
+
+    def test_tasks_cursor_pagination(self):
+        state = EventsState()
+        events = []
+        for number in range(5):
+            events += task_succeeded_events(
+                worker='worker1', name=f'task{number}', id=str(number))
+        send_events(state, events)
+        self.app.events.state = state
+
+        names = []
+        cursor = None
+        for _ in range(3):
+            params = dict(limit=2, sort_by='-name')
+            if cursor:
+                params['cursor'] = cursor
+            r = self.get('/api/tasks?' + urlencode(params))
+            self.assertEqual(200, r.code)
+            table = json.loads(r.body.decode('utf-8'),
+                               object_pairs_hook=OrderedDict)
+            names += [task['name'] for task in table.values()]
+            cursor = r.headers.get('X-Next-Cursor')
+
+        self.assertEqual(['task4', 'task3', 'task2', 'task1', 'task0'], names)
+        self.assertIsNone(cursor)
+
+    def test_invalid_cursor(self):
+        r = self.get('/api/tasks?limit=2&cursor=invalid')
+
+        self.assertEqual(400, r.code)
+        error = json.loads(r.body.decode('utf-8'))
+        self.assertEqual('Invalid pagination cursor.', error['error'])
+
+
+class TaskStatsTests(BaseApiTestCase):
+    def setUp(self):
+        self.app = super().get_app()
+        super().setUp()
+
+    def get_app(self, capp=None):
+        return self.app
+
+    def test_task_stats(self):
+        state = EventsState()
+        events = []
+        for i, runtime in enumerate((1.0, 2.0, 3.0, 4.0)):
+            events += task_succeeded_events(
+                worker='worker1', name='task1', id=str(i), runtime=runtime)
+        events += task_succeeded_events(worker='worker1', name='task2',
+                                        id='5', runtime=0.5)
+        send_events(state, events)
+        self.app.events.state = state
+
+        stats = json.loads(self.get('/api/task/stats').body.decode('utf-8'))
+        self.assertEqual(['task1', 'task2'], list(stats))
+        self.assertEqual(4, stats['task1']['count'])
+        self.assertEqual(10.0, stats['task1']['sum'])
+        self.assertEqual(4.0, stats['task1']['max'])
+        self.assertAlmostEqual(2.0, stats['task1']['p50'], delta=0.02)
+        self.assertAlmostEqual(3.0, stats['task1']['p99'], delta=0.03)
+
+        stats = json.loads(self.get(
+            '/api/task/stats?taskname=task2').body.decode('utf-8'))
+        self.assertEqual(['task2'], list(stats))
+        self.assertEqual(0.5, stats['task2']['p95'])
+
+
+class StandingQueryTests(BaseApiTestCase):
+    def setUp(self):
+        self.app = super().get_app()
+        super().setUp()
+
+    def get_app(self, capp=None):
+        return self.app
+
+    def test_standing_query(self):
+        state = EventsState()
+        events = task_failed_events(worker='worker1', name='billing.charge',
+                                    id='1')
+        events += task_succeeded_events(worker='worker1', name='billing.charge',
+                                        id='2')
+        send_events(state, events)
+        self.app.events.state = state
+
+        r = self.post('/api/tasks/standing?' + urlencode(
+            {'query': 'state:FAILURE name:billing'}), body='')
+        self.assertEqual(200, r.code)
+        query = json.loads(r.body.decode('utf-8'))
+        self.assertEqual(1, query['count'])
+        self.assertEqual({'FAILURE': 1}, query['states'])
+
+        events = task_failed_events(worker='worker1', name='billing.refund',
+                                    id='3')
+        send_events(state, events)
+
+        r = self.get(f"/api/tasks/standing/{query['id']}?limit=1")
+        self.assertEqual(200, r.code)
+        result = json.loads(r.body.decode('utf-8'))
+        self.assertEqual(2, result['count'])
+        self.assertEqual(['3'], list(result['tasks']))
+        self.assertEqual('worker1', result['tasks']['3']['worker'])
+
+        r = self.get('/api/tasks/standing')
+        self.assertEqual([query['id']], list(json.loads(r.body.decode('utf-8'))))
+
+        r = self.fetch(f"/api/tasks/standing/{query['id']}", method='DELETE')
+        self.assertEqual(200, r.code)
+        r = self.get(f"/api/tasks/standing/{query['id']}")
+        self.assertEqual(404, r.code)
+
+    def test_invalid_standing_query(self):
+        r = self.post('/api/tasks/standing?query=ab', body='')
+
+        self.assertEqual(400, r.code)
+        error = json.loads(r.body.decode('utf-8'))
+        self.assertIn('at least 3 characters', error['error'])
+
+    def test_standing_query_limit(self):
+        with patch.object(StandingQueries, 'max_standing_queries', 1):
+            r = self.post('/api/tasks/standing?query=first', body='')
+            self.assertEqual(200, r.code)
+            r = self.post('/api/tasks/standing?query=second', body='')
+            self.assertEqual(400, r.code)
@@ -1,19 +1,29 @@
 import asyncio
+import multiprocessing
 import os
 import shelve
 import tempfile
-from unittest.mock import Mock
+import threading
+import time
+import unittest
+from unittest.mock import ANY, Mock, patch
 
+from celery.events import Event
 from kombu.exceptions import OperationalError
 from tornado.testing import AsyncTestCase, gen_test
 
-from flower.events import Events
+from flower.events import (EventBuffer, Events, EventsPublisher,
+                           EventsState, get_prometheus_metrics)
+from tests.unit.utils import (send_events, task_failed_events,
+                              task_succeeded_events)
 
 
 class PersistenceTests(AsyncTestCase):
-    def events(self, db):
-        return Events(Mock(), self.io_loop, db=db, persistent=True,
-                      enable_events=False)
+    def events(self, db, **kwargs):
+        events = Events(Mock(), self.io_loop, db=db, persistent=True,
+                        enable_events=False, **kwargs)
+        self.io_loop.run_sync(events.load_state)
+        return events
 
     def test_recovers_counters_and_continues_counting(self):
         with tempfile.TemporaryDirectory() as tmpdir:
@@ -43,6 +53,148 @@ class PersistenceTests(AsyncTestCase):
             self.assertEqual(
                 1, restored_again.state.counter['worker3']['task-received'])
 
+    def test_restores_tasks_workers_and_search_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = os.path.join(tmpdir, 'flower')
+            events = self.events(db)
+            send_events(events.state, task_succeeded_events(
+                'worker1', id='1', name='tasks.add'))
+            events.state.event(Event(
+                'worker-heartbeat', hostname='worker1', clock=4,
+                timestamp=time.time(), local_received=time.time(), freq=2))
+            events.save_state()
+
+            restored = self.events(db)
+            task = restored.state.tasks['1']
+
+            self.assertEqual('SUCCESS', task.state)
+            self.assertEqual('tasks.add', task.name)
+            self.assertIs(restored.state.workers['worker1'], task.worker)
+            self.assertEqual(events.state.workers['worker1'].heartbeats,
+                             task.worker.heartbeats)
+            self.assertEqual(['tasks.add'], restored.state.task_types())
+            self.assertEqual(
+                {'1'}, restored.state.search_engine.matching_ids('name:add'))
+            self.assertEqual(
+                ['1'], [uuid for uuid, _ in restored.state.tasks_by_time()])
+
+    def test_restores_compact_tasks(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = os.path.join(tmpdir, 'flower')
+            events = self.events(db, compact_tasks=True)
+            child = task_succeeded_events('worker1', id='2')
+            child[0]['parent_id'] = '1'
+            send_events(events.state,
+                        task_succeeded_events('worker1', id='1') + child)
+            events.save_state()
+
+            restored = self.events(db, compact_tasks=True)
+            task = restored.state.tasks.data['1']
+
+            self.assertEqual(list(events.state.tasks),
+                             list(restored.state.tasks))
+            self.assertEqual('SUCCESS', task.state)
+            self.assertEqual(['2'], task.as_dict()['children'])
+            self.assertEqual({}, restored.state.tasks.data.live)
+
+    def test_appends_changes_between_snapshots(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = os.path.join(tmpdir, 'flower')
+            events = Events(Mock(), self.io_loop, db=db, persistent=True,
+                            enable_events=False, max_tasks_in_memory=2)
+            events.save_state()
+            snapshot_size = os.path.getsize(db + '.snapshot')
+
+            for clock, uuid in enumerate(('1', '2', '3')):
+                events.state.event(Event(
+                    'task-received', uuid=uuid, name='tasks.add',
+                    hostname='worker1', clock=clock,
+                    local_received=time.time()))
+            events.save_state()
+            events.state_log.close()
+
+            self.assertEqual(snapshot_size, os.path.getsize(db + '.snapshot'))
+            restored = self.events(db)
+            self.assertEqual(['2', '3'], list(restored.state.tasks))
+            self.assertEqual(
+                3, restored.state.counter['worker1']['task-received'])
+
+    @gen_test
+    async def test_events_received_while_loading_take_precedence(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = os.path.join(tmpdir, 'flower')
+            events = Events(Mock(), self.io_loop, db=db, persistent=True,
+                            enable_events=False)
+            for clock, uuid in enumerate(('1', '2')):
+                events.state.event(Event(
+                    'task-received', uuid=uuid, name='tasks.add',
+                    hostname='worker1', clock=clock,
+                    local_received=time.time()))
+            events.save_state()
+
+            restored = Events(Mock(), self.io_loop, db=db, persistent=True,
+                              enable_events=False)
+            restored.restore_chunk_size = 1
+            loading = asyncio.ensure_future(restored.load_state())
+            await asyncio.sleep(0)
+            self.assertTrue(restored.loading)
+            restored.state.event(Event(
+                'task-failed', uuid='2', hostname='worker1', clock=3,
+                local_received=time.time(), exception='error'))
+            await loading
+
+            self.assertFalse(restored.loading)
+            self.assertEqual('FAILURE', restored.state.tasks['2'].state)
+            self.assertEqual('tasks.add', restored.state.tasks['2'].name)
+            self.assertEqual('RECEIVED', restored.state.tasks['1'].state)
+            self.assertEqual(
+                {'2'}, restored.state.search_engine.matching_ids('state:FAILURE'))
+            self.assertEqual(
+                {'task-received': 2, 'task-failed': 1},
+                dict(restored.state.counter['worker1']))
+            self.assertEqual(3, restored.state.event_count)
+
+    @gen_test
+    async def test_saves_while_loading_keep_the_persisted_counters(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = os.path.join(tmpdir, 'flower')
+            events = Events(Mock(), self.io_loop, db=db, persistent=True,
+                            enable_events=False)
+            for clock in range(50):
+                events.state.event(Event(
+                    'task-received', uuid=str(clock), name='tasks.add',
+                    hostname='w1', clock=clock, local_received=time.time()))
+            events.save_state()
+            events.state_log.close()
+
+            restored = Events(Mock(), self.io_loop, db=db, persistent=True,
+                              enable_events=False)
+            restored.restore_chunk_size = 5
+            loading = asyncio.ensure_future(restored.load_state())
+            await asyncio.sleep(0)
+            self.assertTrue(restored.loading)
+            restored.state.event(Event(
+                'task-succeeded', uuid='49', hostname='w1', clock=50,
+                local_received=time.time(), result='4', runtime=0.1))
+            await restored.save_state_in_background()
+            await loading
+
+            expected = {'task-received': 50, 'task-succeeded': 1}
+            self.assertEqual(expected, dict(restored.state.counter['w1']))
+            self.assertEqual(51, restored.state.event_count)
+            self.assertEqual('SUCCESS', restored.state.tasks['49'].state)
+
+            restored.save_state()
+            restored.state_log.close()
+            restored_again = Events(Mock(), self.io_loop, db=db,
+                                    persistent=True, enable_events=False)
+            await restored_again.load_state()
+            self.assertEqual(expected,
+                             dict(restored_again.state.counter['w1']))
+            self.assertEqual(51, restored_again.state.event_count)
+            self.assertEqual('SUCCESS',
+                             restored_again.state.tasks['49'].state)
+
     def test_loads_database_without_persisted_counters(self):
         with tempfile.TemporaryDirectory() as tmpdir:
             db = os.path.join(tmpdir, 'flower')
@@ -56,6 +208,531 @@ class PersistenceTests(AsyncTestCase):
             self.assertEqual({}, dict(restored.state.counter))
 
 
+class BackgroundSaveTests(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'flower')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def events(self):
+        return Events(Mock(), self.io_loop, db=self.db, persistent=True,
+                      enable_events=False)
+
+    async def restored_tasks(self):
+        events = self.events()
+        await events.load_state()
+        return list(events.state.tasks)
+
+    def receive_task(self, events, uuid):
+        events.state.event(Event(
+            'task-received', uuid=uuid, name='tasks.add', hostname='worker1',
+            clock=0, local_received=time.time()))
+
+    @gen_test
+    async def test_first_save_writes_a_snapshot(self):
+        events = self.events()
+        self.receive_task(events, '1')
+
+        await events.save_state_in_background()
+
+        metrics = get_prometheus_metrics()
+        self.assertFalse(events.compacting)
+        self.assertEqual(os.path.getsize(self.db + '.snapshot'),
+                         metrics.state_snapshot_size._value.get())
+        self.assertEqual([0], events.state_log.segments())
+        self.assertEqual(['1'], await self.restored_tasks())
+
+    @gen_test
+    async def test_appends_changes_after_the_snapshot(self):
+        events = self.events()
+        await events.save_state_in_background()
+        self.receive_task(events, '1')
+
+        with patch.object(events.state_log, 'compact') as compact:
+            await events.save_state_in_background()
+
+        compact.assert_not_called()
+        self.assertEqual(['1'], await self.restored_tasks())
+
+    @gen_test
+    async def test_failed_snapshot_keeps_the_log(self):
+        events = self.events()
+        self.receive_task(events, '1')
+        events.save_state()
+        self.receive_task(events, '2')
+        events.save_state()
+
+        with patch.object(events.state_log, 'should_compact', return_value=True), \
+                patch.object(events.state_log, 'open_snapshot',
+                             side_effect=OSError('disk full')), \
+                self.assertLogs('flower.events', level='ERROR'):
+            await events.save_state_in_background()
+
+        self.assertFalse(events.compacting)
+        self.assertEqual(['1', '2'], await self.restored_tasks())
+
+    @gen_test
+    async def test_restores_tasks_changed_while_writing_a_snapshot(self):
+        events = self.events()
+        events.snapshot_chunk_size = 1
+        self.receive_task(events, '1')
+        self.receive_task(events, '2')
+        open_snapshot = events.state_log.open_snapshot
+
+        def changing_snapshot(segment):
+            snapshot = open_snapshot(segment)
+            write = snapshot.write
+
+            def write_and_change(records):
+                if records and records[0][0] == 'task':
+                    # Applied on the ioloop before the next chunk is taken
+                    self.io_loop.add_callback(self.receive_task, events, '3')
+                    self.io_loop.add_callback(
+                        events.state.tasks.data.pop, '2')
+                write(records)
+
+            snapshot.write = write_and_change
+            return snapshot
+
+        with patch.object(events.state_log, 'open_snapshot',
+                          changing_snapshot):
+            await events.save_state_in_background()
+        events.save_state()
+
+        self.assertEqual(['1', '3'], await self.restored_tasks())
+
+
+class BatchingTests(AsyncTestCase):
+    def events(self, batch_size):
+        events = Events(Mock(), self.io_loop, enable_events=False,
+                        batch_size=batch_size)
+        events.state = Mock()
+        return events
+
+    def test_processes_events_in_batches(self):
+        events = self.events(batch_size=2)
+        with patch.object(self.io_loop, 'add_callback') as add_callback:
+            events.on_event({'type': 'worker-heartbeat'})
+            add_callback.assert_not_called()
+            events.on_event({'type': 'worker-heartbeat'})
+            events.on_event({'type': 'worker-heartbeat'})
+            add_callback.assert_called_once_with(events.flush_events)
+
+        events.flush_events()
+
+        self.assertEqual(2, events.state.event.call_count)
+        self.assertEqual(1, len(events.buffer))
+
+    def test_flush_reschedules_while_full_batches_are_waiting(self):
+        events = self.events(batch_size=1)
+        with patch.object(self.io_loop, 'add_callback') as add_callback:
+            events.on_event({'type': 'task-received'})
+            events.on_event({'type': 'task-started'})
+            add_callback.reset_mock()
+
+            events.flush_events()
+
+            add_callback.assert_called_once_with(events.flush_events)
+            self.assertEqual(1, len(events.buffer))
+
+    def test_failing_event_does_not_drop_the_batch(self):
+        events = self.events(batch_size=2)
+        events.state.event.side_effect = [ValueError('bad event'), None]
+        with patch.object(self.io_loop, 'add_callback'):
+            events.on_event({'type': 'task-received'})
+            events.on_event({'type': 'task-started'})
+
+        with self.assertLogs('flower.events', level='ERROR'):
+            events.flush_events()
+
+        self.assertEqual(2, events.state.event.call_count)
+
+    def test_stop_flushes_buffered_events(self):
+        events = self.events(batch_size=10)
+        events.on_event({'type': 'worker-heartbeat'})
+
+        events.stop()
+
+        events.state.event.assert_called_once_with({'type': 'worker-heartbeat'})
+
+
+class TasksMemoryTests(unittest.TestCase):
+    @staticmethod
+    def send(state, events, result=None):
+        for event in events:
+            if event['type'] == 'task-succeeded' and result is not None:
+                event['result'] = result
+        send_events(state, events)
+
+    def test_tracks_the_size_of_tasks(self):
+        state = EventsState()
+        self.send(state, task_succeeded_events('worker1', id='small'))
+        self.send(state, task_succeeded_events('worker1', id='large'),
+                  result='x' * 10000)
+
+        self.assertGreater(state.task_sizes['large'],
+                           state.task_sizes['small'] + 10000)
+        self.assertEqual(sum(state.task_sizes.values()), state.tasks_memory)
+        self.assertEqual(state.tasks_memory,
+                         get_prometheus_metrics().tasks_memory._value.get())
+
+        state.clear_tasks()
+        self.assertEqual({}, state.task_sizes)
+        self.assertEqual(0, state.tasks_memory)
+
+    def test_evicts_least_recently_used_finished_tasks(self):
+        for compact_tasks in (False, True):
+            with self.subTest(compact_tasks=compact_tasks):
+                state = EventsState(compact_tasks=compact_tasks,
+                                    max_tasks_memory=150000)
+                self.send(state, task_succeeded_events('worker1', id='running')[:2],
+                          result='x' * 10000)
+                for task_id in ('1', '2', '3', '4'):
+                    self.send(state, task_succeeded_events('worker1', id=task_id),
+                              result='x' * 10000)
+
+                self.assertEqual(['running', '3', '4'], list(state.tasks))
+                self.assertLessEqual(state.tasks_memory, 150000)
+                self.assertEqual(sum(state.task_sizes.values()),
+                                 state.tasks_memory)
+                self.assertEqual({'running', '3', '4'},
+                                 state.search_engine.matching_ids(''))
+
+    def test_keeps_tasks_without_a_budget(self):
+        state = EventsState()
+        for task_id in ('1', '2', '3'):
+            self.send(state, task_succeeded_events('worker1', id=task_id),
+                      result='x' * 10000)
+
+        self.assertEqual(['1', '2', '3'], list(state.tasks))
+
+
+class TaskRetentionTests(unittest.TestCase):
+    def test_expires_tasks_by_state(self):
+        state = EventsState(task_retention=['SUCCESS=60', 'FAILURE=3600'])
+        old = time.time() - 600
+        send_events(state, task_succeeded_events('worker1', id='success'),
+                    timestamp=old)
+        send_events(state, task_failed_events('worker1', id='failure'),
+                    timestamp=old)
+        send_events(state, task_succeeded_events('worker1', id='recent'))
+
+        self.assertEqual(['failure', 'recent'], list(state.tasks))
+        self.assertEqual({'failure', 'recent'},
+                         state.search_engine.matching_ids(''))
+        self.assertNotIn('success', state.task_sizes)
+
+    def test_keeps_failures_at_the_max_tasks_limit(self):
+        state = EventsState(max_tasks_in_memory=3,
+                            task_retention=['SUCCESS=600', 'FAILURE=86400'])
+        send_events(state, task_failed_events('worker1', id='failure'))
+        for task_id in ('1', '2', '3'):
+            send_events(state, task_succeeded_events('worker1', id=task_id))
+
+        self.assertEqual(['failure', '2', '3'], list(state.tasks))
+        self.assertEqual({'failure', '2', '3'},
+                         state.search_engine.matching_ids(''))
+
+    def test_evicts_shorter_retention_first_over_the_memory_budget(self):
+        state = EventsState(max_tasks_memory=10000,
+                            task_retention=['SUCCESS=600', 'FAILURE=86400'])
+        send_events(state, task_failed_events('worker1', id='failure'))
+        for task_id in ('1', '2', '3', '4'):
+            send_events(state, task_succeeded_events('worker1', id=task_id))
+
+        self.assertIn('failure', state.tasks)
+        self.assertNotIn('1', state.tasks)
+        self.assertLessEqual(state.tasks_memory, 10000)
+
+
+class BoundMetricsTests(unittest.TestCase):
+    def test_reuses_bound_children_until_workers_are_removed(self):
+        metrics = get_prometheus_metrics()
+        state = EventsState()
+        send_events(state, task_succeeded_events('bound-worker', id='1'))
+        counter = metrics.events.labels(
+            'bound-worker', 'task-succeeded', 'sometask')
+        bound = metrics.bind('bound-worker', 'task-succeeded', 'sometask')
+        self.assertIs(counter, bound[metrics.events])
+        self.assertEqual(1, counter._value.get())
+
+        send_events(state, task_succeeded_events('bound-worker', id='2'))
+        self.assertIs(bound, metrics.bind(
+            'bound-worker', 'task-succeeded', 'sometask'))
+        self.assertEqual(2, counter._value.get())
+
+        self.assertEqual(1, metrics.remove_workers({'bound-worker'}))
+        self.assertNotIn(('bound-worker', 'sometask'), metrics.bound)
+        send_events(state, task_succeeded_events('bound-worker', id='3'))
+        self.assertEqual(1, metrics.events.labels(
+            'bound-worker', 'task-succeeded', 'sometask')._value.get())
+
+
+class MetricsCardinalityTests(unittest.TestCase):
+    def setUp(self):
+        self.metrics = get_prometheus_metrics()
+        self.state = EventsState()
+
+    def tearDown(self):
+        self.metrics.configure()
+
+    def succeeded(self, worker, task_id, name='sometask'):
+        send_events(self.state,
+                    task_succeeded_events(worker, id=task_id, name=name))
+
+    def count(self, worker, task):
+        return self.metrics.events.labels(
+            worker, 'task-succeeded', task)._value.get()
+
+    def test_groups_workers_and_drops_labels(self):
+        self.metrics.configure(worker_pattern=r'^(\w+)-pod-',
+                               drop_labels=['task'])
+        self.succeeded('group-pod-a1', '1', name='tasks.add')
+        self.succeeded('group-pod-b2', '2', name='tasks.mul')
+        self.succeeded('lonely-worker', '3')
+
+        self.assertEqual(2, self.count('group', ''))
+        self.assertEqual(1, self.count('lonely-worker', ''))
+        self.assertGreater(self.metrics.runtime.labels(
+            'lonely-worker', '')._sum.get(), 0)
+
+    def test_counts_series_beyond_the_limit_as_overflow(self):
+        self.metrics.configure(max_series=1)
+        self.succeeded('capped-a', '1')
+        self.succeeded('capped-b', '2')
+        self.succeeded('capped-b', '3')
+
+        self.assertEqual(1, self.count('capped-a', 'sometask'))
+        self.assertEqual(2, self.count('overflow', 'overflow'))
+
+        self.metrics.remove_workers({'capped-a', 'capped-b', 'overflow'})
+        self.succeeded('capped-b', '4')
+        self.assertEqual(1, self.count('capped-b', 'sometask'))
+
+        self.metrics.count_series()
+        self.assertEqual(len(self.metrics.events._metrics),
+                         self.metrics.series_count.labels(
+                             'flower_events_total')._value.get())
+
+
+class EventBufferOverflowTests(unittest.TestCase):
+    @staticmethod
+    def heartbeat():
+        return {'type': 'worker-heartbeat', 'hostname': 'worker1'}
+
+    @staticmethod
+    def task_event(uuid):
+        return {'type': 'task-received', 'uuid': uuid, 'hostname': 'worker1'}
+
+    @staticmethod
+    def counter_value(metric, event_type):
+        return metric.labels(event_type)._value.get()
+
+    def test_rejects_unknown_policy(self):
+        with self.assertRaisesRegex(ValueError, 'Unknown events overflow policy'):
+            EventBuffer(1, maxsize=1, policy='drop-all')
+
+    def test_drop_heartbeats_makes_room_for_task_events(self):
+        metrics = get_prometheus_metrics()
+        dropped = self.counter_value(metrics.events_dropped, 'worker-heartbeat')
+        buffer = EventBuffer(10, maxsize=2, policy='drop-heartbeats')
+        buffer.put(self.heartbeat())
+        buffer.put(self.task_event('1'))
+
+        buffer.put(self.task_event('2'))
+        buffer.put(self.heartbeat())
+
+        batch, _ = buffer.drain()
+        self.assertEqual(['1', '2'], [event['uuid'] for event in batch])
+        self.assertEqual(0, buffer.heartbeats)
+        self.assertEqual(
+            dropped + 2,
+            self.counter_value(metrics.events_dropped, 'worker-heartbeat'))
+
+    def test_drop_heartbeats_drops_task_events_when_no_heartbeats_are_queued(self):
+        metrics = get_prometheus_metrics()
+        dropped = self.counter_value(metrics.events_dropped, 'task-received')
+        buffer = EventBuffer(10, maxsize=1, policy='drop-heartbeats')
+        buffer.put(self.task_event('1'))
+
+        buffer.put(self.task_event('2'))
+
+        self.assertEqual(1, len(buffer))
+        self.assertEqual(
+            dropped + 1,
+            self.counter_value(metrics.events_dropped, 'task-received'))
+
+    def test_sample_keeps_all_events_of_admitted_tasks(self):
+        metrics = get_prometheus_metrics()
+        sampled = self.counter_value(metrics.events_sampled, 'task-received')
+        buffer = EventBuffer(100, maxsize=100, policy='sample', sample_rate=2)
+        for _ in range(50):
+            buffer.put(self.heartbeat())
+
+        for uuid in map(str, range(40)):
+            buffer.put(self.task_event(uuid))
+        admitted = {
+            event['uuid'] for event in buffer.events
+            if event['type'] == 'task-received'
+        }
+        for uuid in map(str, range(40)):
+            buffer.put(dict(self.task_event(uuid), type='task-started'))
+
+        started = {
+            event['uuid'] for event in buffer.events
+            if event['type'] == 'task-started'
+        }
+        self.assertTrue(0 < len(admitted) < 40)
+        self.assertEqual(admitted, started)
+        self.assertEqual(
+            sampled + 40 - len(admitted),
+            self.counter_value(metrics.events_sampled, 'task-received'))
+
+    def test_block_waits_until_the_queue_is_drained(self):
+        buffer = EventBuffer(1, maxsize=1, policy='block')
+        buffer.put(self.task_event('1'))
+
+        producer = threading.Thread(
+            target=buffer.put, args=(self.task_event('2'),))
+        producer.start()
+        producer.join(0.05)
+        self.assertTrue(producer.is_alive())
+
+        buffer.drain()
+        producer.join(1)
+
+        self.assertFalse(producer.is_alive())
+        self.assertEqual('2', buffer.events[0]['uuid'])
+
+
+class EventsProcessTests(AsyncTestCase):
+    def publish(self, publisher, events):
+        send_events(Mock(event=publisher.on_event), events)
+
+    def test_publisher_sends_full_batches(self):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        publisher = EventsPublisher(sender, batch_size=3, flush_interval=100)
+
+        self.publish(publisher, task_succeeded_events(
+            worker='worker1', id='1', name='task1')[:2])
+        self.assertFalse(receiver.poll())
+        self.publish(publisher, [Event('task-succeeded', uuid='1',
+                                       result='4', hostname='worker1')])
+
+        records, summaries = receiver.recv()
+        (kind, worker), (task_kind, task) = records
+        self.assertEqual(('worker', 'worker1'), (kind, worker['hostname']))
+        self.assertEqual('task', task_kind)
+        self.assertEqual(('1', 'task1', 'SUCCESS', 'worker1'),
+                         (task['uuid'], task['name'], task['state'],
+                          task['worker']))
+        self.assertEqual(['task-received', 'task-started', 'task-succeeded'],
+                         [summary['type'] for summary in summaries])
+        self.assertNotIn('args', summaries[0])
+
+    def test_publisher_flushes_partial_batches(self):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        publisher = EventsPublisher(sender, batch_size=10, flush_interval=100)
+        self.publish(publisher, [Event('worker-heartbeat', hostname='worker1',
+                                       active=2)])
+
+        publisher.flush()
+
+        records, summaries = receiver.recv()
+        self.assertEqual([('worker', 'worker1')],
+                         [(kind, fields['hostname'])
+                          for kind, fields in records])
+        self.assertEqual([{'type': 'worker-heartbeat', 'hostname': 'worker1',
+                           'active': 2, 'timestamp': ANY}], summaries)
+
+    def changes(self, events):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        publisher = EventsPublisher(sender, batch_size=100, flush_interval=100)
+        self.publish(publisher, events)
+        publisher.flush()
+        return receiver.recv()
+
+    def test_state_applies_changes_of_the_process(self):
+        state = EventsState()
+
+        state.apply_changes(*self.changes(
+            task_succeeded_events(worker='worker1', id='1', name='task1') +
+            task_failed_events(worker='worker2', id='2', name='task1')))
+
+        self.assertEqual('SUCCESS', state.tasks['1'].state)
+        self.assertEqual('FAILURE', state.tasks['2'].state)
+        self.assertEqual('worker2', state.tasks['2'].worker.hostname)
+        self.assertEqual({'worker1', 'worker2'}, set(state.workers))
+        self.assertEqual((6, 2), (state.event_count, state.task_count))
+        self.assertEqual(1, state.counter['worker2']['task-failed'])
+        self.assertEqual({'2'},
+                         state.search_engine.matching_ids('state:FAILURE'))
+        self.assertEqual(['task1'], state.task_types())
+
+    def test_state_keeps_fields_missing_from_snapshots(self):
+        state = EventsState()
+        received, started, succeeded = task_succeeded_events(
+            worker='worker1', id='1', name='task1')
+        state.apply_changes(*self.changes([received, started]))
+
+        # Sent by a restarted process, which didn't receive the task
+        state.apply_changes(*self.changes([succeeded]))
+
+        task = state.tasks['1']
+        self.assertEqual(('task1', 'SUCCESS', '4'),
+                         (task.name, task.state, task.result))
+        self.assertEqual(1, len(state.tasks))
+
+    def test_state_links_children_of_snapshots(self):
+        state = EventsState()
+        parent = task_succeeded_events(worker='worker1', id='1')
+        child = task_succeeded_events(worker='worker1', id='2')
+        child[0]['parent_id'] = child[0]['root_id'] = '1'
+
+        state.apply_changes(*self.changes(child + parent))
+
+        self.assertEqual(['2'], [task.id for task in state.tasks['1'].children])
+
+    def events_with_pipe(self):
+        events = Events(Mock(), self.io_loop, enable_events=False,
+                        use_process=True)
+        events.state = Mock()
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        events.process = Mock(exitcode=1)
+        events.process_conn = receiver
+        self.io_loop.add_handler(
+            receiver.fileno(), events.on_process_events, self.io_loop.READ)
+        return events, sender
+
+    def test_applies_changes_received_from_the_process(self):
+        events, sender = self.events_with_pipe()
+        records, summaries = [('task', {'uuid': '1'})], [{'type': 'task-sent'}]
+        sender.send((records, summaries))
+
+        events.on_process_events(events.process_conn.fileno(), None)
+
+        events.state.apply_changes.assert_called_once_with(records, summaries)
+        events.stop()
+
+    def test_restarts_exited_process(self):
+        events, sender = self.events_with_pipe()
+        process = events.process
+        sender.close()
+
+        with self.assertLogs('flower.events', level='ERROR'):
+            events.on_process_events(events.process_conn.fileno(), None)
+
+        process.terminate.assert_called_once_with()
+        self.assertIsNone(events.process)
+        self.assertIsNotNone(events.process_restart)
+        events.stop()
+        self.assertIsNone(events.process_restart)
+
+
 class EnableEventsTests(AsyncTestCase):
     def setUp(self):
         super().setUp()
@@ -1,3 +1,4 @@
+import time
 import xml.etree.ElementTree as ET
 from html.parser import HTMLParser
 
@@ -68,3 +69,10 @@ def task_failed_events(worker, id=None, name=None):
             Event('task-started', uuid=id, hostname=worker),
             Event('task-failed', uuid=id, exception="KeyError('foo')",
                   traceback='line 1 at main', hostname=worker)]
+
+
+def send_events(state, events, **fields):
+    "applies the events to the state in order, with the fields set on each"
+    for clock, event in enumerate(events):
+        event.update(clock=clock, local_received=time.time(), **fields)
+        state.event(event)
@@ -0,0 +1,77 @@
+import random
+import unittest
+
+from flower.utils.bitmap import MAX_ARRAY_SIZE, Bitmap
+
+
+class TestBitmap(unittest.TestCase):
+    def test_add_discard_and_membership(self):
+        bitmap = Bitmap()
+        for value in (5, 70000, 3, 5):
+            bitmap.add(value)
+
+        self.assertEqual([3, 5, 70000], list(bitmap))
+        self.assertEqual(3, len(bitmap))
+        self.assertIn(70000, bitmap)
+        self.assertNotIn(4, bitmap)
+
+        bitmap.discard(70000)
+        bitmap.discard(4)
+        self.assertEqual([3, 5], list(bitmap))
+        self.assertEqual([0], list(bitmap.chunks))
+
+    def test_dense_chunks_become_bitsets_and_back(self):
+        bitmap = Bitmap(range(MAX_ARRAY_SIZE))
+        self.assertNotIsInstance(bitmap.chunks[0], bytearray)
+
+        bitmap.add(MAX_ARRAY_SIZE)
+        self.assertIsInstance(bitmap.chunks[0], bytearray)
+        self.assertEqual(MAX_ARRAY_SIZE + 1, len(bitmap))
+
+        for value in range(MAX_ARRAY_SIZE // 2 + 1):
+            bitmap.discard(value)
+        self.assertNotIsInstance(bitmap.chunks[0], bytearray)
+        self.assertEqual(
+            list(range(MAX_ARRAY_SIZE // 2 + 1, MAX_ARRAY_SIZE + 1)),
+            list(bitmap))
+
+    def test_bitsets_keep_their_length(self):
+        bitmap = Bitmap(range(0, 2 * MAX_ARRAY_SIZE + 1, 2))
+        self.assertIsInstance(bitmap.chunks[0], bytearray)
+
+        bitmap.add(2)
+        bitmap.add(3)
+        bitmap.discard(5)
+        bitmap.discard(4)
+        bitmap.discard(4)
+        self.assertEqual(MAX_ARRAY_SIZE + 1, len(bitmap))
+        self.assertEqual(len(list(bitmap)), len(bitmap))
+
+        other = Bitmap(range(MAX_ARRAY_SIZE, 3 * MAX_ARRAY_SIZE))
+        for result in (bitmap & other, bitmap | other, bitmap - other,
+                       other - bitmap, bitmap.copy()):
+            self.assertEqual(len(list(result)), len(result))
+
+    def test_set_operations_match_sets(self):
+        generator = random.Random(42)
+        for size in (10, 3000, 20000):
+            with self.subTest(size=size):
+                first = {generator.randrange(200000) for _ in range(size)}
+                second = {generator.randrange(200000) for _ in range(size)}
+
+                self.assertEqual(sorted(first & second),
+                                 list(Bitmap(first) & Bitmap(second)))
+                self.assertEqual(sorted(first | second),
+                                 list(Bitmap(first) | Bitmap(second)))
+                self.assertEqual(sorted(first - second),
+                                 list(Bitmap(first) - Bitmap(second)))
+
+    def test_operations_do_not_share_chunks(self):
+        first = Bitmap([1, 2])
+        result = first | Bitmap([70000])
+        result.add(3)
+
+        self.assertEqual([1, 2], list(first))
+        copy = first.copy()
+        copy.discard(1)
+        self.assertEqual([1, 2], list(first))
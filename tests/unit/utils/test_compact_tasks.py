@@ -0,0 +1,148 @@
+import unittest
+
+from celery.events import Event
+
+from flower.events import EventsState
+from flower.utils.compact_tasks import TaskRef
+from flower.utils.symbols import SymbolTable
+from tests.unit.utils import (send_events, task_failed_events,
+                              task_succeeded_events)
+
+
+class TestCompactTaskMap(unittest.TestCase):
+    def setUp(self):
+        self.state = EventsState(compact_tasks=True)
+        self.data = self.state.tasks.data
+
+    def test_stores_finished_tasks_in_columns(self):
+        send_events(self.state, task_succeeded_events('worker1', id='1',
+                                                      name='tasks.add'))
+        send_events(self.state, task_failed_events('worker1', id='2')[:2])
+
+        self.assertEqual(['1', '2'], list(self.state.tasks))
+        self.assertIsNotNone(self.data.rows['1'])
+        self.assertIsNone(self.data.rows['2'])
+        self.assertEqual({'2'}, set(self.data.live))
+
+    def test_materializes_the_same_task(self):
+        plain = EventsState()
+        events = (task_succeeded_events('worker1', id='1', name='tasks.add') +
+                  task_failed_events('worker1', id='2'))
+        for state in (plain, self.state):
+            send_events(state, [dict(event) for event in events])
+
+        for task_id in ('1', '2'):
+            expected = plain.tasks[task_id]
+            task = self.state.tasks[task_id]
+            for field in expected._fields:
+                if field not in ('worker', 'root', 'parent', 'children'):
+                    self.assertEqual(getattr(expected, field),
+                                     getattr(task, field), field)
+            self.assertIs(self.state.workers['worker1'], task.worker)
+            self.assertIs(self.state, task.cluster_state)
+
+    def test_updates_stored_tasks(self):
+        send_events(self.state, task_succeeded_events('worker1', id='1'))
+        send_events(self.state, [Event('task-received', uuid='1',
+                                       hostname='worker1', name='tasks.add',
+                                       timestamp=1.0)])
+
+        task = self.state.tasks['1']
+        self.assertEqual('SUCCESS', task.state)
+        self.assertEqual(1.0, task.received)
+        self.assertIsNotNone(self.data.rows['1'])
+        self.assertEqual({'1'}, self.state.search_engine.matching_ids(
+            'name:tasks.add'))
+
+    def test_evicts_least_recently_used_tasks(self):
+        self.state = EventsState(compact_tasks=True, max_tasks_in_memory=2)
+        for task_id in ('1', '2', '3'):
+            send_events(self.state,
+                        task_succeeded_events('worker1', id=task_id))
+
+        self.assertEqual(['2', '3'], list(self.state.tasks))
+        self.assertEqual({'2', '3'},
+                         self.state.search_engine.matching_ids(''))
+        self.assertEqual(2, len(self.state.tasks.data.details))
+
+    def test_accounts_stored_tasks_by_row_size(self):
+        state = EventsState()
+        for events_state in (state, self.state):
+            send_events(events_state, task_succeeded_events('worker1', id='1'))
+            send_events(events_state, task_succeeded_events('worker1', id='2')[:2])
+
+        self.assertLess(self.state.task_sizes['1'], state.task_sizes['1'] / 2)
+        self.assertEqual(sum(self.state.task_sizes.values()),
+                         self.state.tasks_memory)
+
+    def test_keeps_children_of_stored_tasks(self):
+        send_events(self.state, task_succeeded_events('worker1', id='parent'))
+        child = task_succeeded_events('worker1', id='child')
+        child[0]['parent_id'] = 'parent'
+        send_events(self.state, child)
+
+        parent = self.state.tasks['parent']
+        self.assertEqual({TaskRef('child')}, parent.children)
+        self.assertEqual(['child'], parent.as_dict()['children'])
+        self.assertEqual('parent', self.state.tasks['child'].parent_id)
+
+    def test_keeps_children_of_running_tasks(self):
+        parent = task_succeeded_events('worker1', id='parent')
+        send_events(self.state, parent[:2])
+        child = task_succeeded_events('worker1', id='child')
+        child[0]['parent_id'] = 'parent'
+        send_events(self.state, child)
+        send_events(self.state, parent[2:])
+
+        self.assertEqual({TaskRef('child')},
+                         self.state.tasks['parent'].children)
+
+    def test_pop_and_clear(self):
+        send_events(self.state, task_succeeded_events('worker1', id='1'))
+        send_events(self.state, task_succeeded_events('worker1', id='2'))
+
+        self.assertEqual('1', self.data.pop('1').uuid)
+        self.assertIsNone(self.data.pop('1', None))
+        self.assertEqual(1, len(self.data.free_rows))
+        self.state.clear_tasks()
+        self.assertEqual(0, len(self.state.tasks))
+
+    def test_releases_symbols_of_removed_tasks(self):
+        send_events(self.state, task_succeeded_events('worker1', id='1',
+                                                      name='tasks.add'))
+        send_events(self.state, task_succeeded_events('worker1', id='2',
+                                                      name='tasks.sub'))
+
+        self.data.pop('1')
+
+        self.assertIsNone(self.data.symbols.get('tasks.add'))
+        self.assertIsNotNone(self.data.symbols.get('tasks.sub'))
+        self.assertEqual('tasks.sub', self.state.tasks['2'].name)
+
+
+class TestSymbolTable(unittest.TestCase):
+    def test_encodes_values(self):
+        symbols = SymbolTable()
+
+        self.assertEqual(0, symbols.encode(None))
+        self.assertEqual(1, symbols.encode('SUCCESS'))
+        self.assertEqual(2, symbols.encode('FAILURE'))
+        self.assertEqual(1, symbols.encode('SUCCESS'))
+        self.assertEqual('FAILURE', symbols.decode(2))
+        self.assertIsNone(symbols.get('PENDING'))
+        self.assertEqual(3, len(symbols))
+
+    def test_releases_symbols_after_the_last_reference(self):
+        symbols = SymbolTable()
+        symbol = symbols.encode('SUCCESS')
+        symbols.encode('SUCCESS')
+
+        symbols.release(symbol)
+        self.assertEqual(symbol, symbols.get('SUCCESS'))
+        symbols.release(symbol)
+        self.assertIsNone(symbols.get('SUCCESS'))
+        self.assertEqual(1, len(symbols))
+        self.assertEqual(symbol, symbols.encode('FAILURE'))
+        self.assertEqual('FAILURE', symbols.decode(symbol))
+        symbols.release(0)
+        self.assertEqual(0, symbols.get(None))
@@ -0,0 +1,73 @@
+import unittest
+from types import SimpleNamespace
+
+from flower.utils.eviction import (LRUEvictionPolicy, RetentionEvictionPolicy,
+                                   parse_retention)
+
+
+def task(state, timestamp):
+    return SimpleNamespace(state=state, timestamp=timestamp)
+
+
+class TestParseRetention(unittest.TestCase):
+    def test_parses_states_and_seconds(self):
+        self.assertEqual({'SUCCESS': 600.0, 'FAILURE': 86400.0},
+                         parse_retention(['success=600', 'FAILURE=86400']))
+        self.assertEqual({}, parse_retention([]))
+
+    def test_rejects_invalid_values(self):
+        for value in ('SUCCESS', '=600', 'SUCCESS=soon', 'SUCCESS=-1'):
+            with self.subTest(value=value):
+                with self.assertRaisesRegex(ValueError, 'Invalid task retention'):
+                    parse_retention([value])
+
+
+class TestLRUEvictionPolicy(unittest.TestCase):
+    def test_victims_are_finished_tasks_in_update_order(self):
+        policy = LRUEvictionPolicy()
+        policy.touch('1', task('SUCCESS', 1000))
+        policy.touch('2', task('STARTED', 1000))
+        policy.touch('3', task('FAILURE', 1000))
+        policy.touch('1', task('SUCCESS', 1001))
+        policy.touch('2', task('SUCCESS', 1002))
+        policy.touch('3', task('RETRY', 1003))
+
+        self.assertEqual(['1', '2'], list(policy.victims(None)))
+        policy.forget('1')
+        self.assertEqual(['2'], list(policy.victims(None)))
+        self.assertIsNone(policy.make_room(None))
+
+
+class TestRetentionEvictionPolicy(unittest.TestCase):
+    def setUp(self):
+        self.policy = RetentionEvictionPolicy({'SUCCESS': 10, 'FAILURE': 100})
+
+    def test_expires_tasks_by_state(self):
+        self.policy.touch('1', task('SUCCESS', 1000))
+        self.policy.touch('2', task('FAILURE', 1000))
+        self.policy.touch('3', task('STARTED', 1000))
+
+        self.assertEqual([], self.policy.expired(1005))
+        self.assertEqual(['1'], self.policy.expired(1010))
+        self.assertEqual(['2'], self.policy.expired(1100))
+        self.assertEqual([], self.policy.expired(10 ** 9))
+
+    def test_updates_and_removals_replace_deadlines(self):
+        self.policy.touch('1', task('FAILURE', 1000))
+        self.policy.touch('1', task('SUCCESS', 1050))
+        self.policy.touch('2', task('SUCCESS', 1000))
+        self.policy.forget('2')
+
+        self.assertEqual([], self.policy.expired(1059))
+        self.assertEqual(['1'], self.policy.expired(1100))
+        self.assertEqual({}, self.policy.deadlines)
+        self.assertEqual(0, self.policy.stale)
+
+    def test_makes_room_with_finished_tasks_without_retention(self):
+        self.policy.touch('1', task('REVOKED', 1000))
+        self.policy.touch('2', task('SUCCESS', 1000))
+        self.policy.touch('3', task('REVOKED', 1000))
+
+        self.assertEqual(['2', '1', '3'], list(self.policy.victims(None)))
+        self.policy.forget('2')
+        self.assertEqual('1', self.policy.make_room(None))
@@ -1,13 +1,18 @@
 import pickle
 import time
 import unittest
+from collections import deque
 from types import SimpleNamespace
+from unittest.mock import patch
 
 from celery.events import Event
 
 from flower.events import EventsState
-from flower.utils.search import (And, MatchAll, Or, QuerySyntaxError,
+from flower.utils.bitmap import Bitmap
+from flower.utils.query import QuerySyntaxError
+from flower.utils.search import (And, MatchAll, Or, SearchDocument, SortedIndex,
                                  TaskSearchEngine, Term, parse_query)
+from flower.utils.search_pages import CursorError
 
 
 class TestQueryParser(unittest.TestCase):
@@ -218,6 +223,110 @@ class TestTaskSearchEngine(unittest.TestCase):
                          self.engine.matching_ids('kwargs:priority=high'))
         self.assertEqual({'3'}, self.engine.matching_ids('result:timeout'))
 
+    @staticmethod
+    def trigram_ids(engine):
+        return {
+            field: {
+                trigram: {engine.row_ids[row] for row in rows}
+                for trigram, rows in index.items()
+            }
+            for field, index in engine.trigram_postings.items()
+        }
+
+    def test_trigram_postings_follow_upserts_and_removals(self):
+        task = self.tasks['1']
+        task.state = 'SUCCESS'
+        task.result = 'completed'
+        self.engine.upsert(task)
+        self.engine.remove('2')
+
+        expected = TaskSearchEngine()
+        expected.rebuild(
+            (task_id, task) for task_id, task in self.tasks.items()
+            if task_id != '2')
+        self.assertEqual(self.trigram_ids(expected),
+                         self.trigram_ids(self.engine))
+        self.assertEqual(
+            {'3'}, self.trigram_ids(self.engine)['result']['tim'])
+
+    def test_substring_search_verifies_trigram_candidates(self):
+        self.engine.upsert(self.create_task(
+            '5', 'tasks.fetch', 'SUCCESS', 'worker-a', result='abcd bcde'))
+
+        self.assertEqual(set(), self.engine.matching_ids('result:abcde'))
+        self.assertEqual(set(), self.engine.matching_ids('abcde'))
+        self.assertEqual({'5'}, self.engine.matching_ids('"abcd bcd"'))
+
+    def test_substring_search_with_few_candidates(self):
+        self.assertEqual(
+            {'3'},
+            self.engine.matching_ids('customer', candidates={'3', '4'}))
+        self.assertEqual(
+            {'1'}, self.engine.matching_ids('fetch', candidates={'1'}))
+
+    def test_names_states_and_workers_are_symbols(self):
+        documents = self.engine.documents
+        symbols = self.engine.symbols
+
+        self.assertEqual(documents['1'].name, documents['3'].name)
+        self.assertEqual('tasks.fetch', symbols.decode(documents['1'].name))
+        self.assertEqual(
+            Bitmap([self.engine.rows['1'], self.engine.rows['3']]),
+            self.engine.exact_postings['worker'][symbols.get('worker-a')])
+        self.assertNotIn('worker', self.engine.trigram_postings)
+        self.assertNotIn('worker-a', documents['1'].all_text)
+
+    def test_symbols_of_removed_documents_are_released(self):
+        symbols = self.engine.symbols
+        size = len(symbols.values)
+        self.engine.remove('2')
+        self.engine.upsert(self.create_task('4', 'tasks.report', 'FAILURE', None))
+
+        self.assertIsNone(symbols.get('tasks.store'))
+        self.assertIsNone(symbols.get('worker-b'))
+        self.assertIsNone(symbols.get('success'))
+        self.engine.upsert(self.create_task('5', 'tasks.store', 'PENDING', 'worker-c'))
+        self.assertEqual(size, len(symbols.values))
+        self.assertEqual({'5'}, self.engine.matching_ids('name:store'))
+        self.assertEqual({'1', '4'}, self.engine.matching_ids('state:FAILURE'))
+
+    def test_substring_search_on_symbols(self):
+        self.assertEqual({'1', '3'}, self.engine.matching_ids('name:etc'))
+        self.assertEqual({'1', '3'}, self.engine.matching_ids('er-a'))
+        self.assertEqual(
+            {'1'}, self.engine.matching_ids('er-a', candidates={'1', '2'}))
+        self.assertEqual({'2', '4'}, self.engine.matching_ids('success'))
+
+    def test_load_translates_symbols(self):
+        engine = TaskSearchEngine()
+        engine.upsert(self.create_task('5', 'tasks.other', 'SUCCESS', 'worker-c'))
+
+        engine.load(self.engine.dump())
+
+        self.assertEqual({'1', '3'}, engine.matching_ids('name:fetch'))
+        self.assertEqual({'2', '4', '5'}, engine.matching_ids('state:SUCCESS'))
+        self.assertEqual(['1', '3'], engine.search(
+            self.tasks, worker='worker-a', sort_by='uuid').task_ids)
+
+    def test_rows_of_removed_documents_are_reused(self):
+        row = self.engine.rows['2']
+        self.engine.remove('2')
+        self.engine.upsert(self.create_task('5', 'tasks.store', 'SUCCESS', 'worker-b'))
+
+        self.assertEqual(row, self.engine.rows['5'])
+        self.assertEqual(4, len(self.engine.row_ids))
+        self.assertEqual({'4', '5'}, self.engine.matching_ids('state:SUCCESS'))
+
+    def test_load_keeps_free_rows(self):
+        self.engine.remove('2')
+        engine = TaskSearchEngine()
+        engine.load(self.engine.dump())
+        engine.upsert(self.create_task('5', 'tasks.store', 'SUCCESS', 'worker-b'))
+
+        self.assertEqual(self.engine.rows['1'], engine.rows['1'])
+        self.assertEqual(4, len(engine.row_ids))
+        self.assertEqual({'4', '5'}, engine.matching_ids('state:SUCCESS'))
+
     def test_rebuild_removes_stale_documents_and_postings(self):
         self.engine.rebuild([('4', self.tasks['4'])])
 
@@ -230,6 +339,8 @@ class TestTaskSearchEngine(unittest.TestCase):
         self.tasks['1'].started = 20
         self.tasks['3'].received = 30
         self.tasks['3'].started = 40
+        for task_id in ('1', '3'):
+            self.engine.upsert(self.tasks[task_id])
 
         page = self.engine.search(
             self.tasks,
@@ -250,6 +361,54 @@ class TestTaskSearchEngine(unittest.TestCase):
         self.assertEqual(4, page.filtered_count)
         self.assertEqual(4, page.total_count)
 
+    def test_dump_and_load_restore_the_index(self):
+        engine = TaskSearchEngine()
+
+        self.assertEqual(set(self.tasks), engine.load(self.engine.dump()))
+
+        self.assertEqual({'1', '3'}, engine.matching_ids('kwargs:priority=high'))
+        self.assertEqual({'1'}, engine.matching_ids('state:FAILURE'))
+        self.assertEqual({'1', '3'}, engine.matching_ids('result:timeout'))
+        self.assertEqual({'2', '4'}, engine.matching_ids('state:SUCCESS OR hello'))
+        self.assertEqual(self.trigram_ids(self.engine), self.trigram_ids(engine))
+
+    def test_dump_of_a_copy_ignores_later_changes(self):
+        index = self.engine.copy_index()
+        self.engine.remove('1')
+        self.engine.upsert(self.create_task('2', 'tasks.fetch', 'FAILURE', 'worker-a'))
+        engine = TaskSearchEngine()
+
+        self.assertEqual(set(self.tasks), engine.load(self.engine.dump(index)))
+
+        self.assertEqual({'1'}, engine.matching_ids('state:FAILURE'))
+        self.assertEqual({'2', '4'}, engine.matching_ids('state:SUCCESS'))
+
+    def test_load_keeps_existing_documents(self):
+        dump = self.engine.dump()
+        engine = TaskSearchEngine()
+        task = self.create_task('1', 'tasks.fetch', 'SUCCESS', 'worker-a')
+        engine.upsert(task)
+
+        self.assertEqual({'2', '3', '4'}, engine.load(dump))
+
+        self.assertEqual(set(), engine.matching_ids('state:FAILURE'))
+        self.assertEqual({'1', '2', '4'}, engine.matching_ids('state:SUCCESS'))
+
+    def test_load_rejects_invalid_dumps(self):
+        dump = self.engine.dump()
+        invalid_dumps = [
+            dict(dump, version=dump['version'] + 1),
+            dict(dump, checksum=dump['checksum'] + 1),
+            dict(dump, data=dump['data'][:-1]),
+            None,
+        ]
+
+        for invalid_dump in invalid_dumps:
+            with self.subTest(dump=invalid_dump):
+                engine = TaskSearchEngine()
+                self.assertIsNone(engine.load(invalid_dump))
+                self.assertEqual({}, engine.documents)
+
     def test_queries_return_expected_tasks(self):
         expected_results = {
             'customer': {'1', '2', '3'},
@@ -265,6 +424,393 @@ class TestTaskSearchEngine(unittest.TestCase):
                 self.assertEqual(expected, self.engine.matching_ids(query))
 
 
+class TestFieldLimits(unittest.TestCase):
+    def setUp(self):
+        self.tasks = {
+            '1': SimpleNamespace(
+                uuid='1', name='tasks.fetch', state='SUCCESS', worker=None,
+                args="('short',)", kwargs={'priority': 'high'},
+                result='header ' + 'x' * 100 + ' trailer'),
+            '2': SimpleNamespace(
+                uuid='2', name='tasks.fetch', state='SUCCESS', worker=None,
+                args="('" + 'y' * 100 + "',)", kwargs={'priority': 'low'},
+                result='header'),
+        }
+
+    def engine(self, **kwargs):
+        engine = TaskSearchEngine(**kwargs)
+        engine.rebuild(self.tasks.items())
+        return engine
+
+    def test_long_fields_are_truncated(self):
+        engine = self.engine(max_field_length=20)
+        document = engine.documents['1']
+
+        self.assertEqual(('result',), document.truncated)
+        self.assertEqual(20, len(document.result))
+        self.assertNotIn('header', document.all_text)
+        self.assertEqual({'1', '2'}, engine.matching_ids('result:header'))
+        self.assertEqual(set(), engine.matching_ids('result:trailer'))
+        self.assertEqual({'2'}, engine.matching_ids('header'))
+        self.assertEqual({'1'}, engine.matching_ids('short'))
+
+    def test_truncated_kwargs_have_no_pairs(self):
+        self.tasks['1'].kwargs = {'priority': 'high', 'data': 'z' * 100}
+        engine = self.engine(max_field_length=20)
+
+        self.assertEqual(set(), engine.matching_ids('kwargs:priority=high'))
+        self.assertEqual({'1', '2'}, engine.matching_ids('kwargs:priority'))
+        self.assertEqual({'2'}, engine.matching_ids('kwargs:priority=low'))
+
+    def test_excluded_fields_are_not_indexed(self):
+        engine = self.engine(excluded_fields=['args', 'kwargs'])
+
+        self.assertEqual(set(), engine.matching_ids('args:short'))
+        self.assertEqual(set(), engine.matching_ids('short'))
+        self.assertEqual(set(), engine.matching_ids('kwargs:priority=high'))
+        self.assertEqual({}, engine.trigram_postings['args'])
+        self.assertEqual({'1', '2'}, engine.matching_ids('result:header'))
+
+    def test_unknown_excluded_fields_are_rejected(self):
+        with self.assertRaisesRegex(ValueError, 'name'):
+            TaskSearchEngine(excluded_fields=['name'])
+
+    def test_load_rejects_dumps_with_other_settings(self):
+        dump = self.engine(max_field_length=20).dump()
+
+        self.assertIsNone(TaskSearchEngine().load(dump))
+        self.assertEqual(
+            {'1', '2'}, TaskSearchEngine(max_field_length=20).load(dump))
+
+
+class TestSortedIndexes(unittest.TestCase):
+    def setUp(self):
+        self.tasks = {}
+        for number in range(200):
+            task_id = f'{number:03d}'
+            self.tasks[task_id] = SimpleNamespace(
+                uuid=task_id, name='tasks.add', state='SUCCESS', worker=None,
+                args='()', kwargs='{}', result=None,
+                received=None if number % 7 == 0 else number % 50,
+                started=None if number % 3 == 0 else number % 40,
+                timestamp=number % 60, runtime=None)
+        self.engine = TaskSearchEngine()
+        self.engine.rebuild(self.tasks.items())
+
+    def expected_ids(self, received_start=None, received_end=None,
+                     started_start=None, started_end=None):
+        def in_range(value, start, end):
+            return value is None or (
+                (start is None or value >= start) and
+                (end is None or value <= end))
+
+        return {
+            task_id for task_id, task in self.tasks.items()
+            if in_range(task.received, received_start, received_end)
+            and in_range(task.started, started_start, started_end)
+        }
+
+    def test_sorted_index_orders_by_value_and_id(self):
+        index = SortedIndex()
+        for task_id, value in [('b', 2.0), ('a', 2.0), ('c', 1.0), ('d', None)]:
+            index.add(task_id, value)
+        index.remove('a', 2.0)
+        index.remove('missing', 2.0)
+
+        self.assertEqual(['c', 'b'], index.ids)
+        self.assertEqual([1.0, 2.0], index.values)
+        self.assertEqual(['d', 'c', 'b'],
+                         list(index.ordered_ids({'b', 'c', 'd'})))
+        self.assertEqual(['b', 'd'],
+                         list(index.ordered_ids({'b', 'd'}, descending=True)))
+
+    def test_time_ranges(self):
+        ranges = [
+            {'received_start': 10, 'received_end': 12},
+            {'received_start': 5},
+            {'received_end': 48},
+            {'started_start': 39},
+            {'received_start': 10, 'started_end': 20},
+        ]
+
+        for time_range in ranges:
+            with self.subTest(**time_range):
+                page = self.engine.search(self.tasks, **time_range)
+                self.assertEqual(self.expected_ids(**time_range),
+                                 set(page.task_ids))
+
+    def test_time_ranges_of_small_candidate_sets(self):
+        self.tasks['010'].state = 'FAILURE'
+        self.engine.upsert(self.tasks['010'])
+
+        page = self.engine.search(
+            self.tasks, state='FAILURE', received_start=5, started_end=30)
+
+        self.assertEqual(['010'], page.task_ids)
+
+    def test_pages_match_a_full_sort(self):
+        def key(task_id):
+            value = getattr(self.tasks[task_id], sort_by)
+            return value is not None, value or 0, task_id
+
+        for sort_by in ('received', 'started', 'timestamp'):
+            for descending in (False, True):
+                ordered = sorted(self.tasks, key=key, reverse=descending)
+                for offset, limit in ((0, 10), (45, 20), (190, 20)):
+                    with self.subTest(sort_by=sort_by, descending=descending,
+                                      offset=offset):
+                        page = self.engine.search(
+                            self.tasks, sort_by=sort_by, descending=descending,
+                            offset=offset, limit=limit)
+                        self.assertEqual(ordered[offset:offset + limit],
+                                         page.task_ids)
+
+    def test_cursor_pages_match_a_full_sort(self):
+        def key(task_id):
+            value = getattr(self.tasks[task_id], sort_by)
+            if sort_by == 'name':
+                return value, task_id
+            return value is not None, value or 0, task_id
+
+        for sort_by in ('received', 'started', 'name'):
+            for descending in (False, True):
+                for query in ('', 'name:add'):
+                    ordered = sorted(self.tasks, key=key, reverse=descending)
+                    with self.subTest(sort_by=sort_by, descending=descending,
+                                      query=query):
+                        task_ids = []
+                        cursor = None
+                        while True:
+                            page = self.engine.search(
+                                self.tasks, query, sort_by=sort_by,
+                                descending=descending, limit=30,
+                                cursor=cursor)
+                            task_ids += page.task_ids
+                            cursor = page.next_cursor
+                            if cursor is None:
+                                break
+                        self.assertEqual(ordered, task_ids)
+
+    def test_cursor_of_a_small_filtered_set(self):
+        first = self.engine.search(
+            self.tasks, received_start=45, received_end=46,
+            sort_by='received', limit=2)
+        second = self.engine.search(
+            self.tasks, received_start=45, received_end=46,
+            sort_by='received', limit=100, cursor=first.next_cursor)
+
+        self.assertEqual(
+            sorted(self.expected_ids(received_start=45, received_end=46),
+                   key=lambda task_id: (self.tasks[task_id].received is not None,
+                                        self.tasks[task_id].received or 0,
+                                        task_id)),
+            first.task_ids + second.task_ids)
+        self.assertIsNone(second.next_cursor)
+
+    def test_cursor_must_match_the_search(self):
+        cursor = self.engine.search(
+            self.tasks, sort_by='received', limit=10).next_cursor
+        searches = [
+            dict(sort_by='received', descending=True),
+            dict(sort_by='started'),
+            dict(sort_by='received', state='SUCCESS'),
+        ]
+
+        for search in searches:
+            with self.subTest(**search):
+                with self.assertRaises(CursorError):
+                    self.engine.search(
+                        self.tasks, limit=10, cursor=cursor, **search)
+        for cursor in ('invalid', 'W10=', cursor[:-4]):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(CursorError):
+                    self.engine.search(
+                        self.tasks, sort_by='received', limit=10,
+                        cursor=cursor)
+
+    def test_upsert_moves_the_task_in_the_index(self):
+        task = self.tasks['001']
+        task.timestamp = 1000
+        self.engine.upsert(task)
+
+        page = self.engine.search(self.tasks, limit=1)
+
+        self.assertEqual(['001'], page.task_ids)
+        self.assertEqual(200, len(self.engine.sorted_indexes['timestamp']))
+
+    def test_dump_and_load_keep_the_indexes(self):
+        engine = TaskSearchEngine()
+        engine.load(self.engine.dump())
+
+        for field, index in self.engine.sorted_indexes.items():
+            with self.subTest(field=field):
+                loaded = engine.sorted_indexes[field]
+                self.assertEqual(index.ids, loaded.ids)
+                self.assertEqual(index.values, loaded.values)
+                self.assertEqual(index.missing, loaded.missing)
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.tasks = {
+            str(number): SimpleNamespace(
+                uuid=str(number), name='tasks.add',
+                state='FAILURE' if number % 2 else 'SUCCESS', worker=None,
+                args='()', kwargs='{}', result=None, received=number,
+                started=None, timestamp=number, runtime=None)
+            for number in range(10)
+        }
+        self.engine = TaskSearchEngine()
+        self.engine.rebuild(self.tasks.items())
+
+    def search(self, query='state:FAILURE', **kwargs):
+        return self.engine.search(self.tasks, query, **kwargs)
+
+    def test_repeated_search_hits_the_cache(self):
+        first = self.search(sort_by='received', limit=2)
+        second = self.search(sort_by='received', descending=True, limit=2)
+
+        self.assertEqual('miss', first.cache)
+        self.assertEqual('hit', second.cache)
+        self.assertEqual(['9', '7'], second.task_ids)
+        self.assertEqual(5, second.filtered_count)
+
+    def test_changes_patch_the_cached_result(self):
+        self.search()
+        self.tasks['0'].state = 'FAILURE'
+        self.tasks['1'].state = 'SUCCESS'
+        self.engine.upsert(self.tasks['0'])
+        self.engine.upsert(self.tasks['1'])
+        self.engine.remove('3')
+        del self.tasks['3']
+
+        page = self.search()
+
+        self.assertEqual('patch', page.cache)
+        self.assertEqual({'0', '5', '7', '9'}, set(page.task_ids))
+        self.assertEqual('hit', self.search().cache)
+
+    def test_filters_are_part_of_the_key(self):
+        self.search()
+
+        page = self.search(received_start=5)
+
+        self.assertEqual('miss', page.cache)
+        self.assertEqual({'5', '7', '9'}, set(page.task_ids))
+
+    def test_result_is_recomputed_past_the_change_log(self):
+        self.engine.change_log = deque(maxlen=1)
+        self.search()
+        self.tasks['0'].state = 'FAILURE'
+        self.engine.upsert(self.tasks['0'])
+        self.engine.upsert(self.tasks['2'])
+
+        page = self.search()
+
+        self.assertEqual('miss', page.cache)
+        self.assertEqual({'0', '1', '3', '5', '7', '9'}, set(page.task_ids))
+
+    def test_least_recently_used_results_are_evicted(self):
+        self.engine.result_cache_size = 2
+        self.search('state:FAILURE')
+        self.search('state:SUCCESS')
+        self.search('state:FAILURE')
+        self.search('name:add')
+
+        self.assertEqual('hit', self.search('state:FAILURE').cache)
+        self.assertEqual('miss', self.search('state:SUCCESS').cache)
+
+    def test_rebuild_clears_the_cache(self):
+        self.search()
+        self.engine.rebuild(self.tasks.items())
+
+        self.assertEqual('miss', self.search().cache)
+
+
+class TestStandingQueries(unittest.TestCase):
+    def setUp(self):
+        self.tasks = {
+            str(number): SimpleNamespace(
+                uuid=str(number),
+                name='billing.charge' if number % 2 else 'tasks.add',
+                state='FAILURE' if number % 3 else 'SUCCESS', worker=None,
+                args='()', kwargs='{}', result=None, received=number,
+                started=None, timestamp=number, runtime=None)
+            for number in range(10)
+        }
+        self.engine = TaskSearchEngine()
+        self.engine.rebuild(self.tasks.items())
+        self.query = self.engine.add_standing_query('state:FAILURE name:billing')
+
+    def test_matches_on_registration(self):
+        self.assertEqual({'1', '5', '7'}, self.query.task_ids)
+        self.assertEqual(
+            {'id': self.query.id, 'query': 'state:FAILURE name:billing',
+             'count': 3, 'states': {'FAILURE': 3}},
+            self.query.as_dict())
+        self.assertIs(self.query, self.engine.standing_queries[self.query.id])
+
+    def test_changes_update_the_matches(self):
+        self.tasks['3'].state = 'FAILURE'
+        self.tasks['5'].state = 'SUCCESS'
+        self.tasks['7'].args = '(1, 2)'
+        for task_id in ('3', '5', '7'):
+            self.engine.upsert(self.tasks[task_id])
+        self.engine.remove('1')
+        self.engine.upsert(SimpleNamespace(
+            uuid='10', name='billing.refund', state='FAILURE', worker=None,
+            args='()', kwargs='{}', result=None))
+
+        self.assertEqual({'3', '7', '10'}, self.query.task_ids)
+        self.assertEqual({'failure': 3}, self.query.states)
+
+    def test_counts_by_state(self):
+        query = self.engine.add_standing_query('name:billing')
+        self.tasks['1'].state = 'RETRY'
+        self.engine.upsert(self.tasks['1'])
+
+        self.assertEqual({'FAILURE': 2, 'SUCCESS': 2, 'RETRY': 1},
+                         query.as_dict()['states'])
+
+    def test_rebuild_refreshes_the_matches(self):
+        self.engine.rebuild(
+            (task_id, task) for task_id, task in self.tasks.items()
+            if task_id != '5')
+
+        self.assertEqual({'1', '7'}, self.query.task_ids)
+
+    def test_most_recent_matches(self):
+        self.assertEqual(['7', '5'],
+                         self.engine.most_recent(self.query.task_ids, 2))
+
+    def test_changes_are_matched_without_the_index(self):
+        queries = [
+            self.engine.add_standing_query(query) for query in (
+                'billing', 'name:charge OR state:SUCCESS', 'args:"(1, 2"',
+                'kwargs:a=1 state:FAILURE', "kwargs:{'a")
+        ]
+        self.tasks['4'].args = '(1, 2)'
+        self.tasks['4'].kwargs = "{'a': '1'}"
+
+        with patch.object(self.engine, '_evaluate') as evaluate, \
+                patch.object(self.engine, '_substring_estimate') as estimate:
+            self.engine.upsert(self.tasks['4'])
+        evaluate.assert_not_called()
+        estimate.assert_not_called()
+
+        for query in queries:
+            with self.subTest(query=query.query):
+                self.assertEqual(
+                    self.engine.matching_ids(query.query), query.task_ids)
+
+    def test_remove_standing_query(self):
+        self.assertTrue(self.engine.remove_standing_query(self.query.id))
+        self.assertFalse(self.engine.remove_standing_query(self.query.id))
+        self.engine.remove('1')
+
+        self.assertEqual({}, self.engine.standing_queries)
+
+
 class TestSearchIndexLifecycle(unittest.TestCase):
     @staticmethod
     def received_event(uuid, name, clock):
@@ -312,6 +858,56 @@ class TestSearchIndexLifecycle(unittest.TestCase):
 
         self.assertEqual({'1'}, restored.search_engine.matching_ids('name:first'))
 
+    def test_restore_uses_the_persisted_index(self):
+        state = EventsState()
+        state.event(self.received_event('1', 'tasks.first', 1))
+        state.event(self.received_event('2', 'tasks.second', 2))
+        records = list(state.snapshot_records())
+        records.append(('task', dict(records[-1][1], name='tasks.renamed')))
+
+        restored = EventsState()
+        with patch('flower.utils.search.SearchDocument.from_task',
+                   wraps=SearchDocument.from_task) as from_task:
+            restored.restore(records)
+
+        self.assertEqual(['2'], [call.args[0].uuid for call in from_task.call_args_list])
+        self.assertEqual({'1'}, restored.search_engine.matching_ids('name:first'))
+        self.assertEqual({'2'}, restored.search_engine.matching_ids('name:renamed'))
+
+    def test_loaded_engine_keeps_tasks_indexed_while_loading(self):
+        state = EventsState()
+        state.event(self.received_event('1', 'tasks.first', 1))
+        state.event(self.received_event('2', 'tasks.second', 2))
+        records = list(state.load_records(state.snapshot_records()))
+
+        restored = EventsState()
+        standing_query = restored.search_engine.add_standing_query('name:third')
+        restored.event(self.received_event('3', 'tasks.third', 3))
+        restored.restore(records)
+
+        self.assertEqual('search-engine', records[2][0])
+        self.assertIs(records[2][1], restored.search_engine)
+        self.assertEqual({'1', '2', '3'}, set(restored.search_engine.documents))
+        self.assertEqual({'3'}, restored.search_engine.matching_ids('name:third'))
+        self.assertEqual(
+            {standing_query.id: standing_query},
+            restored.search_engine.standing_queries)
+        self.assertEqual({'3'}, standing_query.task_ids)
+
+    def test_restore_rebuilds_an_invalid_index(self):
+        state = EventsState()
+        state.event(self.received_event('1', 'tasks.first', 1))
+        records = [
+            (kind, dict(value, version=0) if kind == 'search-index' else value)
+            for kind, value in state.snapshot_records()
+        ]
+
+        restored = EventsState()
+        with self.assertLogs('flower.events', level='WARNING'):
+            restored.restore(records)
+
+        self.assertEqual({'1'}, restored.search_engine.matching_ids('name:first'))
+
     def test_clearing_tasks_rebuilds_the_index(self):
         state = EventsState()
         state.event(self.received_event('1', 'tasks.finished', 1))
@@ -0,0 +1,43 @@
+import random
+import unittest
+
+from flower.utils.sketch import DDSketch
+
+
+class TestDDSketch(unittest.TestCase):
+    def test_quantiles_are_within_the_relative_accuracy(self):
+        generator = random.Random(7)
+        values = [generator.lognormvariate(0, 2) for _ in range(20000)]
+        sketch = DDSketch(relative_accuracy=0.01)
+        for value in values:
+            sketch.add(value)
+
+        values.sort()
+        for quantile in (0.5, 0.9, 0.95, 0.99):
+            with self.subTest(quantile=quantile):
+                exact = values[int(quantile * (len(values) - 1))]
+                self.assertAlmostEqual(exact, sketch.quantile(quantile),
+                                       delta=exact * 0.0201)
+        self.assertEqual(len(values), len(sketch))
+        self.assertEqual(values[-1], sketch.quantile(1))
+
+    def test_empty_and_zero_values(self):
+        sketch = DDSketch()
+        self.assertEqual({'count': 0, 'sum': 0.0, 'min': None, 'max': None,
+                          'p50': None, 'p90': None, 'p95': None,
+                          'p99': None}, sketch.stats())
+
+        for value in (0, 0, 0, 5.0):
+            sketch.add(value)
+        self.assertEqual(0, sketch.quantile(0.5))
+        self.assertAlmostEqual(5.0, sketch.quantile(1), delta=0.05)
+
+    def test_collapses_the_lowest_bins(self):
+        sketch = DDSketch(max_bins=10)
+        for exponent in range(-20, 5):
+            sketch.add(10.0 ** exponent)
+
+        self.assertEqual(10, len(sketch.bins))
+        self.assertEqual(25, len(sketch))
+        self.assertAlmostEqual(10000.0, sketch.quantile(1), delta=100)
+        self.assertAlmostEqual(100.0, sketch.quantile(0.95), delta=1)
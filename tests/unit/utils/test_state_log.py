@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+
+from flower.utils.state_log import StateLog, StateLogError, encode_record
+
+
+class TestStateLog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'flower')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_replays_snapshot_and_newer_segments(self):
+        log = StateLog(self.path)
+        log.compact([('task', 1)])
+        log.append([('task', 2)])
+        log.append([('task', 3)])
+        log.close()
+
+        self.assertEqual(
+            [('task', 1), ('task', 2), ('task', 3)],
+            list(StateLog(self.path).read()))
+
+    def test_compaction_removes_covered_segments(self):
+        log = StateLog(self.path)
+        log.append([('task', 1)])
+        log.compact([('task', 1), ('task', 2)])
+        log.append([('task', 3)])
+        log.close()
+
+        self.assertEqual([1], log.segments())
+        self.assertEqual(
+            [('task', 1), ('task', 2), ('task', 3)],
+            list(StateLog(self.path).read()))
+
+    def test_new_log_appends_to_a_new_segment(self):
+        log = StateLog(self.path)
+        log.compact([])
+        log.append([('task', 1)])
+        log.close()
+
+        reopened = StateLog(self.path)
+        reopened.append([('task', 2)])
+        reopened.close()
+
+        self.assertEqual([0, 1], reopened.segments())
+        self.assertEqual([('task', 1), ('task', 2)], list(reopened.read()))
+
+    def test_does_not_replay_segments_started_while_reading(self):
+        log = StateLog(self.path)
+        log.compact([('task', 1)])
+        log.append([('task', 2)])
+        log.close()
+
+        reopened = StateLog(self.path)
+        records = reopened.read()
+        self.assertEqual(('task', 1), next(records))
+        reopened.append([('task', 3)])
+        reopened.close()
+
+        self.assertEqual([('task', 2)], list(records))
+
+    def test_ignores_incomplete_tail(self):
+        log = StateLog(self.path)
+        log.compact([])
+        log.append([('task', 1)])
+        log.segment_file.write(encode_record(('task', 2))[:-1])
+        log.close()
+
+        self.assertEqual([('task', 1)], list(StateLog(self.path).read()))
+
+    def test_should_compact(self):
+        log = StateLog(self.path)
+        self.assertTrue(log.should_compact())
+
+        log.compact([('task', 1)])
+        log.min_compaction_size = 0
+        self.assertFalse(log.should_compact())
+
+        log.append([('task', 'x' * 100)])
+        self.assertTrue(log.should_compact())
+        log.close()
+
+    def test_rejects_unknown_snapshot_format(self):
+        with open(self.path + '.snapshot', 'wb') as snapshot:
+            snapshot.write(encode_record(('header', {'version': 0})))
+
+        with self.assertRaisesRegex(StateLogError, 'Unsupported'):
+            list(StateLog(self.path).read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from flower.events import EventsState, Events
+from flower.utils.search import parse_query
+from flower.utils.task_store import (TaskStore, check_sqlite, open_task_store,
+                                     task_store_path)
+from flower.utils.tasks import get_task_by_id, page_tasks, search_tasks
+from tests.unit.utils import (send_events, task_failed_events,
+                              task_succeeded_events)
+
+NO_FILTERS = (None,) * 7
+
+
+def record(task_id, **fields):
+    fields.setdefault('name', 'tasks.add')
+    fields.setdefault('state', 'SUCCESS')
+    fields.setdefault('timestamp', 1000.0)
+    fields.setdefault('worker', 'worker1')
+    fields.setdefault('children', [])
+    return dict(uuid=task_id, **fields)
+
+
+class TestTaskStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = TaskStore(os.path.join(self.directory.name, 'tasks.db'))
+        self.store.start()
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def put(self, *records):
+        for fields in records:
+            self.store.put(fields)
+        self.assertTrue(self.store.flush(5))
+
+    def search(self, query='', filters=NO_FILTERS, sort_by='timestamp',
+               descending=True, after=None, count=None):
+        return [task_id for _, task_id in self.store.search(
+            parse_query(query), filters, sort_by, descending, after, count)]
+
+    def test_parses_urls(self):
+        self.assertEqual('flower.db', task_store_path('sqlite:///flower.db'))
+        self.assertEqual('/var/flower.db',
+                         task_store_path('sqlite:////var/flower.db'))
+        for url in ('flower.db', 'sqlite://', 'postgres:///flower'):
+            with self.subTest(url=url):
+                with self.assertRaisesRegex(ValueError, 'Unsupported'):
+                    open_task_store(url)
+
+    def test_requires_sqlite_full_text_search(self):
+        check_sqlite()
+        with patch('sqlite3.sqlite_version_info', (3, 31, 1)):
+            with self.assertRaisesRegex(ValueError, 'SQLite 3.34 or later'):
+                TaskStore(os.path.join(self.directory.name, 'old.db'))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory.name, 'old.db')))
+
+    def test_merges_records_of_a_task(self):
+        self.put(record('1', state='STARTED', args='(1, 2)', children=['2']),
+                 record('1', state='SUCCESS', result='3', children=['3']))
+
+        fields = self.store.get('1')
+        self.assertEqual('SUCCESS', fields['state'])
+        self.assertEqual('(1, 2)', fields['args'])
+        self.assertEqual(['2', '3'], fields['children'])
+        self.assertEqual(1, len(self.store))
+        self.assertIsNone(self.store.get('2'))
+        self.assertEqual({}, self.store.pending)
+
+    def test_translates_searches(self):
+        self.put(
+            record('1', name='tasks.Add', args="('alpha',)",
+                   kwargs="{'user': 'Ann'}"),
+            record('2', name='tasks.mul', state='FAILURE',
+                   result='KeyError("beta")', timestamp=1001.0),
+            record('3', name='tasks.add', worker='worker2',
+                   kwargs="{'user': 'bob'}", timestamp=1002.0),
+        )
+
+        self.assertEqual(['3', '2', '1'], self.search())
+        self.assertEqual(['1'], self.search('alpha'))
+        self.assertEqual(['3', '1'], self.search('name:add'))
+        self.assertEqual(['2'], self.search('state:failure'))
+        self.assertEqual(['1'], self.search('kwargs:user=ann'))
+        self.assertEqual(['2', '1'], self.search('alpha OR "error(\\"beta"'))
+        self.assertEqual(['3'], self.search('tasks.add worker2'))
+        self.assertEqual([], self.search('args:beta'))
+        self.assertEqual(
+            ['3'], self.search(filters=('tasks.add', 'worker2') + (None,) * 5))
+        self.assertEqual(2, self.store.count(
+            parse_query('tasks'), ('tasks.add',) + (None,) * 6))
+
+    def test_orders_like_the_search_engine(self):
+        self.put(record('a', timestamp=2.0), record('b', timestamp=1.0),
+                 record('c', timestamp=None), record('d', timestamp=2.0))
+
+        self.assertEqual(['c', 'b', 'a', 'd'],
+                         self.search(descending=False))
+        pairs = self.store.search(parse_query(''), NO_FILTERS, 'timestamp',
+                                  True, None, 2)
+        self.assertEqual([((True, 2.0, 'd'), 'd'), ((True, 2.0, 'a'), 'a')],
+                         pairs)
+        self.assertEqual(['b', 'c'],
+                         self.search(after=pairs[-1][0], descending=True))
+
+    def test_prunes_old_tasks(self):
+        now = time.time()
+        self.store.max_age = 100
+        self.put(record('1', timestamp=now - 200, kwargs="{'a': 1}"),
+                 record('2', timestamp=now), record('3', timestamp=None))
+
+        self.assertEqual(2, len(self.store))
+        self.assertIsNone(self.store.get('1'))
+        self.assertEqual(['2', '3'], self.search())
+        self.assertEqual([], self.search('kwargs:a=1'))
+
+
+class TestStoredTasks(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = TaskStore(os.path.join(self.directory.name, 'tasks.db'))
+        self.store.start()
+        self.events = Events.__new__(Events)
+        self.events.state = EventsState(max_tasks_in_memory=2,
+                                        task_store=self.store)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+        super().tearDown()
+
+    def send(self, events):
+        send_events(self.events.state, events)
+
+    @gen_test
+    async def test_spills_evicted_tasks(self):
+        self.send(task_failed_events('worker1', id='1', name='tasks.fail'))
+        self.send(task_succeeded_events('worker1', id='2'))
+        self.send(task_succeeded_events('worker1', id='3'))
+        self.assertTrue(self.store.flush(5))
+
+        self.assertEqual(['2', '3'], list(self.events.state.tasks))
+        task = await get_task_by_id(self.events, '1')
+        self.assertEqual('FAILURE', task.state)
+        self.assertEqual('tasks.fail', task.name)
+        self.assertEqual('worker1', task.worker.hostname)
+        self.assertEqual('1', task.as_dict()['uuid'])
+
+        page = await search_tasks(self.events, search='name:fail')
+        self.assertEqual(['1'], page.task_ids)
+        self.assertEqual(['1'], [task_id for task_id, _ in
+                                 await page_tasks(self.events, page)])
+
+    @gen_test
+    async def test_reads_the_store_in_the_reader_thread(self):
+        self.send(task_failed_events('worker1', id='1', name='tasks.fail'))
+        self.send(task_succeeded_events('worker1', id='2'))
+        self.send(task_succeeded_events('worker1', id='3'))
+        self.assertTrue(self.store.flush(5))
+        threads = []
+
+        def record_thread(method):
+            def read(*args):
+                threads.append(threading.current_thread().name)
+                return method(*args)
+            return read
+
+        with patch.object(self.store, 'fetch', record_thread(self.store.fetch)), \
+                patch.object(self.store, 'get_many',
+                             record_thread(self.store.get_many)):
+            page = await search_tasks(self.events, search='name:fail')
+            tasks = await page_tasks(self.events, page)
+
+        self.assertEqual(['1'], [task_id for task_id, _ in tasks])
+        self.assertEqual(2, len(threads))
+        for name in threads:
+            self.assertTrue(name.startswith('flower-task-store-reader'))
+
+    @gen_test
+    async def test_pages_through_memory_and_store(self):
+        for task_id in ('1', '2', '3', '4', '5'):
+            self.send(task_succeeded_events('worker1', id=task_id))
+        self.assertTrue(self.store.flush(5))
+
+        page = await search_tasks(self.events, limit=2)
+        self.assertEqual(['5', '4'], page.task_ids)
+        self.assertEqual(5, page.filtered_count)
+        self.assertEqual(5, page.total_count)
+        task_ids = list(page.task_ids)
+        while page.next_cursor:
+            page = await search_tasks(self.events, limit=2,
+                                      cursor=page.next_cursor)
+            task_ids.extend(page.task_ids)
+        self.assertEqual(['5', '4', '3', '2', '1'], task_ids)
+        page = await search_tasks(self.events, limit=2, offset=3)
+        self.assertEqual(['2', '1'], page.task_ids)
+
+    @gen_test
+    async def test_searches_without_a_limit_return_max_tasks(self):
+        for task_id in ('1', '2', '3', '4', '5'):
+            self.send(task_succeeded_events('worker1', id=task_id))
+        self.assertTrue(self.store.flush(5))
+
+        page = await search_tasks(self.events)
+        self.assertEqual(['5', '4'], page.task_ids)
+        self.assertEqual(5, page.filtered_count)
+        page = await search_tasks(self.events, cursor=page.next_cursor)
+        self.assertEqual(['3', '2'], page.task_ids)
+
+    @gen_test
+    async def test_writes_tasks_in_memory_through(self):
+        self.send(task_succeeded_events('worker1', id='1'))
+        self.send(task_failed_events('worker1', id='2', name='tasks.fail'))
+        self.assertEqual({'1': None, '2': None}, self.store.unflushed)
+        page = await search_tasks(self.events)
+        self.assertEqual((2, 2), (page.filtered_count, page.total_count))
+
+        self.events.state.flush_task_store()
+        self.assertTrue(self.store.flush(5))
+
+        self.assertEqual({}, self.store.unflushed)
+        self.assertEqual(2, len(self.store))
+        page = await search_tasks(self.events)
+        self.assertEqual(['2', '1'], page.task_ids)
+        self.assertEqual((2, 2), (page.filtered_count, page.total_count))
+        page = await search_tasks(self.events, search='name:fail')
+        self.assertEqual((1, 2), (page.filtered_count, page.total_count))
+
+    @gen_test
+    async def test_keeps_history_across_restarts(self):
+        for task_id in ('1', '2'):
+            self.send(task_succeeded_events('worker1', id=task_id))
+        self.events.state.flush_task_store()
+        self.store.close()
+
+        self.store = TaskStore(self.store.path)
+        self.store.start()
+        self.events.state = EventsState(task_store=self.store)
+        self.send(task_succeeded_events('worker1', id='3'))
+
+        page = await search_tasks(self.events)
+        self.assertEqual(['3', '2', '1'], page.task_ids)
+        self.assertEqual(3, page.total_count)
+        task = await get_task_by_id(self.events, '1')
+        self.assertEqual('SUCCESS', task.state)
@@ -0,0 +1,66 @@
+import unittest
+
+from flower.utils.timeseries import FIELDS, RingBuffer, TaskTimeSeries
+
+SUCCEEDED = FIELDS.index('succeeded')
+
+
+class TestRingBuffer(unittest.TestCase):
+    def test_keeps_the_latest_slots(self):
+        buffer = RingBuffer(resolution=10, size=3)
+        for timestamp in (100, 105, 110, 120, 130):
+            buffer.add(timestamp, SUCCEEDED, runtime=1.5)
+
+        series = buffer.series(13)
+        self.assertEqual([1, 1, 1], series['succeeded'])
+        self.assertEqual([1.5, 1.5, 1.5], series['runtime'])
+        self.assertEqual([0, 0, 0], series['failed'])
+        # Slot 10 was taken over by slot 13
+        self.assertEqual([0, 0, 0], buffer.series(10)['succeeded'])
+        self.assertEqual([1, 1, 0], buffer.series(14)['succeeded'])
+
+    def test_drops_values_older_than_the_window(self):
+        buffer = RingBuffer(resolution=1, size=2)
+        buffer.add(10, SUCCEEDED)
+        buffer.add(8, SUCCEEDED)
+        buffer.add(9, SUCCEEDED)
+
+        self.assertEqual([1, 1], buffer.series(10)['succeeded'])
+
+
+class TestTaskTimeSeries(unittest.TestCase):
+    def event(self, event_type, timestamp, **fields):
+        return dict(type=event_type, timestamp=timestamp, **fields)
+
+    def test_counts_events_per_task_and_worker(self):
+        timeseries = TaskTimeSeries()
+        timeseries.add(self.event('task-received', 1000), 'w1', 'tasks.add')
+        timeseries.add(self.event('task-succeeded', 1001, runtime=0.5),
+                       'w1', 'tasks.add')
+        timeseries.add(self.event('task-failed', 1001), 'w2', 'tasks.mul')
+        timeseries.add(self.event('worker-heartbeat', 1001), 'w2', '')
+
+        result = timeseries.query('second', now=1001.5)
+        self.assertEqual(1, result['resolution'])
+        self.assertEqual([1000, 1001], result['timestamps'][-2:])
+        self.assertEqual(['tasks.add', 'tasks.mul'], list(result['tasks']))
+        add = result['tasks']['tasks.add']
+        self.assertEqual([1, 0], add['received'][-2:])
+        self.assertEqual([0, 1], add['succeeded'][-2:])
+        self.assertEqual([0, 0.5], add['runtime'][-2:])
+        self.assertEqual(1, sum(result['workers']['w2']['failed']))
+
+        result = timeseries.query('minute', worker_name='w1', now=1001.5)
+        self.assertEqual(960, result['timestamps'][-1])
+        self.assertEqual(['w1'], list(result['workers']))
+        self.assertEqual(2, sum(result['workers']['w1']['received']) +
+                         sum(result['workers']['w1']['succeeded']))
+
+    def test_removes_idle_series(self):
+        timeseries = TaskTimeSeries()
+        timeseries.add(self.event('task-received', 1000), 'w1', 'tasks.add')
+        timeseries.add(self.event('task-received', 20000), 'w2', 'tasks.mul')
+        timeseries.prune(20000)
+
+        self.assertEqual(['tasks.mul'], list(timeseries.tasks))
+        self.assertEqual(['w2'], list(timeseries.workers))
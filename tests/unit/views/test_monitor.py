@@ -1,13 +1,17 @@
+import gzip
+import os
 import re
 import time
 from datetime import datetime, timedelta
+from unittest.mock import patch
 
 from celery.events import Event
 from kombu import uuid
 
-from flower.events import EventsState
+from flower.events import EventsState, get_prometheus_metrics
 from tests.unit import AsyncHTTPTestCase
-from tests.unit.utils import task_failed_events, task_succeeded_events
+from tests.unit.utils import (send_events, task_failed_events,
+                              task_succeeded_events)
 
 
 class PrometheusTests(AsyncHTTPTestCase):
@@ -261,6 +265,96 @@ class PrometheusTests(AsyncHTTPTestCase):
             f'flower_worker_prefetched_tasks{{task="{task_name}",worker="{worker_name}"}} 1.0' in metrics
         )
 
+    def test_search_cache_metric(self):
+        self.app.events.state = EventsState()
+        with patch.dict(os.environ, FLOWER_UNAUTHENTICATED_API='true'):
+            for _ in range(2):
+                self.get('/api/tasks?search=needle')
+
+        metrics = self.get('/metrics').body.decode('utf-8')
+
+        self.assertIn('flower_search_cache_total{result="miss"}', metrics)
+        self.assertIn('flower_search_cache_total{result="hit"}', metrics)
+
+    def test_metrics_are_gzipped_for_scrapers_accepting_gzip(self):
+        response = self.get('/metrics', decompress_response=False,
+                            headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        metrics = gzip.decompress(response.body).decode('utf-8')
+        self.assertIn('flower_metrics_scrape_duration_seconds', metrics)
+        plain = self.get('/metrics', decompress_response=False)
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+    def test_metrics_follow_gzip_quality_values(self):
+        for accept_encoding, gzipped in (('gzip;q=0', False),
+                                         ('identity, gzip;q=0.5', True),
+                                         ('*;q=0.1', True),
+                                         ('*, gzip;q=0', False),
+                                         ('br', False)):
+            with self.subTest(accept_encoding=accept_encoding):
+                response = self.get('/metrics', decompress_response=False,
+                                    headers={'Accept-Encoding': accept_encoding})
+                self.assertEqual(gzipped, 'Content-Encoding' in response.headers)
+
+    def test_metrics_are_gzipped_once_per_rendering(self):
+        with self.mock_option('metrics_cache_ttl', 60.0), \
+                patch('flower.metrics.gzip.compress',
+                      wraps=gzip.compress) as compress:
+            self.get('/metrics', decompress_response=False)
+            self.assertEqual(0, compress.call_count)
+            for _ in range(2):
+                response = self.get('/metrics', decompress_response=False,
+                                    headers={'Accept-Encoding': 'gzip'})
+                self.assertIn(b'flower_events_total',
+                              gzip.decompress(response.body))
+
+        self.assertEqual(1, compress.call_count)
+
+    def test_metrics_are_cached_for_the_ttl(self):
+        state = EventsState()
+        self.app.events.state = state
+        counter = state.metrics.events.labels(
+            'cached-worker', 'task-succeeded', 'cached-task')
+        counter.inc()
+        pattern = 'flower_events_total{task="cached-task",type="task-succeeded",worker="cached-worker"} (.*)'
+
+        with self.mock_option('metrics_cache_ttl', 60.0):
+            first = self.get('/metrics').body.decode('utf-8')
+            counter.inc()
+            cached = self.get('/metrics').body.decode('utf-8')
+        with self.mock_option('metrics_cache_ttl', 0.0):
+            rendered = self.get('/metrics').body.decode('utf-8')
+
+        self.assertEqual(re.findall(pattern, first), re.findall(pattern, cached))
+        self.assertEqual(float(re.findall(pattern, first)[0]) + 1,
+                         float(re.findall(pattern, rendered)[0]))
+
+    def test_task_runtime_summary(self):
+        state = EventsState()
+        send_events(state, task_succeeded_events(
+                worker='worker1', name='summary-task', id='1', runtime=2.0))
+        self.app.events.state = state
+        metrics = get_prometheus_metrics()
+
+        metrics.expose_runtime_quantiles(self.app.runtime_sketches)
+        try:
+            body = self.get('/metrics').body.decode('utf-8')
+        finally:
+            metrics.expose_runtime_quantiles(None)
+
+        self.assertIn('# TYPE flower_task_runtime_quantiles_seconds summary',
+                      body)
+        quantile = re.search(
+            'flower_task_runtime_quantiles_seconds{quantile="0.99",task="summary-task"} (.*)',
+            body).group(1)
+        self.assertAlmostEqual(2.0, float(quantile), delta=0.02)
+        self.assertIn(
+            'flower_task_runtime_quantiles_seconds_count{task="summary-task"} 1.0',
+            body)
+        self.assertNotIn('flower_task_runtime_quantiles_seconds',
+                         self.get('/metrics').body.decode('utf-8'))
+
 
 class HealthcheckTests(AsyncHTTPTestCase):
     def setUp(self):
@@ -1,11 +1,13 @@
 import json
 import time
+from urllib.parse import urlencode
 
 from celery.events import Event
 
 from flower.events import EventsState
 from tests.unit import AsyncHTTPTestCase
-from tests.unit.utils import task_failed_events, task_succeeded_events
+from tests.unit.utils import (send_events, task_failed_events,
+                              task_succeeded_events)
 
 
 class TaskTest(AsyncHTTPTestCase):
@@ -337,3 +339,58 @@ class TasksTest(AsyncHTTPTestCase):
         self.assertEqual('task2', tasks[0]['name'])
         self.assertEqual('456', tasks[0]['uuid'])
         self.assertEqual('worker1', tasks[0]['worker'])
+
+    def test_cursor_pagination(self):
+        state = EventsState()
+        events = []
+        for number in range(3):
+            events += task_succeeded_events(
+                worker='worker1', name=f'task{number}', id=str(number),
+                runtime=float(number))
+        send_events(state, events)
+        self.app.events.state = state
+
+        params = dict(draw=1, start=0, length=2)
+        params['search[value]'] = ''
+        params['order[0][column]'] = 0
+        params['columns[0][data]'] = 'runtime'
+        params['order[0][dir]'] = 'desc'
+
+        r = self.get('/tasks/datatable?' + urlencode(params))
+        table = json.loads(r.body.decode('utf-8'))
+        self.assertEqual(['2', '1'], [task['uuid'] for task in table['data']])
+
+        params['start'] = 2
+        params['cursor'] = table['nextCursor']
+        r = self.get('/tasks/datatable?' + urlencode(params))
+        table = json.loads(r.body.decode('utf-8'))
+        self.assertEqual(['0'], [task['uuid'] for task in table['data']])
+        self.assertEqual(3, table['recordsFiltered'])
+        self.assertIsNone(table['nextCursor'])
+
+    def test_stale_cursor_falls_back_to_the_offset(self):
+        state = EventsState()
+        events = []
+        for number in range(3):
+            events += task_succeeded_events(
+                worker='worker1', name=f'task{number}', id=str(number))
+        send_events(state, events)
+        self.app.events.state = state
+
+        params = dict(draw=1, start=0, length=2)
+        params['search[value]'] = ''
+        params['order[0][column]'] = 0
+        params['columns[0][data]'] = 'name'
+        params['order[0][dir]'] = 'asc'
+        r = self.get('/tasks/datatable?' + urlencode(params))
+        cursor = json.loads(r.body.decode('utf-8'))['nextCursor']
+
+        params['order[0][dir]'] = 'desc'
+        params['start'] = 1
+        params['cursor'] = cursor
+        r = self.get('/tasks/datatable?' + urlencode(params))
+        table = json.loads(r.body.decode('utf-8'))
+
+        self.assertNotIn('searchError', table)
+        self.assertEqual(['task1', 'task0'],
+                         [task['name'] for task in table['data']])
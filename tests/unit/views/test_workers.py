@@ -31,6 +31,14 @@ class WorkersTests(AsyncHTTPTestCase):
         self.assertIn('Load Average', str(r.body))
         self.assertNotIn('<tr id=', str(r.body))
 
+    def test_loading_state_indicator(self):
+        self.assertNotIn('Loading state', self.get('/workers').body.decode())
+
+        self.app.events.loading = True
+        body = self.get('/workers').body.decode()
+
+        self.assertIn('Loading state&hellip; 0 tasks', body)
+
     @unittest.skip('disable temporarily')
     def test_unknown_worker(self):
         with self.mock_option("inspect_timeout", 1.0):